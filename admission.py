@@ -0,0 +1,152 @@
+import time
+import asyncio
+import threading
+from contextlib import contextmanager, asynccontextmanager
+from metrics import ADMISSIONS
+from resources import reinit_after_fork
+
+# Admission control cho các call LLM của agent (rewrite, trả lời, Reflection fallback):
+# - Tối đa `max_in_flight` call đồng thời mỗi process, tối đa `max_queue` request chờ slot.
+# - Mỗi request có 1 Deadline; request chỉ được chờ slot khi thời gian còn lại vẫn đủ cho 1 call LLM
+#   (ước lượng bằng EWMA latency các call gần đây), nếu không thì bị loại ngay (load shedding) thay vì
+#   xếp hàng rồi timeout. Agent bắt AdmissionRejected và trả câu trả lời rút gọn (degraded).
+
+class AdmissionRejected(Exception):
+    """Request bị loại: reason = "deadline" (không kịp deadline) hoặc "queue_full" (hàng đợi đầy)."""
+    def __init__(self, reason: str, message: str = None):
+        super().__init__(message or reason)
+        self.reason = reason
+
+
+class Deadline:
+    """Mốc hết hạn của 1 request (time.monotonic), truyền qua các stage rewrite / embed / retrieve / trả lời."""
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def __repr__(self):
+        return f"Deadline(remaining={self.remaining():.3f}s)"
+
+
+class _AdmissionBase:
+    def __init__(self, max_in_flight: int = 16, max_queue: int = 64, expected_seconds: float = 2.0, alpha: float = 0.2):
+        """
+        expected_seconds: latency ước lượng ban đầu của 1 call LLM, sau đó cập nhật bằng EWMA (hệ số alpha).
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.expected_seconds = expected_seconds
+        self.alpha = alpha
+        self._in_flight = 0
+        self._waiting = 0
+        self._counters = {"admitted": 0, "shed_deadline": 0, "shed_queue": 0, "timeout": 0}
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self._in_flight, "waiting": self._waiting,
+            "expected_ms": round(self.expected_seconds * 1000, 1), **self._counters
+        }
+
+    def _count(self, result: str):
+        self._counters[result] += 1
+        ADMISSIONS.inc(result=result)
+
+    def _observe(self, seconds: float):
+        self.expected_seconds = (1 - self.alpha) * self.expected_seconds + self.alpha * seconds
+
+    def _wait_budget(self, deadline: Deadline) -> float:
+        """Thời gian được phép chờ slot; loại ngay nếu không kịp deadline hoặc hàng đợi đầy."""
+        budget = deadline.remaining() - self.expected_seconds if deadline is not None else None
+        if budget is not None and budget <= 0:
+            self._count("shed_deadline")
+            raise AdmissionRejected("deadline", f"Không đủ thời gian cho call LLM (còn {deadline.remaining():.2f}s)")
+        if self._in_flight >= self.max_in_flight and self._waiting >= self.max_queue:
+            self._count("shed_queue")
+            raise AdmissionRejected("queue_full", f"Hàng đợi LLM đầy ({self._waiting} request)")
+        return budget
+
+
+class AdmissionController(_AdmissionBase):
+    """Bản thread (Flask / gunicorn gthread)."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reopen()
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        """Sau fork: mỗi worker có giới hạn / hàng đợi riêng, bắt đầu rỗng."""
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._waiting = 0
+
+    @contextmanager
+    def slot(self, deadline: Deadline = None):
+        """Giữ 1 slot trong block; latency của block được dùng để cập nhật ước lượng."""
+        with self._cond:
+            budget = self._wait_budget(deadline)
+            self._waiting += 1
+            try:
+                if not self._cond.wait_for(lambda: self._in_flight < self.max_in_flight, timeout=budget):
+                    self._count("timeout")
+                    raise AdmissionRejected("deadline", "Hết thời gian chờ slot LLM")
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+            self._count("admitted")
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._observe(time.perf_counter() - started)
+                self._in_flight -= 1
+                self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return super().stats()
+
+
+class AsyncAdmissionController(_AdmissionBase):
+    """Bản asyncio (asgi.py); chỉ dùng trong 1 event loop."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = None
+
+    def _get_cond(self):
+        # Condition tạo lazily để gắn với event loop đang chạy (như AsyncOpenAiClient._get_slots)
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    @asynccontextmanager
+    async def slot(self, deadline: Deadline = None):
+        cond = self._get_cond()
+        async with cond:
+            budget = self._wait_budget(deadline)
+            self._waiting += 1
+            try:
+                await asyncio.wait_for(cond.wait_for(lambda: self._in_flight < self.max_in_flight), timeout=budget)
+            except asyncio.TimeoutError:
+                self._count("timeout")
+                raise AdmissionRejected("deadline", "Hết thời gian chờ slot LLM") from None
+            finally:
+                self._waiting -= 1
+            self._in_flight += 1
+            self._count("admitted")
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._observe(time.perf_counter() - started)
+            self._in_flight -= 1
+            async with cond:
+                # notify_all: waiter vừa bị timeout / cancel có thể đã nhận notify -> không để mất lượt
+                cond.notify_all()
@@ -1,5 +1,26 @@
 import os
+import re
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import Future, ThreadPoolExecutor
+from openai import APITimeoutError
 from openai_client import OpenAiClient
+from admission import AdmissionRejected, Deadline
+from embeddings import EmbeddingService, normalize_text
+from resources import reinit_after_fork
+from rag.registry import current_catalog, catalog_scope
+from metrics import lap as _lap, request_timings, set_outcome, annotate, request_scope, current_request_id, new_request_id, FALLBACKS
+
+logger = logging.getLogger(__name__)
+
+# Call LLM bị loại bởi admission control hoặc hết deadline -> câu trả lời degraded thay vì lỗi / chờ tiếp
+DEGRADE_ERRORS = (AdmissionRejected, APITimeoutError)
+OVERLOADED_MESSAGE = "Hệ thống đang quá tải, bạn vui lòng thử lại sau ít phút."
+
 
 class GuardedRAGAgent:
     """
@@ -7,27 +28,135 @@ class GuardedRAGAgent:
     - Dùng chatHistory để tạo câu hỏi standalone.
     - Tìm document RAG dựa trên rewritten query.
     - Fallback Reflection nếu không tìm đủ document.
+    - Bỏ qua rewrite khi không có history hoặc query đã nêu tên sản phẩm trong catalog;
+      khi phải rewrite thì retrieval bằng query gốc chạy song song (speculative).
+    - Admission control (admission + deadline_seconds): mỗi request có 1 Deadline, call LLM phải xin slot;
+      bị loại / timeout -> bỏ rewrite (dùng câu hỏi gốc), còn câu trả lời thì thành danh sách sản phẩm
+      từ kết quả retrieval (tên, giá, link), đánh dấu "degraded".
     """
-    def __init__(self, rag, embedding_client, embed_model, fallback_reflection=None, similarity_threshold=0.75, max_last_items=100):
+    def __init__(self, rag, embedding_client, embed_model, fallback_reflection=None, similarity_threshold=0.75, max_last_items=100, embedder=None, llm=None,
+                 rewrite_history_items=10, speculative_workers=8, admission=None, deadline_seconds=None):
         self.rag = rag
         self.embedding_client = embedding_client
         self.embed_model = embed_model
+        self.embedder = embedder or EmbeddingService(embedding_client, embed_model)
+        # Gateway LLM dùng chung (pool kết nối) cho rewrite + trả lời
+        self.llm = llm or (fallback_reflection.llm if fallback_reflection else OpenAiClient(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            base_url=os.getenv("OPENAI_ENDPOINT")
+        ))
         self.fallback_reflection = fallback_reflection
         self.similarity_threshold = similarity_threshold
         self.max_last_items = max_last_items
+        self.rewrite_history_items = rewrite_history_items
         self.last_rewritten_query = ""
+        self.speculative_workers = speculative_workers
+        self.admission = admission
+        self.deadline_seconds = deadline_seconds
+        self._speculative_pool = ThreadPoolExecutor(max_workers=speculative_workers)
+        self._rewrite_counters = {"skipped": 0, "llm": 0, "shed": 0, "speculative_hits": 0, "saved_ms": 0.0}
+        self._rewrite_latency_ms = 0.0  # EWMA latency của rewrite LLM call
+        self._counters_lock = threading.Lock()
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        """Sau fork: worker thread của pool thuộc process cha -> tạo pool / lock mới."""
+        self._speculative_pool = ThreadPoolExecutor(max_workers=self.speculative_workers)
+        self._counters_lock = threading.Lock()
+
+    @property
+    def rag(self):
+        """RAG của catalog trong request hiện tại (catalog_scope), mặc định là RAG truyền vào constructor."""
+        return current_catalog() or self._rag
+
+    @rag.setter
+    def rag(self, rag):
+        self._rag = rag
 
     def is_product_query(self, query: str) -> bool:
-        """Check sơ bộ query có liên quan sản phẩm."""
-        keywords = ["iphone", "samsung", "laptop", "điện thoại", "máy tính", "máy ảnh"]
-        return any(k.lower() in query.lower() for k in keywords)
+        """
+        Check sơ bộ query có liên quan sản phẩm: có brand / model / category / từ khoá sản phẩm của catalog
+        (EntityMatcher, không phân biệt dấu, 1 lượt quét).
+        """
+        return bool(self.rag.match_entities(query))
 
-    def __rewrite_query(self, chatHistory, query):
-        """Tạo câu hỏi standalone dựa trên chat history dài hạn."""
-        history_to_use = chatHistory[-self.max_last_items:] if len(chatHistory) > self.max_last_items else chatHistory
+    def rewrite_stats(self) -> dict:
+        """Counter cộng dồn: số lần bỏ qua / gọi / bị loại (admission) rewrite, speculative hit, tổng latency tiết kiệm (ms)."""
+        with self._counters_lock:
+            return dict(self._rewrite_counters)
+
+    def _needs_rewrite(self, chatHistory, query) -> bool:
+        """Chỉ cần rewrite khi có history và query chưa nêu tên model cụ thể."""
+        if not chatHistory:
+            return False
+        return not any(m["type"] == "model" for m in self.rag.match_entities(query))
+
+    @staticmethod
+    def _same_question(a: str, b: str) -> bool:
+        def canonical(text):
+            return re.sub(r"\s+", " ", re.sub(r"[^\w\s]", " ", normalize_text(text))).strip()
+        return canonical(a) == canonical(b)
+
+    def _retrieve(self, text: str, deadline=None):
+        """Embed + retrieval cho 1 câu hỏi. Trả về (embedding, results, elapsed_ms)."""
+        started = time.perf_counter()
+        query_embedding = self.embedder.embed(text, deadline=deadline)
+        results = self.rag.hybrid_search(query_embedding, limit=5, query_text=text)
+        return query_embedding, results, (time.perf_counter() - started) * 1000
+
+    def _record_rewrite(self, stats: dict, rewrite_ms: float = None):
+        with self._counters_lock:
+            if rewrite_ms is not None:
+                self._rewrite_latency_ms = rewrite_ms if not self._rewrite_latency_ms else 0.8 * self._rewrite_latency_ms + 0.2 * rewrite_ms
+            if stats["rewrite"] == "skipped":
+                stats["saved_ms"] = round(self._rewrite_latency_ms, 1)
+            self._rewrite_counters[stats["rewrite"]] += 1
+            if stats["speculative"] == "hit":
+                self._rewrite_counters["speculative_hits"] += 1
+            self._rewrite_counters["saved_ms"] += stats["saved_ms"]
+
+    # ------------------- Admission / deadline -------------------
+    def _new_deadline(self):
+        return Deadline(self.deadline_seconds) if self.deadline_seconds else None
+
+    def _llm_slot(self, deadline):
+        return self.admission.slot(deadline) if self.admission is not None else contextlib.nullcontext()
+
+    def _llm_chat(self, messages, deadline=None):
+        with self._llm_slot(deadline):
+            return self.llm.chat(messages, deadline=deadline)
+
+    def _degraded(self, query: str, session_id: str, plan: dict, error: Exception) -> dict:
+        """Câu trả lời rút gọn từ kết quả retrieval (không gọi LLM); turn vẫn được lưu vào history."""
+        reason = getattr(error, "reason", "timeout")
+        logger.warning("Degraded answer (%s): %s", reason, error)
+        set_outcome("degraded", degraded_reason=reason)
+        output = self._degraded_answer(plan.get("results") or [])
+        if self.fallback_reflection:
+            self.fallback_reflection.__record_turn__(session_id, query, query, output)
+        return {"output": output, "stats": plan["stats"], "degraded": True}
+
+    def _truncated(self, query: str, session_id: str, partial: str, error: Exception):
+        """Stream hết deadline sau khi đã gửi token: dừng ở phần đã gửi, lưu turn (không cache câu trả lời dở)."""
+        logger.warning("Stream bị cắt (%s): %s", getattr(error, "reason", "timeout"), error)
+        set_outcome("degraded", degraded_reason="truncated")
+        if self.fallback_reflection:
+            self.fallback_reflection.__record_turn__(session_id, query, query, partial)
+
+    @staticmethod
+    def _degraded_answer(results) -> str:
+        if not results:
+            return OVERLOADED_MESSAGE
+        lines = [f"- {r['title']}: {r['price']}" + (f" ({r.link})" if r.link else "") for r in results]
+        return "Hệ thống đang bận nên chưa thể tư vấn chi tiết. Các sản phẩm phù hợp với câu hỏi của bạn:\n" + "\n".join(lines)
+
+    def _rewrite_prompt(self, chatHistory, query):
+        # chatHistory đã qua ContextBuilder: [summary] + các turn gần nhất trong token budget
+        summary = [h for h in chatHistory if h["role"] == "system"]
+        history_to_use = summary + [h for h in chatHistory if h["role"] != "system"][-self.rewrite_history_items:]
         historyString = "\n".join([f"{h['role']}: {h['content']}" for h in history_to_use])
 
-        prompt = [{
+        return [{
             "role": "user",
             "content": f"""
 Given a chat history and the latest user question, formulate a standalone question in Vietnamese which can be understood without the chat history. 
@@ -38,88 +167,574 @@ Do NOT answer, just rewrite or return the question as-is.
 """
         }]
 
-        rewritten = self.fallback_reflection.llm.chat(prompt)
-        print(f"[DEBUG] Rewritten query: {rewritten[:300]}")  # show first 300 chars
+    def __rewrite_query(self, chatHistory, query, deadline=None):
+        """Tạo câu hỏi standalone dựa trên chat history dài hạn."""
+        rewritten = self._llm_chat(self._rewrite_prompt(chatHistory, query), deadline)
         self.last_rewritten_query = rewritten
         return rewritten
 
-    def invoke(self, query: str, session_id: str = ""):
-        print(f"[DEBUG] Incoming query: {query}")
+    def invoke(self, query: str, session_id: str = "", prefetched: tuple = None):
+        """
+        Trả về {"output": câu trả lời, "stats": thống kê rewrite của request}.
+        stats["timings"]: thời gian (ms) từng stage: gate, history, rewrite, embed, cache, retrieve, llm / fallback, record.
+        Trong metrics.request_scope, timings là timings của request (kèm request id) và được ghi vào histogram.
+        prefetched: (embedding, kết quả retrieval) của query gốc đã tính sẵn (invoke_batch), dùng như speculative retrieval.
+        Admission control loại call LLM / hết deadline -> {"output": câu trả lời rút gọn, "stats", "degraded": True}.
+        """
+        deadline = self._new_deadline()
+        plan = self._prepare(query, session_id, prefetched, deadline)
+        if "output" in plan:
+            return plan
+        timings = plan["stats"]["timings"]
+        started = time.perf_counter()
+        if plan.get("fallback"):
+            try:
+                with self._llm_slot(deadline):
+                    output = self._fallback(query, session_id, deadline)
+            except DEGRADE_ERRORS as e:
+                return self._degraded(query, session_id, plan, e)
+            finally:
+                _lap(timings, "fallback", started)
+            return {"output": output, "stats": plan["stats"]}
+
+        # 9. Gọi LLM
+        try:
+            response = self._llm_chat(plan["messages"], deadline)
+        except DEGRADE_ERRORS as e:
+            _lap(timings, "llm", started)
+            return self._degraded(query, session_id, plan, e)
+        started = _lap(timings, "llm", started)
+
+        self._record_answer(query, session_id, response, plan)
+        _lap(timings, "record", started)
+        return {"output": response, "stats": plan["stats"]}
+
+    def invoke_stream(self, query: str, session_id: str = ""):
+        """
+        Giống invoke nhưng yield từng đoạn text ngay khi LLM trả về.
+        History chỉ được lưu khi stream hoàn tất; nếu client ngắt kết nối giữa chừng
+        (generator bị close) thì upstream stream được đóng và turn dở dang không được lưu.
+        Slot admission được giữ tới khi stream kết thúc; bị loại / timeout trước token đầu tiên -> câu trả lời degraded,
+        hết deadline giữa chừng -> stream dừng ở phần đã gửi (cũng đánh dấu degraded).
+        """
+        deadline = self._new_deadline()
+        plan = self._prepare(query, session_id, deadline=deadline)
+        if "output" in plan:
+            yield plan["output"]
+            return
+        with contextlib.ExitStack() as admitted:
+            try:
+                admitted.enter_context(self._llm_slot(deadline))
+            except DEGRADE_ERRORS as e:
+                yield self._degraded(query, session_id, plan, e)["output"]
+                return
+
+            if plan.get("fallback"):
+                if self.fallback_reflection:
+                    yield from self._fallback_stream(query, session_id, plan, deadline)
+                else:
+                    yield "Không tìm thấy dữ liệu"
+                return
+
+            # 9. Stream LLM
+            timings = plan["stats"]["timings"]
+            started = time.perf_counter()
+            chunks = []
+            stream = self.llm.chat_stream(plan["messages"], deadline=deadline)
+            try:
+                for delta in stream:
+                    chunks.append(delta)
+                    yield delta
+            except DEGRADE_ERRORS as e:
+                if chunks:
+                    self._truncated(query, session_id, "".join(chunks), e)
+                    return
+                yield self._degraded(query, session_id, plan, e)["output"]
+                return
+            finally:
+                stream.close()
+            started = _lap(timings, "llm", started)
+
+        self._record_answer(query, session_id, "".join(chunks), plan)
+        _lap(timings, "record", started)
+
+    def invoke_batch(self, items: list, max_concurrency: int = 8) -> list:
+        """
+        Trả lời nhiều câu hỏi [{"query", "session_id"}], kết quả theo thứ tự input.
+        - Embed mọi query sản phẩm trong 1 lần gọi và retrieval bằng 1 lần hybrid_search_batch.
+        - Trả lời LLM song song tối đa max_concurrency session; các item cùng session chạy tuần tự theo thứ tự.
+        - Item lỗi nhận {"error": ...}, không làm hỏng cả batch.
+        """
+        queries = [item.get("query", "") for item in items]
+        prefetched = self._prefetch(queries)
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(item.get("session_id", ""), []).append(i)
+
+        outputs = [None] * len(items)
+        batch_id = current_request_id() or new_request_id()
+        rag = self.rag   # thread của pool không mang contextvar của request -> truyền catalog tường minh
+
+        def run_group(indices):
+            for i in indices:
+                with request_scope("chatbot_batch_item", f"{batch_id}-{i}"), catalog_scope(rag):
+                    try:
+                        outputs[i] = self.invoke(queries[i], items[i].get("session_id", ""), prefetched[i])
+                    except Exception as e:
+                        logger.exception("Batch item %d failed", i)
+                        set_outcome("error")
+                        outputs[i] = {"error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(groups)))) as pool:
+            list(pool.map(run_group, groups.values()))
+        return outputs
+
+    def _batch_positions(self, queries: list) -> list:
+        """Vị trí các query qua được keyword gate (chỉ những query này cần embedding / retrieval)."""
+        return [i for i, q in enumerate(queries) if q and self.is_product_query(q)]
+
+    def _prefetch(self, queries: list) -> list:
+        """(embedding, results, 0.0) cho từng query sản phẩm, None nếu không cần / bị lỗi (item tự retrieval lại)."""
+        prefetched = [None] * len(queries)
+        positions = self._batch_positions(queries)
+        if not positions:
+            return prefetched
+        timings = request_timings()
+        started = time.perf_counter()
+        embeddings = self.embedder.embed_batch([queries[i] for i in positions], return_exceptions=True)
+        started = _lap(timings, "embed", started)
+        ok = [(i, emb) for i, emb in zip(positions, embeddings) if not isinstance(emb, Exception)]
+        try:
+            results = self.rag.hybrid_search_batch([emb for _, emb in ok], 5, [queries[i] for i, _ in ok])
+        except Exception:
+            logger.exception("Batch retrieval failed")
+            return prefetched
+        _lap(timings, "retrieve", started)
+        for (i, emb), item_results in zip(ok, results):
+            prefetched[i] = (emb, item_results, 0.0)
+        return prefetched
+
+    def _prepare(self, query: str, session_id: str, prefetched: tuple = None, deadline=None):
+        """
+        Các bước trước khi gọi LLM trả lời. Trả về 1 trong 3 dạng:
+        - {"output": ...}: đã có câu trả lời (semantic cache hit, hoặc degraded khi embed hết deadline), history đã được lưu.
+        - {"fallback": True}: chuyển sang Reflection.
+        - {"messages", "rewritten_query", "query_embedding", "results"}: sẵn sàng gọi LLM.
+        """
+        stats = {"rewrite": "skipped", "speculative": None, "saved_ms": 0.0, "timings": request_timings()}
+        timings = stats["timings"]
 
         # 1. Nếu query không liên quan sản phẩm
-        if not self.is_product_query(query):
-            print("[DEBUG] Query không liên quan sản phẩm.")
-            if self.fallback_reflection:
-                output = self.fallback_reflection.chat(
-                    session_id=session_id,
-                    enhanced_message=query,
-                    original_message=query,
-                    cache_response=False
-                )
-                print(f"[DEBUG] Fallback Reflection output: {output[:200]}...")
-                return {"output": output}
-            return {"output": "Không tìm thấy dữ liệu"}
-
-        # 2. Lấy toàn bộ chatHistory
-        chatHistory = self.fallback_reflection.__construct_session_messages__(session_id) if self.fallback_reflection else []
-
-        # 3. Rewrite query thành standalone
-        rewritten_query = self.__rewrite_query(chatHistory, query)
-
-        # 4. Tạo embedding cho rewritten query
-        query_embedding = self.embedding_client.embeddings.create(
-            model=self.embed_model,
-            input=rewritten_query
-        ).data[0].embedding
-
-        # 5. Lấy document từ RAG
-        results = self.rag.hybrid_search(query_embedding, limit=5)
-        print(f"[DEBUG] Retrieved {len(results)} documents from RAG")
-        for r in results:
-            print(f"  _id={r['_id']}, title={r['title']}, distance={r['distance']:.4f}")
+        started = time.perf_counter()
+        is_product = self.is_product_query(query)
+        started = _lap(timings, "gate", started)
+        if not is_product:
+            return self._fallback_plan(stats, "not_product")
+
+        # 2. Lấy max_last_items message cuối của chatHistory
+        chatHistory = self._load_history(session_id)
+        started = _lap(timings, "history", started)
+
+        # 3-4. Rewrite query thành standalone (nếu cần) + embedding
+        try:
+            results = None
+            if self._needs_rewrite(chatHistory, query):
+                # Retrieval bằng query gốc chạy song song với rewrite (giữ request id trong thread pool)
+                if prefetched is not None:
+                    speculative = Future()
+                    speculative.set_result(prefetched)
+                else:
+                    speculative = self._speculative_pool.submit(contextvars.copy_context().run, self._retrieve, query, deadline)
+                try:
+                    rewritten_query = self.__rewrite_query(chatHistory, query, deadline)
+                    stats["rewrite"] = "llm"
+                except DEGRADE_ERRORS as e:
+                    # Không kịp rewrite: dùng câu hỏi gốc (kết quả speculative retrieval)
+                    logger.warning("Bỏ rewrite (%s): %s", getattr(e, "reason", "timeout"), e)
+                    rewritten_query = query
+                    stats["rewrite"] = "shed"
+                rewrite_ms = (time.perf_counter() - started) * 1000
+                started = _lap(timings, "rewrite", started)
+                if self._same_question(rewritten_query, query):
+                    query_embedding, results, speculative_ms = speculative.result()
+                    stats["speculative"] = "hit"
+                    stats["saved_ms"] = round(speculative_ms, 1)
+                else:
+                    speculative.cancel()
+                    stats["speculative"] = "miss"
+                    query_embedding = self.embedder.embed(rewritten_query, deadline=deadline)
+                self._record_rewrite(stats, rewrite_ms if stats["rewrite"] == "llm" else None)
+            else:
+                rewritten_query = query
+                self.last_rewritten_query = query
+                if prefetched is not None:
+                    query_embedding, results, _ = prefetched
+                else:
+                    query_embedding = self.embedder.embed(query, deadline=deadline)
+                self._record_rewrite(stats)
+        except DEGRADE_ERRORS as e:
+            # Embed không kịp deadline: không có embedding để retrieval -> trả lời degraded luôn
+            _lap(timings, "embed", started)
+            return self._degraded(query, session_id, {"stats": stats}, e)
+        started = _lap(timings, "embed", started)
+        annotate(rewrite=stats["rewrite"], speculative=stats["speculative"])
+
+        # 4b. Semantic cache -> bỏ qua retrieval + LLM
+        cached = self._lookup_cache(query, session_id, query_embedding)
+        started = _lap(timings, "cache", started)
+        if cached is not None:
+            set_outcome("cache")
+            return {"output": cached, "stats": stats}
+
+        # 5. Lấy document từ RAG (nếu speculative retrieval chưa có kết quả)
+        if results is None:
+            results = self.rag.hybrid_search(query_embedding, limit=5, query_text=rewritten_query)
+        started = _lap(timings, "retrieve", started)
 
         # 6. Filter theo similarity threshold
+        filtered_results = self._filter_results(results)
+        if not filtered_results:
+            return self._fallback_plan(stats, "no_documents")
+
+        # 7-8. Ghép prompt từ các document + message list cho LLM
+        messages = self._answer_messages(chatHistory, filtered_results, query)
+        return {"messages": messages, "rewritten_query": rewritten_query, "query_embedding": query_embedding,
+                "results": filtered_results, "stats": stats}
+
+    @staticmethod
+    def _fallback_plan(stats: dict, reason: str) -> dict:
+        FALLBACKS.inc(reason=reason)
+        set_outcome("fallback", fallback_reason=reason)
+        return {"fallback": True, "stats": stats}
+
+    def _load_history(self, session_id: str):
+        if not self.fallback_reflection:
+            return []
+        return self.fallback_reflection.context_builder.messages(session_id, self.max_last_items)
+
+    def _lookup_cache(self, query: str, session_id: str, query_embedding):
+        """Semantic cache: câu hỏi tương tự đã được trả lời -> lưu history và trả về câu trả lời cũ."""
+        if not self.fallback_reflection:
+            return None
+        cached = self.fallback_reflection.__lookup_cached_response__(query_embedding)
+        if cached is not None:
+            self.fallback_reflection.__record_turn__(session_id, query, query, cached)
+        return cached
+
+    def _filter_results(self, results):
         filtered_results = [r for r in results if r['distance'] >= self.similarity_threshold]
-        print(f"[DEBUG] Filtered {len(filtered_results)} docs with similarity >= {self.similarity_threshold}")
-        for r in filtered_results:
-            print(f"  _id={r['_id']}, title={r['title']}, distance={r['distance']:.4f}")
+        annotate(retrieved=len(results), relevant=len(filtered_results))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Retrieved %d documents, %d with similarity >= %s: %s", len(results), len(filtered_results),
+                         self.similarity_threshold, [(r['_id'], round(r['distance'], 4)) for r in results])
+        return filtered_results
 
-        if not filtered_results:
-            print("[DEBUG] Không có document đủ similarity, fallback Reflection.")
-            if self.fallback_reflection:
-                output = self.fallback_reflection.chat(
-                    session_id=session_id,
-                    enhanced_message=query,
-                    original_message=query,
-                    cache_response=False
-                )
-                print(f"[DEBUG] Fallback Reflection output: {output[:200]}...")
-                return {"output": output}
-            return {"output": "Không tìm thấy dữ liệu"}
-
-        # 7. Ghép prompt từ các document
-        prompt_docs = "\n".join([
-            f"Title: {r['title']}, Content: {r['description']}, Price: {r['price']}, Brand: {r['brand']}"
-            for r in filtered_results
-        ])
-
-        # 8. Tạo message list cho LLM (multi-turn)
+    def _answer_messages(self, chatHistory, filtered_results, query):
+        prompt_docs = "\n".join(r.snippet for r in filtered_results)
+
+        # Message list cho LLM (multi-turn)
         messages = [{"role": "system", "content": "Bạn là chatbot cửa hàng bán điện thoại/laptop, thân thiện."}]
-        messages += chatHistory[-self.max_last_items:]  # giữ multi-turn context
+        messages += chatHistory  # multi-turn context: summary + các turn gần nhất trong token budget
         messages.append({"role": "system", "content": f"Thông tin sản phẩm liên quan:\n{prompt_docs}"})
         messages.append({"role": "user", "content": query})
+        return messages
 
-        # 9. Gọi LLM
-        llm = OpenAiClient(
-            api_key=os.getenv("OPENAI_API_KEY"),
-            base_url=os.getenv("OPENAI_ENDPOINT")
+    def _fallback(self, query: str, session_id: str, deadline=None):
+        if not self.fallback_reflection:
+            return "Không tìm thấy dữ liệu"
+        return self.fallback_reflection.chat(
+            session_id=session_id,
+            enhanced_message=query,
+            original_message=query,
+            cache_response=False,
+            deadline=deadline
         )
-        response = llm.chat(messages)
-        print(f"[DEBUG] LLM output (first 300 chars): {response[:300]}")
 
-        # 10. Lưu history
+    def _fallback_stream(self, query: str, session_id: str, plan: dict, deadline=None):
+        """Reflection.chat_stream trong deadline: hết hạn trước token đầu -> degraded, giữa chừng -> dừng ở phần đã gửi."""
+        chunks = []
+        stream = self.fallback_reflection.chat_stream(
+            session_id=session_id,
+            enhanced_message=query,
+            original_message=query,
+            deadline=deadline
+        )
+        try:
+            for delta in stream:
+                chunks.append(delta)
+                yield delta
+        except DEGRADE_ERRORS as e:
+            if chunks:
+                self._truncated(query, session_id, "".join(chunks), e)
+                return
+            yield self._degraded(query, session_id, plan, e)["output"]
+        finally:
+            stream.close()
+
+    def _record_answer(self, query: str, session_id: str, response: str, plan: dict):
+        # 10. Lưu history + semantic cache (key = rewritten query)
         if self.fallback_reflection:
-            self.fallback_reflection.__record_human_prompt__(session_id, query, query)
-            self.fallback_reflection.__record_ai_response__(session_id, response)
+            self.fallback_reflection.__record_turn__(session_id, query, query, response)
+            self.fallback_reflection.__cache_ai_response__(plan["rewritten_query"], query, response, plan["query_embedding"])
+
+
+class AsyncGuardedRAGAgent(GuardedRAGAgent):
+    """
+    Bản asyncio của GuardedRAGAgent cho đường ASGI, cùng input/output.
+    - LLM gọi qua AsyncOpenAiClient, embedding qua EmbeddingService.aembed.
+    - Chroma / SQLite là API sync nên chạy trong thread pool (asyncio.to_thread).
+    - Stage độc lập chạy chồng nhau: embed + retrieval bằng query gốc chạy song song với đọc history
+      và rewrite; nếu rewrite bị bỏ qua hoặc trả về y nguyên câu hỏi thì dùng luôn kết quả đó.
+    - async_admission: AsyncAdmissionController cho các call LLM async (admission vẫn dùng cho đường sync).
+    """
+    def __init__(self, *args, async_llm=None, async_admission=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.async_llm = async_llm
+        self.async_admission = async_admission
+
+    def _allm_slot(self, deadline):
+        return self.async_admission.slot(deadline) if self.async_admission is not None else contextlib.nullcontext()
+
+    async def _allm_chat(self, messages, deadline=None):
+        async with self._allm_slot(deadline):
+            return await self.async_llm.chat(messages, deadline=deadline)
+
+    async def _adegraded(self, query: str, session_id: str, plan: dict, error: Exception) -> dict:
+        return await asyncio.to_thread(self._degraded, query, session_id, plan, error)
+
+    async def ainvoke(self, query: str, session_id: str = "", prefetched: tuple = None):
+        deadline = self._new_deadline()
+        plan = await self._aprepare(query, session_id, prefetched, deadline)
+        if "output" in plan:
+            return plan
+        timings = plan["stats"]["timings"]
+        started = time.perf_counter()
+        if plan.get("fallback"):
+            try:
+                async with self._allm_slot(deadline):
+                    output = await self._afallback(query, session_id, deadline)
+            except DEGRADE_ERRORS as e:
+                return await self._adegraded(query, session_id, plan, e)
+            finally:
+                _lap(timings, "fallback", started)
+            return {"output": output, "stats": plan["stats"]}
+
+        try:
+            response = await self._allm_chat(plan["messages"], deadline)
+        except DEGRADE_ERRORS as e:
+            _lap(timings, "llm", started)
+            return await self._adegraded(query, session_id, plan, e)
+        started = _lap(timings, "llm", started)
+        await asyncio.to_thread(self._record_answer, query, session_id, response, plan)
+        _lap(timings, "record", started)
+        return {"output": response, "stats": plan["stats"]}
 
-        return {"output": response}
+    async def ainvoke_batch(self, items: list, max_concurrency: int = 8) -> list:
+        """Bản async của invoke_batch: cùng input / output, song song bằng asyncio.Semaphore."""
+        queries = [item.get("query", "") for item in items]
+        prefetched = await self._aprefetch(queries)
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(item.get("session_id", ""), []).append(i)
+
+        outputs = [None] * len(items)
+        batch_id = current_request_id() or new_request_id()
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def run_group(indices):
+            async with semaphore:
+                for i in indices:
+                    with request_scope("chatbot_batch_item", f"{batch_id}-{i}"):
+                        try:
+                            outputs[i] = await self.ainvoke(queries[i], items[i].get("session_id", ""), prefetched[i])
+                        except Exception as e:
+                            logger.exception("Batch item %d failed", i)
+                            set_outcome("error")
+                            outputs[i] = {"error": str(e)}
+
+        await asyncio.gather(*(run_group(indices) for indices in groups.values()))
+        return outputs
+
+    async def _aprefetch(self, queries: list) -> list:
+        prefetched = [None] * len(queries)
+        positions = await asyncio.to_thread(self._batch_positions, queries)
+        if not positions:
+            return prefetched
+        timings = request_timings()
+        started = time.perf_counter()
+        embeddings = await self.embedder.aembed_batch([queries[i] for i in positions], return_exceptions=True)
+        started = _lap(timings, "embed", started)
+        ok = [(i, emb) for i, emb in zip(positions, embeddings) if not isinstance(emb, Exception)]
+        try:
+            results = await asyncio.to_thread(self.rag.hybrid_search_batch, [emb for _, emb in ok], 5, [queries[i] for i, _ in ok])
+        except Exception:
+            logger.exception("Batch retrieval failed")
+            return prefetched
+        _lap(timings, "retrieve", started)
+        for (i, emb), item_results in zip(ok, results):
+            prefetched[i] = (emb, item_results, 0.0)
+        return prefetched
+
+    async def ainvoke_stream(self, query: str, session_id: str = ""):
+        """Async generator tương tự invoke_stream; client ngắt kết nối -> đóng upstream, không lưu turn dở."""
+        deadline = self._new_deadline()
+        plan = await self._aprepare(query, session_id, deadline=deadline)
+        if "output" in plan:
+            yield plan["output"]
+            return
+        async with contextlib.AsyncExitStack() as admitted:
+            try:
+                await admitted.enter_async_context(self._allm_slot(deadline))
+            except DEGRADE_ERRORS as e:
+                yield (await self._adegraded(query, session_id, plan, e))["output"]
+                return
+
+            if plan.get("fallback"):
+                if self.fallback_reflection:
+                    stream = self._afallback_stream(query, session_id, plan, deadline)
+                else:
+                    yield "Không tìm thấy dữ liệu"
+                    return
+            else:
+                stream = self._astream_answer(query, session_id, plan, deadline)
+
+            try:
+                async for delta in stream:
+                    yield delta
+            finally:
+                await stream.aclose()
+
+    async def _astream_answer(self, query: str, session_id: str, plan: dict, deadline=None):
+        timings = plan["stats"]["timings"]
+        started = time.perf_counter()
+        chunks = []
+        stream = self.async_llm.chat_stream(plan["messages"], deadline=deadline)
+        try:
+            async for delta in stream:
+                chunks.append(delta)
+                yield delta
+        except DEGRADE_ERRORS as e:
+            if chunks:
+                await asyncio.to_thread(self._truncated, query, session_id, "".join(chunks), e)
+                return
+            yield (await self._adegraded(query, session_id, plan, e))["output"]
+            return
+        finally:
+            await stream.aclose()
+        started = _lap(timings, "llm", started)
+        await asyncio.to_thread(self._record_answer, query, session_id, "".join(chunks), plan)
+        _lap(timings, "record", started)
+
+    async def _aprepare(self, query: str, session_id: str, prefetched: tuple = None, deadline=None):
+        stats = {"rewrite": "skipped", "speculative": None, "saved_ms": 0.0, "timings": request_timings()}
+        timings = stats["timings"]
+
+        # 1. Keyword gate: sub-ms khi matcher đã load, nhưng lần đầu / sau khi catalog đổi version phải đọc file
+        #    (có thể build lại) -> chạy trong thread pool như các stage Chroma / SQLite
+        started = time.perf_counter()
+        is_product = await asyncio.to_thread(self.is_product_query, query)
+        started = _lap(timings, "gate", started)
+        if not is_product:
+            return self._fallback_plan(stats, "not_product")
+
+        # 2 + 5'. Đọc history song song với embed + retrieval bằng query gốc (speculative)
+        if prefetched is not None:
+            raw_task = asyncio.get_running_loop().create_future()
+            raw_task.set_result(prefetched)
+        else:
+            raw_task = asyncio.create_task(self._aretrieve(query, deadline))
+        try:
+            chatHistory = await asyncio.to_thread(self._load_history, session_id)
+            started = _lap(timings, "history", started)
+
+            # 3-4. Rewrite nếu cần; dùng lại kết quả của query gốc khi rewrite không đổi câu hỏi
+            results = None
+            if await asyncio.to_thread(self._needs_rewrite, chatHistory, query):
+                try:
+                    rewritten_query = await self._allm_chat(self._rewrite_prompt(chatHistory, query), deadline)
+                    stats["rewrite"] = "llm"
+                except DEGRADE_ERRORS as e:
+                    logger.warning("Bỏ rewrite (%s): %s", getattr(e, "reason", "timeout"), e)
+                    rewritten_query = query
+                    stats["rewrite"] = "shed"
+                rewrite_ms = (time.perf_counter() - started) * 1000
+                started = _lap(timings, "rewrite", started)
+                if self._same_question(rewritten_query, query):
+                    query_embedding, results, speculative_ms = await raw_task
+                    stats["speculative"] = "hit"
+                    stats["saved_ms"] = round(speculative_ms, 1)
+                else:
+                    raw_task.cancel()
+                    stats["speculative"] = "miss"
+                    query_embedding = await self.embedder.aembed(rewritten_query, deadline=deadline)
+                self._record_rewrite(stats, rewrite_ms if stats["rewrite"] == "llm" else None)
+            else:
+                rewritten_query = query
+                query_embedding, results, _ = await raw_task
+                self._record_rewrite(stats)
+            # Khi dùng kết quả speculative, "embed" gồm cả phần retrieval còn lại chưa chạy xong
+            started = _lap(timings, "embed", started)
+        except DEGRADE_ERRORS as e:
+            # Embed không kịp deadline -> trả lời degraded luôn (như _prepare)
+            raw_task.cancel()
+            _lap(timings, "embed", started)
+            return await self._adegraded(query, session_id, {"stats": stats}, e)
+        except BaseException:
+            raw_task.cancel()
+            raise
+        self.last_rewritten_query = rewritten_query
+        annotate(rewrite=stats["rewrite"], speculative=stats["speculative"])
+
+        cached = await asyncio.to_thread(self._lookup_cache, query, session_id, query_embedding)
+        started = _lap(timings, "cache", started)
+        if cached is not None:
+            set_outcome("cache")
+            return {"output": cached, "stats": stats}
+
+        # 5-8. Retrieval + prompt
+        if results is None:
+            results = await asyncio.to_thread(self.rag.hybrid_search, query_embedding, 5, rewritten_query)
+        started = _lap(timings, "retrieve", started)
+        filtered_results = self._filter_results(results)
+        if not filtered_results:
+            return self._fallback_plan(stats, "no_documents")
+
+        messages = self._answer_messages(chatHistory, filtered_results, query)
+        return {"messages": messages, "rewritten_query": rewritten_query, "query_embedding": query_embedding,
+                "results": filtered_results, "stats": stats}
+
+    async def _aretrieve(self, text: str, deadline=None):
+        started = time.perf_counter()
+        query_embedding = await self.embedder.aembed(text, deadline=deadline)
+        results = await asyncio.to_thread(self.rag.hybrid_search, query_embedding, 5, text)
+        return query_embedding, results, (time.perf_counter() - started) * 1000
+
+    async def _afallback(self, query: str, session_id: str, deadline=None):
+        if not self.fallback_reflection:
+            return "Không tìm thấy dữ liệu"
+        return await self.fallback_reflection.achat(
+            session_id=session_id,
+            enhanced_message=query,
+            original_message=query,
+            deadline=deadline
+        )
+
+    async def _afallback_stream(self, query: str, session_id: str, plan: dict, deadline=None):
+        chunks = []
+        stream = self.fallback_reflection.achat_stream(
+            session_id=session_id,
+            enhanced_message=query,
+            original_message=query,
+            deadline=deadline
+        )
+        try:
+            async for delta in stream:
+                chunks.append(delta)
+                yield delta
+        except DEGRADE_ERRORS as e:
+            if chunks:
+                await asyncio.to_thread(self._truncated, query, session_id, "".join(chunks), e)
+                return
+            yield (await self._adegraded(query, session_id, plan, e))["output"]
+        finally:
+            await stream.aclose()
@@ -1,22 +1,41 @@
 import os
-from flask import Flask, request, jsonify
+import json
+import time
+import logging
+from flask import Flask, request, jsonify, Response, stream_with_context
 from flask_cors import CORS
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
-from rag import RAG
-from reflection import Reflection
+from rag import RAG, CatalogRegistry, read_catalog_version, current_catalog, catalog_scope
+from reflection import Reflection, SemanticCache, ContextBuilder
+from history import SQLiteHistoryStore, SQLiteSummaryStore, WriteBehindHistoryStore, HistoryRetention, ArchiveFallbackHistoryStore
+from embeddings import EmbeddingModel, EmbeddingService
 from agent_router import GuardedRAGAgent
-from openai_client import OpenAiClient
+from openai_client import OpenAiClient, AsyncOpenAiClient
+from admission import AdmissionController, AsyncAdmissionController
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, configure_logging, request_scope, new_request_id, set_outcome, lap
 
 # ===== Load env =====
 load_dotenv()
 
+# ===== Logging (LOG_LEVEL, mặc định INFO; DEBUG để xem chi tiết retrieval) =====
+configure_logging()
+logger = logging.getLogger("chatbot.api")
+
 # ===== Kiểm tra env =====
 DB_PATH = "VECTOR_STORE"
 COLLECTION_NAME = os.getenv("COLLECTION_NAME") or "products"
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND") or "chroma"  # "chroma" | "numpy"
+# Các catalog (collection trong DB_PATH) được phục vụ, request chọn bằng "catalog_id"; mặc định chỉ COLLECTION_NAME
+CATALOGS = [c.strip() for c in (os.getenv("CATALOGS") or COLLECTION_NAME).split(",") if c.strip()]
+CATALOG_MEMORY_BUDGET_MB = float(os.getenv("CATALOG_MEMORY_BUDGET_MB", "1024"))  # tổng index đang load, vượt -> evict LRU
+CATALOG_BACKEND = os.getenv("CATALOG_BACKEND") or "numpy"  # backend của catalog load lazy (numpy: evict giải phóng hết)
 DB_CHAT_HISTORY_COLLECTION = os.getenv("DB_CHAT_HISTORY_COLLECTION") or "chat_history"
 SEMANTIC_CACHE_COLLECTION = os.getenv("SEMANTIC_CACHE_COLLECTION") or "semantic_cache"
 EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH") or os.path.join(DB_PATH, "chat_history.sqlite3")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")  # openai / local / hashing
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH") or os.path.join(DB_PATH, "embedding_cache.sqlite3")
 
 for var_name, var_value in [
     ("COLLECTION_NAME", COLLECTION_NAME),
@@ -27,7 +46,29 @@ for var_name, var_value in [
         raise ValueError(f"{var_name} chưa được định nghĩa trong .env")
 
 MAX_HISTORY_ITEMS = 100
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))  # token budget cho history trong mỗi prompt
 SIMILARITY_THRESHOLD = 0.75
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", str(24 * 3600)))
+SEMANTIC_CACHE_MAX_SIZE = int(os.getenv("SEMANTIC_CACHE_MAX_SIZE", "5000"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+HISTORY_WRITE_BEHIND = os.getenv("HISTORY_WRITE_BEHIND", "1") != "0"         # ghi history nền, gom nhiều turn / transaction
+HISTORY_FLUSH_INTERVAL_MS = float(os.getenv("HISTORY_FLUSH_INTERVAL_MS", "50"))
+HISTORY_FLUSH_BATCH = int(os.getenv("HISTORY_FLUSH_BATCH", "256"))
+HISTORY_MAX_TURNS = int(os.getenv("HISTORY_MAX_TURNS", "500"))                    # turn giữ lại mỗi session, phần cũ hơn -> archive
+HISTORY_SESSION_TTL_DAYS = float(os.getenv("HISTORY_SESSION_TTL_DAYS", "30"))     # session không hoạt động quá hạn -> archive
+HISTORY_RETENTION_INTERVAL_S = float(os.getenv("HISTORY_RETENTION_INTERVAL_S", "3600"))  # 0: tắt job nền (chạy python -m history.retention)
+HISTORY_ARCHIVE_DIR = os.getenv("HISTORY_ARCHIVE_DIR") or os.path.join(DB_PATH, "chat_history_archive")
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "1") != "0"                   # giới hạn call LLM + deadline, quá tải -> degraded
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", str(LLM_MAX_CONCURRENCY)))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))                 # số request chờ slot LLM tối đa mỗi worker
+ADMISSION_EXPECTED_LLM_MS = float(os.getenv("ADMISSION_EXPECTED_LLM_MS", "2000"))  # ước lượng ban đầu latency 1 call LLM
+REQUEST_DEADLINE_MS = float(os.getenv("REQUEST_DEADLINE_MS", "15000"))           # deadline mỗi request chatbot
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "1000"))      # số item tối đa mỗi request batch
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))     # số câu trả lời LLM chạy song song trong 1 batch
 
 # ===== Flask app =====
 app = Flask(__name__)
@@ -38,21 +79,114 @@ embedding_client = OpenAI(
     api_key=os.getenv("OPENAI_API_KEY_EMBEDDED"),
     base_url=os.getenv("OPENAI_ENDPOINT")
 )
+async_embedding_client = AsyncOpenAI(
+    api_key=os.getenv("OPENAI_API_KEY_EMBEDDED"),
+    base_url=os.getenv("OPENAI_ENDPOINT")
+)
+# Backend embedding phải giống lúc ingest (data_store.py dùng cùng env EMBEDDING_BACKEND)
+embedding_engine = EmbeddingModel(
+    model=EMBED_MODEL if EMBEDDING_BACKEND == "openai" else None,
+    backend=EMBEDDING_BACKEND,
+    client=embedding_client,
+    async_client=async_embedding_client
+)
+embedder = EmbeddingService(
+    client=embedding_engine,
+    cache_path=EMBEDDING_CACHE_PATH
+)
 
 # ===== RAG object =====
-rag = RAG(collection_name=COLLECTION_NAME, db_path=DB_PATH)
+rag = RAG(collection_name=COLLECTION_NAME, db_path=DB_PATH, backend=VECTOR_BACKEND)
+# Catalog khác load lazy ở request đầu tiên; catalog mặc định luôn load (pinned)
+catalogs = CatalogRegistry(
+    DB_PATH,
+    backend=CATALOG_BACKEND,
+    max_bytes=int(CATALOG_MEMORY_BUDGET_MB * 1024 * 1024),
+    catalogs=CATALOGS
+)
+catalogs.register(COLLECTION_NAME, rag, pinned=True)
 
-# ===== Reflection fallback =====
+def _catalog_id() -> str:
+    """Catalog của request hiện tại (semantic cache tách theo catalog + version của catalog đó)."""
+    return (current_catalog() or rag).collection_name
+
+# ===== LLM gateway (dùng chung cho agent, Reflection, query rewrite) =====
 llm_client = OpenAiClient(
     api_key=os.getenv("OPENAI_API_KEY"),
-    base_url=os.getenv("OPENAI_ENDPOINT")
+    base_url=os.getenv("OPENAI_ENDPOINT"),
+    max_connections=LLM_MAX_CONNECTIONS,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=LLM_TIMEOUT,
+    max_retries=LLM_MAX_RETRIES
 )
+# Bản async cho asgi.py (connection pool chỉ mở khi được dùng trong event loop)
+async_llm_client = AsyncOpenAiClient(
+    api_key=os.getenv("OPENAI_API_KEY"),
+    base_url=os.getenv("OPENAI_ENDPOINT"),
+    max_connections=LLM_MAX_CONNECTIONS,
+    max_concurrency=LLM_MAX_CONCURRENCY,
+    timeout=LLM_TIMEOUT,
+    max_retries=LLM_MAX_RETRIES
+)
+
+# ===== Chat history (SQLite, write-behind: ghi ngoài đường request) =====
+history_store = SQLiteHistoryStore(HISTORY_DB_PATH)
+# Retention: cap turn / TTL session, phần bị loại chuyển sang segment gzip (chạy nền sau warmup của worker)
+history_retention = HistoryRetention(
+    HISTORY_DB_PATH,
+    archive_dir=HISTORY_ARCHIVE_DIR,
+    max_turns=HISTORY_MAX_TURNS,
+    session_ttl=HISTORY_SESSION_TTL_DAYS * 86400,
+    interval=HISTORY_RETENTION_INTERVAL_S
+)
+# Session đã archive quay lại: history trong prompt đọc tiếp từ archive
+history_store = ArchiveFallbackHistoryStore(history_store, history_retention)
+if HISTORY_WRITE_BEHIND:
+    history_store = WriteBehindHistoryStore(
+        history_store,
+        max_batch=HISTORY_FLUSH_BATCH,
+        flush_interval=HISTORY_FLUSH_INTERVAL_MS / 1000
+    )
+
+# ===== Reflection fallback =====
 reflection = Reflection(
     llm=llm_client,
     db_path=DB_PATH,
     dbChatHistoryCollection=DB_CHAT_HISTORY_COLLECTION,
-    semanticCacheCollection=SEMANTIC_CACHE_COLLECTION
+    semanticCacheCollection=SEMANTIC_CACHE_COLLECTION,
+    history_store=history_store,
+    max_history_items=MAX_HISTORY_ITEMS,
+    async_llm=async_llm_client
+)
+reflection.semantic_cache = SemanticCache(
+    reflection.semantic_cache_collection,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    ttl_seconds=SEMANTIC_CACHE_TTL,
+    max_size=SEMANTIC_CACHE_MAX_SIZE,
+    version_fn=lambda catalog: read_catalog_version(DB_PATH, catalog),
+    catalog_fn=_catalog_id
 )
+# History trong prompt: các turn gần nhất theo token budget + summary cuốn chiếu (lưu cùng file SQLite history)
+reflection.context_builder = ContextBuilder(
+    reflection.history_store,
+    summary_store=SQLiteSummaryStore(HISTORY_DB_PATH),
+    llm=llm_client,
+    max_tokens=CONTEXT_MAX_TOKENS,
+    max_messages=MAX_HISTORY_ITEMS
+)
+
+# ===== Admission control (mỗi worker 1 controller cho đường sync, 1 cho đường asyncio) =====
+admission = AdmissionController(
+    max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    expected_seconds=ADMISSION_EXPECTED_LLM_MS / 1000
+) if ADMISSION_ENABLED else None
+async_admission = AsyncAdmissionController(
+    max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+    max_queue=ADMISSION_MAX_QUEUE,
+    expected_seconds=ADMISSION_EXPECTED_LLM_MS / 1000
+) if ADMISSION_ENABLED else None
+REQUEST_DEADLINE = REQUEST_DEADLINE_MS / 1000 if ADMISSION_ENABLED else None
 
 # ===== Guarded RAG Agent =====
 agent_router = GuardedRAGAgent(
@@ -61,53 +195,222 @@ agent_router = GuardedRAGAgent(
     embed_model=EMBED_MODEL,
     fallback_reflection=reflection,
     similarity_threshold=SIMILARITY_THRESHOLD,
-    max_last_items=MAX_HISTORY_ITEMS
+    max_last_items=MAX_HISTORY_ITEMS,
+    embedder=embedder,
+    llm=llm_client,
+    admission=admission,
+    deadline_seconds=REQUEST_DEADLINE
 )
 
+# ===== Warmup =====
+def warmup(open_stores: bool = True):
+    """
+    Load trước index (vector / BM25 / attribute / entity), model embedding local, tokenizer và collection Chroma
+    để request đầu tiên không chịu chi phí này. Gọi lúc startup: `python app.py`, lifespan của asgi.py, gunicorn.conf.py.
+    open_stores=False: phần an toàn trước fork (master gunicorn --preload); worker gọi lại warmup() để mở store
+    của mình, index / model đã load được dùng chung trang nhớ với master.
+    Lỗi của từng phần chỉ được log: phần đó sẽ load lazy ở request đầu tiên như trước.
+    Job retention history chỉ start khi open_stores (trong worker, không chạy ở master).
+    """
+    started = time.perf_counter()
+    for name, component in (("catalogs", catalogs), ("embedder", embedder), ("reflection", reflection)):
+        try:
+            component.warmup(open_stores=open_stores)
+        except Exception:
+            logger.exception("Warmup %s thất bại", name)
+    if open_stores:
+        history_retention.start()
+    logger.info("Warmup xong trong %.0f ms", (time.perf_counter() - started) * 1000)
+
+# ===== Catalog của request =====
+def _get_catalog(data: dict):
+    """(RAG, None) theo "catalog_id" (mặc định COLLECTION_NAME), (None, response 404) nếu catalog không được phục vụ."""
+    catalog_id = str(data.get("catalog_id") or COLLECTION_NAME)
+    try:
+        return catalogs.get(catalog_id), None
+    except KeyError:
+        return None, (jsonify({"status": "error", "message": f"Không có catalog '{catalog_id}'"}), 404)
+
 # ===== API endpoint: chatbot multi-turn =====
 @app.route("/api/v1/chatbot", methods=["POST"])
 def chatbot():
     data = request.get_json()
     query = data.get("query", "")
     session_id = data.get("session_id", "")
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = _get_catalog(data)
+    if error:
+        return error
 
-    print(f"[API DEBUG] Incoming query: {query}, session_id: {session_id}")
+    # Streaming mode (SSE): {"stream": true}
+    if data.get("stream"):
+        return Response(
+            stream_with_context(_sse_chat(query, session_id, request_id, catalog)),
+            mimetype="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id}
+        )
 
     # Gọi agent invoke (multi-turn + query rewrite + RAG + fallback)
-    result = agent_router.invoke(query=query, session_id=session_id)
+    with request_scope("chatbot", request_id) as ctx, catalog_scope(catalog):
+        result = agent_router.invoke(query=query, session_id=session_id)
+        logger.debug("Chatbot session=%s stats=%s", session_id, result.get("stats"))
+
+    response = jsonify(_chat_item(result))
+    response.headers["Server-Timing"] = _server_timing(ctx.timings)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+def _chat_item(result: dict) -> dict:
+    """Response chatbot; câu trả lời rút gọn do quá tải được đánh dấu "degraded": true."""
+    item = {"role": "assistant", "content": result["output"]}
+    if result.get("degraded"):
+        item["degraded"] = True
+    return item
 
-    # Debug chi tiết
-    print(f"[API DEBUG] Agent output (first 300 chars): {result['output'][:300]}")
-    if hasattr(agent_router, 'last_rewritten_query'):
-        print(f"[API DEBUG] Rewritten standalone query: {agent_router.last_rewritten_query}")
+def _server_timing(timings: dict) -> str:
+    """Header Server-Timing từ timings (ms) theo stage, vd "embed;dur=12.3, llm;dur=850.0"."""
+    return ", ".join(f"{stage};dur={ms}" for stage, ms in (timings or {}).items())
 
-    return jsonify({"role": "assistant", "content": result["output"]})
+def _sse_event(payload: dict, event: str = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+def _sse_chat(query: str, session_id: str, request_id: str = None, catalog: RAG = None):
+    """
+    Mỗi đoạn text là 1 event `data: {"role", "delta"}`; kết thúc bằng `event: done` chứa toàn bộ content.
+    Client ngắt kết nối -> Flask close generator -> agent đóng upstream stream.
+    """
+    chunks = []
+    with request_scope("chatbot_stream", request_id) as ctx, catalog_scope(catalog or rag):
+        try:
+            for delta in agent_router.invoke_stream(query=query, session_id=session_id):
+                chunks.append(delta)
+                yield _sse_event({"role": "assistant", "delta": delta})
+        except Exception as e:
+            logger.exception("Stream error")
+            set_outcome("error")
+            yield _sse_event({"role": "assistant", "error": str(e)}, event="error")
+            return
+    yield _sse_event(_chat_item({"output": "".join(chunks), "degraded": ctx.outcome == "degraded"}), event="done")
 
 # ===== API endpoint: test RAG retrieval =====
 @app.route("/api/v1/rag_test", methods=["POST"])
 def rag_test():
     data = request.get_json()
     query = data.get("query", "")
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = _get_catalog(data)
+    if error:
+        return error
 
-    print(f"[API DEBUG] RAG test query: {query}")
-
-    # Lấy embedding cho query
-    query_embedding = embedding_client.embeddings.create(
-        model=EMBED_MODEL,
-        input=query
-    ).data[0].embedding
+    with request_scope("rag_test", request_id) as ctx:
+        # Lấy embedding cho query
+        started = time.perf_counter()
+        query_embedding = embedder.embed(query)
+        started = lap(ctx.timings, "embed", started)
 
-    # Lấy document từ RAG
-    results = rag.hybrid_search(query_embedding, limit=5)
-    print(f"[DEBUG] Retrieved {len(results)} documents from RAG:")
-    for r in results:
-        print(f"  _id={r['_id']}, title={r['title']}, distance={r['distance']:.4f}")
+        # Lấy document từ RAG
+        results = catalog.hybrid_search(query_embedding, limit=5, query_text=query)
+        lap(ctx.timings, "retrieve", started)
+        set_outcome("answer" if results else "empty", retrieved=len(results))
 
     if not results:
-        return jsonify({"status": "empty", "message": "Không tìm thấy dữ liệu", "results": []})
+        response = jsonify({"status": "empty", "message": "Không tìm thấy dữ liệu", "results": []})
+    else:
+        response = jsonify({"status": "ok", "message": f"Tìm thấy {len(results)} document", "results": [r.to_dict() for r in results]})
+    response.headers["Server-Timing"] = _server_timing(ctx.timings)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+# ===== API endpoint: batch (evaluation offline, widget gợi ý) =====
+def _batch_error(items, key: str):
+    """Message lỗi nếu input batch không hợp lệ, None nếu hợp lệ."""
+    if not isinstance(items, list) or not items:
+        return f"'{key}' phải là list khác rỗng"
+    if len(items) > BATCH_MAX_ITEMS:
+        return f"Tối đa {BATCH_MAX_ITEMS} item mỗi batch"
+    return None
+
+def _rag_batch_items(queries: list, embeddings: list, results: list) -> list:
+    """Kết quả rag_test theo từng query (thứ tự input); query embed lỗi -> status "error"."""
+    items = []
+    found = iter(results)
+    for query, embedding in zip(queries, embeddings):
+        if isinstance(embedding, Exception):
+            items.append({"query": query, "status": "error", "message": str(embedding), "results": []})
+            continue
+        docs = next(found)
+        if docs:
+            items.append({"query": query, "status": "ok", "message": f"Tìm thấy {len(docs)} document", "results": [r.to_dict() for r in docs]})
+        else:
+            items.append({"query": query, "status": "empty", "message": "Không tìm thấy dữ liệu", "results": []})
+    return items
+
+def _chat_batch_items(outputs: list) -> list:
+    return [
+        _chat_item(out) if "output" in out else {"role": "assistant", "error": out["error"]}
+        for out in outputs
+    ]
+
+@app.route("/api/v1/rag_test/batch", methods=["POST"])
+def rag_test_batch():
+    """{"queries": [...]}: 1 lần embed cho mọi query + 1 lần hybrid_search_batch."""
+    data = request.get_json()
+    queries = data.get("queries")
+    error = _batch_error(queries, "queries")
+    if error:
+        return jsonify({"status": "error", "message": error}), 400
+    queries = [str(q or "") for q in queries]
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = _get_catalog(data)
+    if error:
+        return error
+
+    with request_scope("rag_test_batch", request_id) as ctx:
+        started = time.perf_counter()
+        embeddings = embedder.embed_batch(queries, return_exceptions=True)
+        started = lap(ctx.timings, "embed", started)
+        ok = [i for i, emb in enumerate(embeddings) if not isinstance(emb, Exception)]
+        results = catalog.hybrid_search_batch([embeddings[i] for i in ok], 5, [queries[i] for i in ok])
+        lap(ctx.timings, "retrieve", started)
+
+    response = jsonify({"status": "ok", "results": _rag_batch_items(queries, embeddings, results)})
+    response.headers["Server-Timing"] = _server_timing(ctx.timings)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+@app.route("/api/v1/chatbot/batch", methods=["POST"])
+def chatbot_batch():
+    """{"items": [{"query", "session_id"}]}: kết quả theo thứ tự input, item lỗi có "error"."""
+    data = request.get_json()
+    items = data.get("items")
+    error = _batch_error(items, "items")
+    if error or not all(isinstance(item, dict) for item in items):
+        return jsonify({"status": "error", "message": error or "Mỗi item phải là object {query, session_id}"}), 400
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = _get_catalog(data)
+    if error:
+        return error
+
+    with request_scope("chatbot_batch", request_id) as ctx, catalog_scope(catalog):
+        outputs = agent_router.invoke_batch(items, max_concurrency=BATCH_CONCURRENCY)
+
+    response = jsonify({"status": "ok", "results": _chat_batch_items(outputs)})
+    response.headers["Server-Timing"] = _server_timing(ctx.timings)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+# ===== Catalog: thời gian load, dung lượng index, trạng thái load / evict =====
+@app.route("/api/v1/catalogs", methods=["GET"])
+def catalog_stats():
+    return jsonify(catalogs.stats())
 
-    return jsonify({"status": "ok", "message": f"Tìm thấy {len(results)} document", "results": results})
+# ===== Metrics (Prometheus) =====
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(REGISTRY.render(), content_type=METRICS_CONTENT_TYPE)
 
 # ===== Run server =====
 if __name__ == "__main__":
+    warmup()
     app.run(host="0.0.0.0", port=5001, debug=True)
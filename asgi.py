@@ -0,0 +1,186 @@
+import time
+import asyncio
+import contextlib
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse, Response
+from starlette.routing import Route
+from agent_router import AsyncGuardedRAGAgent
+from app import (
+    rag, catalogs, reflection, embedder, history_store, history_retention, embedding_client, llm_client, async_llm_client,
+    admission, async_admission, REQUEST_DEADLINE,
+    EMBED_MODEL, SIMILARITY_THRESHOLD, MAX_HISTORY_ITEMS, BATCH_CONCURRENCY, _sse_event, _server_timing, logger,
+    _batch_error, _rag_batch_items, _chat_batch_items, _chat_item, warmup, COLLECTION_NAME
+)
+from rag import catalog_scope
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE, request_scope, new_request_id, set_outcome, lap
+
+# Chạy: uvicorn asgi:app --host 0.0.0.0 --port 5001
+#   hoặc nhiều worker: gunicorn asgi:app -k uvicorn.workers.UvicornWorker -c gunicorn.conf.py
+# Cùng request/response với app.py (Flask), nhưng pipeline chạy trên asyncio.
+
+agent_router = AsyncGuardedRAGAgent(
+    rag=rag,
+    embedding_client=embedding_client,
+    embed_model=EMBED_MODEL,
+    fallback_reflection=reflection,
+    similarity_threshold=SIMILARITY_THRESHOLD,
+    max_last_items=MAX_HISTORY_ITEMS,
+    embedder=embedder,
+    llm=llm_client,
+    async_llm=async_llm_client,
+    admission=admission,
+    async_admission=async_admission,
+    deadline_seconds=REQUEST_DEADLINE
+)
+
+# ===== Catalog của request =====
+async def _get_catalog(data: dict):
+    """Như app._get_catalog; load index của catalog chưa load chạy trong thread, không chặn event loop."""
+    catalog_id = str(data.get("catalog_id") or COLLECTION_NAME)
+    try:
+        return await asyncio.to_thread(catalogs.get, catalog_id), None
+    except KeyError:
+        return None, JSONResponse({"status": "error", "message": f"Không có catalog '{catalog_id}'"}, status_code=404)
+
+# ===== API endpoint: chatbot multi-turn =====
+async def chatbot(request: Request):
+    data = await request.json()
+    query = data.get("query", "")
+    session_id = data.get("session_id", "")
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = await _get_catalog(data)
+    if error:
+        return error
+
+    if data.get("stream"):
+        return StreamingResponse(
+            _sse_chat(query, session_id, request_id, catalog),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "X-Request-ID": request_id}
+        )
+
+    with request_scope("chatbot", request_id) as ctx, catalog_scope(catalog):
+        result = await agent_router.ainvoke(query=query, session_id=session_id)
+    return JSONResponse(
+        _chat_item(result),
+        headers={"Server-Timing": _server_timing(ctx.timings), "X-Request-ID": request_id}
+    )
+
+async def _sse_chat(query: str, session_id: str, request_id: str = None, catalog=None):
+    # Client ngắt kết nối -> Starlette huỷ generator -> agent đóng upstream stream
+    chunks = []
+    with request_scope("chatbot_stream", request_id) as ctx, catalog_scope(catalog or rag):
+        stream = agent_router.ainvoke_stream(query=query, session_id=session_id)
+        try:
+            async for delta in stream:
+                chunks.append(delta)
+                yield _sse_event({"role": "assistant", "delta": delta})
+        except Exception as e:
+            logger.exception("Stream error")
+            set_outcome("error")
+            yield _sse_event({"role": "assistant", "error": str(e)}, event="error")
+            return
+        finally:
+            await stream.aclose()
+    yield _sse_event(_chat_item({"output": "".join(chunks), "degraded": ctx.outcome == "degraded"}), event="done")
+
+# ===== API endpoint: test RAG retrieval =====
+async def rag_test(request: Request):
+    data = await request.json()
+    query = data.get("query", "")
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = await _get_catalog(data)
+    if error:
+        return error
+
+    with request_scope("rag_test", request_id) as ctx:
+        started = time.perf_counter()
+        query_embedding = await embedder.aembed(query)
+        started = lap(ctx.timings, "embed", started)
+        results = await asyncio.to_thread(catalog.hybrid_search, query_embedding, 5, query)
+        lap(ctx.timings, "retrieve", started)
+        set_outcome("answer" if results else "empty", retrieved=len(results))
+    headers = {"Server-Timing": _server_timing(ctx.timings), "X-Request-ID": request_id}
+
+    if not results:
+        return JSONResponse({"status": "empty", "message": "Không tìm thấy dữ liệu", "results": []}, headers=headers)
+
+    return JSONResponse({"status": "ok", "message": f"Tìm thấy {len(results)} document", "results": [r.to_dict() for r in results]}, headers=headers)
+
+# ===== API endpoint: batch =====
+async def rag_test_batch(request: Request):
+    data = await request.json()
+    queries = data.get("queries")
+    error = _batch_error(queries, "queries")
+    if error:
+        return JSONResponse({"status": "error", "message": error}, status_code=400)
+    queries = [str(q or "") for q in queries]
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = await _get_catalog(data)
+    if error:
+        return error
+
+    with request_scope("rag_test_batch", request_id) as ctx:
+        started = time.perf_counter()
+        embeddings = await embedder.aembed_batch(queries, return_exceptions=True)
+        started = lap(ctx.timings, "embed", started)
+        ok = [i for i, emb in enumerate(embeddings) if not isinstance(emb, Exception)]
+        results = await asyncio.to_thread(catalog.hybrid_search_batch, [embeddings[i] for i in ok], 5, [queries[i] for i in ok])
+        lap(ctx.timings, "retrieve", started)
+
+    return JSONResponse(
+        {"status": "ok", "results": _rag_batch_items(queries, embeddings, results)},
+        headers={"Server-Timing": _server_timing(ctx.timings), "X-Request-ID": request_id}
+    )
+
+async def chatbot_batch(request: Request):
+    data = await request.json()
+    items = data.get("items")
+    error = _batch_error(items, "items")
+    if error or not all(isinstance(item, dict) for item in items):
+        return JSONResponse({"status": "error", "message": error or "Mỗi item phải là object {query, session_id}"}, status_code=400)
+    request_id = request.headers.get("X-Request-ID") or new_request_id()
+    catalog, error = await _get_catalog(data)
+    if error:
+        return error
+
+    with request_scope("chatbot_batch", request_id) as ctx, catalog_scope(catalog):
+        outputs = await agent_router.ainvoke_batch(items, max_concurrency=BATCH_CONCURRENCY)
+    return JSONResponse(
+        {"status": "ok", "results": _chat_batch_items(outputs)},
+        headers={"Server-Timing": _server_timing(ctx.timings), "X-Request-ID": request_id}
+    )
+
+# ===== Catalog: thời gian load, dung lượng index, trạng thái load / evict =====
+async def catalog_stats(request: Request):
+    return JSONResponse(catalogs.stats())
+
+# ===== Metrics (Prometheus) =====
+async def metrics(request: Request):
+    return Response(REGISTRY.render(), media_type=METRICS_CONTENT_TYPE)
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # Load index / model trước khi nhận request (đã warmup ở master gunicorn thì lần này gần như không tốn gì)
+    await asyncio.to_thread(warmup)
+    yield
+    await async_llm_client.close()
+    # Ghi nốt history còn trong hàng đợi write-behind, dừng job retention
+    await asyncio.to_thread(history_store.close)
+    await asyncio.to_thread(history_retention.close)
+
+app = Starlette(
+    routes=[
+        Route("/api/v1/chatbot", chatbot, methods=["POST"]),
+        Route("/api/v1/rag_test", rag_test, methods=["POST"]),
+        Route("/api/v1/chatbot/batch", chatbot_batch, methods=["POST"]),
+        Route("/api/v1/rag_test/batch", rag_test_batch, methods=["POST"]),
+        Route("/api/v1/catalogs", catalog_stats, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])],
+    lifespan=lifespan
+)
@@ -0,0 +1,114 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import numpy as np
+
+# Chạy (trong thư mục có VECTOR_STORE đã ingest, env như khi chạy app):
+#   python -m benchmarks.fake_openai --port 8799 &
+#   OPENAI_ENDPOINT=http://127.0.0.1:8799/v1 OPENAI_API_KEY=x OPENAI_API_KEY_EMBEDDED=x \
+#       python -m benchmarks.bench_startup --repeat 5 [--output startup.json]
+# Đo cold start của 1 worker, mỗi lần chạy trong process Python mới:
+#   cold    : import app -> request đầu tiên (index / collection load lazy trong request)
+#   warmup  : import app -> warmup() -> request đầu tiên
+#   preload : master import app + warmup(open_stores=False) rồi fork (như gunicorn --preload); worker con warmup()
+#             (mở store) rồi nhận request đầu tiên
+# Báo cáo median (ms) của: process (wall, gồm khởi động interpreter), import, warmup, worker_warmup, first_request,
+# ready (thời gian tới khi worker trả lời xong request đầu tiên, tính từ lúc process / fork bắt đầu).
+
+MODES = ("cold", "warmup", "preload")
+
+def _first_request(client, endpoint: str, query: str) -> float:
+    started = time.perf_counter()
+    payload = {"query": query, "session_id": "bench-startup"} if endpoint == "chatbot" else {"query": query}
+    response = client.post(f"/api/v1/{endpoint}", json=payload)
+    if response.status_code >= 400:
+        raise RuntimeError(f"{endpoint} trả về HTTP {response.status_code}")
+    return (time.perf_counter() - started) * 1000
+
+def run_phase(mode: str, endpoint: str, query: str) -> dict:
+    """Chạy trong process con: đo từng giai đoạn của 1 lần khởi động."""
+    started = time.perf_counter()
+    import app
+    result = {"import": (time.perf_counter() - started) * 1000}
+    if mode in ("warmup", "preload"):
+        warmup_started = time.perf_counter()
+        app.warmup(open_stores=mode != "preload")
+        result["warmup"] = (time.perf_counter() - warmup_started) * 1000
+
+    if mode != "preload":
+        result["first_request"] = _first_request(app.app.test_client(), endpoint, query)
+        result["ready"] = (time.perf_counter() - started) * 1000
+        return result
+
+    read_fd, write_fd = os.pipe()
+    forked = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            # Như post_worker_init của gunicorn.conf.py: worker mở store của mình rồi mới nhận request
+            worker_started = time.perf_counter()
+            app.warmup()
+            payload = {"worker_warmup": (time.perf_counter() - worker_started) * 1000}
+            payload["first_request"] = _first_request(app.app.test_client(), endpoint, query)
+        except Exception as e:
+            payload = {"error": str(e)}
+        payload["ready"] = (time.perf_counter() - forked) * 1000
+        os.write(write_fd, json.dumps(payload).encode("utf-8"))
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd, "rb") as f:
+        child = json.loads(f.read() or b"{}")
+    os.waitpid(pid, 0)
+    if "error" in child:
+        raise RuntimeError(child["error"])
+    result.update(child)
+    return result
+
+def run(args) -> dict:
+    report = {}
+    for mode in args.modes:
+        samples = {}
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            out = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_startup", "--phase", mode, "--endpoint", args.endpoint, "--query", args.query],
+                capture_output=True, text=True, check=True, timeout=600
+            )
+            wall = (time.perf_counter() - started) * 1000
+            phase = json.loads(out.stdout.strip().splitlines()[-1])
+            phase["process"] = wall
+            for key, value in phase.items():
+                samples.setdefault(key, []).append(value)
+        report[mode] = {key: round(float(np.median(values)), 1) for key, values in samples.items()}
+    return report
+
+def print_report(report: dict):
+    columns = ("process", "import", "warmup", "worker_warmup", "first_request", "ready")
+    print(f"{'mode':<10}" + "".join(f"{c:>15}" for c in columns))
+    for mode, row in report.items():
+        print(f"{mode:<10}" + "".join(f"{row.get(c, '-'):>15}" for c in columns))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark thời gian khởi động / request đầu tiên của app")
+    parser.add_argument("--repeat", type=int, default=5, help="Số lần chạy mỗi mode (lấy median)")
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--endpoint", choices=("rag_test", "chatbot"), default="rag_test")
+    parser.add_argument("--query", default="iPhone 16 Pro Max giá bao nhiêu?")
+    parser.add_argument("--phase", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--output", help="Ghi báo cáo JSON ra file (để so sánh giữa các commit)")
+    args = parser.parse_args()
+
+    if args.phase:
+        # Process con: log của app ra stderr, kết quả là dòng JSON cuối trên stdout
+        print(json.dumps(run_phase(args.phase, args.endpoint, args.query)))
+        sys.exit(0)
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,93 @@
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import chromadb
+from rag.vector_index import ChromaIndex, NumpyIndex
+
+# Chạy: python -m benchmarks.bench_vector_index [--sizes 1000 100000 1000000] [--dim 1536]
+# So sánh latency query giữa Chroma (HNSW) và NumpyIndex (memory-map + argpartition) trên vector ngẫu nhiên.
+# Lưu ý: 1M x 1536 float32 ~ 6GB trên đĩa; Chroma bị bỏ qua khi size > --max-chroma-size (insert rất chậm).
+
+def random_vectors(rng, count, dim):
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+def percentile_ms(samples, q):
+    return float(np.percentile(samples, q)) * 1000
+
+def time_queries(index, queries, k):
+    samples = []
+    for q in queries:
+        started = time.perf_counter()
+        index.query([q.tolist()], k)
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def bench_size(size, args, rng, workdir):
+    print(f"\n=== {size} vectors, dim={args.dim} ===")
+    ids = [str(i) for i in range(size)]
+    documents = [f"doc {i}" for i in range(size)]
+    metadatas = [{"title": f"product {i}"} for i in range(size)]
+    queries = random_vectors(rng, args.queries, args.dim)
+
+    # Build theo chunk để không giữ 2 bản ma trận trong RAM
+    path = f"{workdir}/bench_{size}"
+    vectors = np.lib.format.open_memmap(f"{workdir}/raw_{size}.npy", mode="w+", dtype=np.float32, shape=(size, args.dim))
+    for start in range(0, size, 65536):
+        end = min(size, start + 65536)
+        vectors[start:end] = random_vectors(rng, end - start, args.dim)
+    started = time.perf_counter()
+    NumpyIndex.build(path, ids, vectors)
+    print(f"numpy build: {time.perf_counter() - started:.2f}s")
+
+    numpy_index = NumpyIndex(path)
+    time_queries(numpy_index, queries[:3], args.k)  # warm page cache
+    samples = time_queries(numpy_index, queries, args.k)
+    print(f"numpy single query : p50={percentile_ms(samples, 50):.2f}ms p95={percentile_ms(samples, 95):.2f}ms")
+    started = time.perf_counter()
+    numpy_index.query(queries.tolist(), args.k)
+    elapsed = time.perf_counter() - started
+    print(f"numpy batched      : {len(queries)} queries in {elapsed * 1000:.1f}ms ({len(queries) / elapsed:.0f} qps)")
+
+    if size > args.max_chroma_size:
+        print("chroma             : skipped (size > --max-chroma-size)")
+        return
+
+    client = chromadb.PersistentClient(path=f"{workdir}/chroma_{size}")
+    collection = client.get_or_create_collection(name=f"bench_{size}")
+    started = time.perf_counter()
+    for start in range(0, size, 5000):
+        end = min(size, start + 5000)
+        collection.add(ids=ids[start:end], embeddings=vectors[start:end].tolist(),
+                       documents=documents[start:end], metadatas=metadatas[start:end])
+    print(f"chroma build: {time.perf_counter() - started:.2f}s")
+
+    chroma_index = ChromaIndex(collection)
+    time_queries(chroma_index, queries[:3], args.k)
+    samples = time_queries(chroma_index, queries, args.k)
+    print(f"chroma single query: p50={percentile_ms(samples, 50):.2f}ms p95={percentile_ms(samples, 95):.2f}ms")
+    started = time.perf_counter()
+    chroma_index.query(queries.tolist(), args.k)
+    elapsed = time.perf_counter() - started
+    print(f"chroma batched     : {len(queries)} queries in {elapsed * 1000:.1f}ms ({len(queries) / elapsed:.0f} qps)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Chroma vs NumpyIndex")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--max-chroma-size", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    workdir = tempfile.mkdtemp(prefix="bench_vector_index_")
+    try:
+        for size in args.sizes:
+            bench_size(size, args, rng, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,97 @@
+import json
+import random
+import argparse
+
+# Chạy: python -m benchmarks.catalog --size 100000 --out /tmp/catalog_100k.json [--seed 42]
+# Sinh catalog giả cùng dạng data.json (category, name, capacity, price, discount, link, ...) để benchmark
+# ingest / retrieval ở quy mô lớn (tới 1M sản phẩm). Cùng seed -> cùng file; name / link không trùng nhau.
+# Ghi JSON kiểu stream nên không giữ cả catalog trong RAM.
+
+PHONE_LINES = {
+    "iPhone": ["16", "16 Plus", "16 Pro", "16 Pro Max", "15", "15 Plus", "14"],
+    "Samsung Galaxy": ["S25", "S25 Ultra", "A56", "A36", "A16", "Z Fold7", "Z Flip7", "M55"],
+    "Xiaomi": ["15T", "15T Pro", "14T", "Redmi Note 14", "Redmi 15C", "POCO X7 Pro"],
+    "OPPO": ["Reno14", "Reno14 F", "Find X8", "A5 Pro", "A3x"],
+    "vivo": ["V50", "V50 Lite", "Y29", "Y19s", "X200 Pro"],
+    "realme": ["14 Pro", "C75", "Note 60", "C61"],
+    "Honor": ["400", "X9c", "X7c", "Magic7 Pro"],
+    "Nubia": ["A76", "Neo 3", "V70"],
+    "TCL": ["60R", "50 SE", "406"],
+    "Tecno": ["Spark 40", "Camon 40", "Pova 7"],
+    "Motorola": ["Edge 60", "Moto G85", "Razr 60"],
+    "Nokia": ["C32", "G42", "105 4G"],
+}
+LAPTOP_LINES = {
+    "MacBook": ["Air M2", "Air M3", "Air M4", "Pro M4", "Pro M4 Pro"],
+    "ASUS": ["Vivobook 15", "Zenbook 14 OLED", "TUF Gaming F15", "ROG Strix G16"],
+    "Dell": ["Inspiron 15", "Vostro 3530", "XPS 13", "Latitude 5440"],
+    "HP": ["Pavilion 15", "Victus 16", "EliteBook 840", "15s"],
+    "Lenovo": ["IdeaPad Slim 5", "ThinkPad E14", "Legion 5", "LOQ 15"],
+    "Acer": ["Aspire 7", "Nitro V 15", "Swift Go 14"],
+}
+PHONE_STORAGE = [("4GB", "128GB"), ("6GB", "128GB"), ("8GB", "128GB"), ("8GB", "256GB"), ("12GB", "256GB"), ("12GB", "512GB"), ("16GB", "1TB")]
+LAPTOP_CONFIGS = ["i5 1334U/16GB/512GB", "i7 13620H/16GB/512GB", "R5 7520U/8GB/512GB", "R7 7735HS/16GB/1TB", "8CPU/8GPU/16GB/256GB", "10CPU/10GPU/16GB/512GB", "Ultra 5 125H/16GB/512GB"]
+COLORS = ["", "Đen", "Trắng", "Xanh", "Tím", "Vàng", "Xám"]
+EDITIONS = ["", "5G", "(NFC)", "(2025)", "Chính hãng"]
+
+def slugify(text: str) -> str:
+    return "-".join("".join(ch if ch.isalnum() else " " for ch in text.lower()).split())
+
+def format_price(value: int) -> str:
+    """2290000 -> "2.290.000 ₫" (cùng format data.json)."""
+    return f"{value:,}".replace(",", ".") + " ₫"
+
+def generate_products(size: int, seed: int = 42):
+    """Yield `size` sản phẩm; name không trùng nhờ hậu tố biến thể khi tổ hợp cơ bản đã dùng hết."""
+    rng = random.Random(seed)
+    phone_models = [(brand, line) for brand, lines in PHONE_LINES.items() for line in lines]
+    laptop_models = [(brand, line) for brand, lines in LAPTOP_LINES.items() for line in lines]
+    seen = set()
+    for i in range(size):
+        laptop = rng.random() < 0.2
+        brand, line = rng.choice(laptop_models if laptop else phone_models)
+        if laptop:
+            capacity = rng.choice(LAPTOP_CONFIGS)
+            name = f"{brand} {line} {capacity}"
+            price = rng.randrange(120, 650) * 100_000 - 10_000
+            category, path = "Laptop", "may-tinh-xach-tay"
+        else:
+            ram, storage = rng.choice(PHONE_STORAGE)
+            capacity = ram
+            name = " ".join(p for p in (brand, line, ram, storage, rng.choice(EDITIONS)) if p)
+            price = rng.randrange(15, 450) * 100_000 - 10_000   # kiểu 2.290.000
+            category, path = "Điện thoại", "dien-thoai"
+        if name in seen:
+            name = f"{name} #{i}"
+        seen.add(name)
+        discount = rng.choice(["", "-3%", "-5%", "-8%", "-10%", "-15%", "-25%"])
+        yield {
+            "category": category,
+            "name": name,
+            "color": rng.choice(COLORS),
+            "capacity": capacity,
+            "price": format_price(price),
+            "discount": discount,
+            "warranty": rng.choice(["", "12 tháng", "24 tháng"]),
+            "link": f"https://fptshop.com.vn/{path}/{slugify(name)}-{i}",
+            "picture": f"https://cdn.example.com/products/{i}.jpg",
+            "Description": ""
+        }
+
+def write_catalog(path: str, size: int, seed: int = 42):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[\n")
+        for i, product in enumerate(generate_products(size, seed)):
+            if i:
+                f.write(",\n")
+            f.write(json.dumps(product, ensure_ascii=False))
+        f.write("\n]\n")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sinh catalog sản phẩm giả cùng dạng data.json")
+    parser.add_argument("--size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="catalog_synthetic.json")
+    args = parser.parse_args()
+    write_catalog(args.out, args.size, args.seed)
+    print(f"✅ Đã ghi {args.size} sản phẩm vào {args.out}")
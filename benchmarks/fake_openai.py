@@ -0,0 +1,147 @@
+import re
+import sys
+import json
+import time
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from embeddings import HashingEmbeddingBackend
+
+# Chạy: python -m benchmarks.fake_openai [--port 8799] [--dim 1536] [--embed-latency-ms 20] [--chat-latency-ms 400]
+# Server giả lập API OpenAI-compatible (chỉ dùng stdlib + HashingEmbeddingBackend) để benchmark không cần mạng:
+#   POST /v1/embeddings        vector deterministic (feature hashing), giống nhau giữa các lần chạy
+#   POST /v1/chat/completions  prompt rewrite -> trả lại nguyên câu hỏi; còn lại -> câu trả lời --chat-tokens từ
+#                              (stream=True: SSE chunk theo format OpenAI, mỗi token cách --stream-token-ms)
+#   GET  /stats                số lần gọi / số input theo endpoint
+# Trỏ app vào server: OPENAI_ENDPOINT=http://127.0.0.1:8799/v1 OPENAI_API_KEY=x OPENAI_API_KEY_EMBEDDED=x
+
+REWRITE_QUESTION_RE = re.compile(r"User question:\s*(.*)", re.S)
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "FakeOpenAI/1.0"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") != "/stats":
+            return self._send_json({"error": {"message": "not found"}}, status=404)
+        with self.server.stats_lock:
+            self._send_json(dict(self.server.stats))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._send_json({"error": {"message": "invalid JSON"}}, status=400)
+
+        if self.path.endswith("/embeddings"):
+            return self._embeddings(body)
+        if self.path.endswith("/chat/completions"):
+            return self._chat(body)
+        self._send_json({"error": {"message": "not found"}}, status=404)
+
+    def _embeddings(self, body):
+        texts = body.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        self._count("embedding_requests", "embedding_inputs", len(texts))
+        time.sleep(self.server.args.embed_latency_ms / 1000)
+        vectors = self.server.embedder.embed_batch([str(t) for t in texts])
+        self._send_json({
+            "object": "list",
+            "model": body.get("model", "fake-embedding"),
+            "data": [{"object": "embedding", "index": i, "embedding": v} for i, v in enumerate(vectors)],
+            "usage": {"prompt_tokens": len(texts), "total_tokens": len(texts)}
+        })
+
+    def _chat(self, body):
+        self._count("chat_requests", "chat_streams", 1 if body.get("stream") else 0)
+        time.sleep(self.server.args.chat_latency_ms / 1000)
+        messages = body.get("messages") or [{}]
+        last = str(messages[-1].get("content") or "")
+        match = REWRITE_QUESTION_RE.search(last)
+        if match:
+            text = match.group(1).strip().splitlines()[0]   # rewrite: giữ nguyên câu hỏi
+        else:
+            text = " ".join(["token"] * self.server.args.chat_tokens)
+        model = body.get("model", "fake-chat")
+
+        if not body.get("stream"):
+            return self._send_json({
+                "id": "chatcmpl-fake",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": len(last.split()), "completion_tokens": len(text.split()), "total_tokens": len(last.split()) + len(text.split())}
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            chunk = {
+                "id": "chatcmpl-fake",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": word if i == 0 else " " + word}, "finish_reason": None}]
+            }
+            self._write_chunk("data: " + json.dumps(chunk, ensure_ascii=False) + "\n\n")
+            time.sleep(self.server.args.stream_token_ms / 1000)
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _count(self, requests_key, items_key, items):
+        with self.server.stats_lock:
+            self.server.stats[requests_key] = self.server.stats.get(requests_key, 0) + 1
+            self.server.stats[items_key] = self.server.stats.get(items_key, 0) + items
+
+    def _write_chunk(self, text):
+        data = text.encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(args) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((args.host, args.port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.args = args
+    server.embedder = HashingEmbeddingBackend(args.dim)
+    server.stats = {}
+    server.stats_lock = threading.Lock()
+    return server
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Server OpenAI-compatible giả lập cho benchmark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8799)
+    parser.add_argument("--dim", type=int, default=1536, help="Số chiều embedding trả về")
+    parser.add_argument("--embed-latency-ms", type=float, default=20.0)
+    parser.add_argument("--chat-latency-ms", type=float, default=400.0, help="Độ trễ trước token đầu tiên / response")
+    parser.add_argument("--stream-token-ms", type=float, default=10.0, help="Khoảng cách giữa các token khi stream")
+    parser.add_argument("--chat-tokens", type=int, default=60, help="Số từ của câu trả lời giả")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = make_server(args)
+    print(f"Fake OpenAI server: http://{args.host}:{args.port}/v1 (dim={args.dim}, embed={args.embed_latency_ms}ms, chat={args.chat_latency_ms}ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+        sys.exit(0)
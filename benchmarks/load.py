@@ -0,0 +1,167 @@
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+import httpx
+from benchmarks.traces import load_traces, generate_traces
+
+# Chạy (3 terminal):
+#   python -m benchmarks.fake_openai --port 8799 --chat-latency-ms 400
+#   OPENAI_ENDPOINT=http://127.0.0.1:8799/v1 OPENAI_API_KEY=x OPENAI_API_KEY_EMBEDDED=x python app.py   (hoặc uvicorn asgi:app)
+#   python -m benchmarks.load --base-url http://127.0.0.1:5001 --concurrency 32 --traces /tmp/traces.jsonl [--duration 60]
+# Replay trace hội thoại (benchmarks.traces) vào /api/v1/chatbot và /api/v1/rag_test: các turn trong 1 session chạy
+# tuần tự (giữ ngữ cảnh multi-turn), tối đa --concurrency session chạy song song.
+# Báo cáo throughput, p50/p95/p99 latency theo endpoint, TTFB của SSE và theo từng stage (header Server-Timing).
+
+PERCENTILES = (50, 95, 99)
+
+def parse_server_timing(header: str) -> dict:
+    """ "embed;dur=12.3, llm;dur=850" -> {"embed": 12.3, "llm": 850.0}."""
+    timings = {}
+    for part in (header or "").split(","):
+        name, _, params = part.strip().partition(";")
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if name and key == "dur":
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
+
+
+class Recorder:
+    """Gom latency (ms) theo nhóm: "chatbot", "chatbot:stream", "rag_test", "stage:embed", "ttfb:chatbot:stream"..."""
+    def __init__(self):
+        self.samples = {}
+        self.errors = {}
+        self.requests = 0
+
+    def add(self, key: str, ms: float):
+        self.samples.setdefault(key, []).append(ms)
+
+    def error(self, key: str, reason: str):
+        self.errors.setdefault(key, {}).setdefault(reason, 0)
+        self.errors[key][reason] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        rows = {}
+        for key, values in sorted(self.samples.items()):
+            values = np.asarray(values)
+            rows[key] = {"count": int(len(values)), "mean": round(float(values.mean()), 2)}
+            rows[key].update({f"p{q}": round(float(np.percentile(values, q)), 2) for q in PERCENTILES})
+        return {
+            "elapsed_s": round(elapsed, 2),
+            "requests": self.requests,
+            "throughput_rps": round(self.requests / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": rows,
+            "errors": self.errors
+        }
+
+
+async def send(client: httpx.AsyncClient, item: dict, recorder: Recorder):
+    endpoint = item["endpoint"]
+    key = endpoint + (":stream" if item.get("stream") else "")
+    payload = {"query": item["query"]}
+    if endpoint == "chatbot":
+        payload["session_id"] = item["session_id"]
+        if item.get("stream"):
+            payload["stream"] = True
+
+    started = time.perf_counter()
+    try:
+        async with client.stream("POST", f"/api/v1/{endpoint}", json=payload) as response:
+            first_byte = None
+            stream_error = False
+            async for line in response.aiter_lines():
+                if first_byte is None:
+                    first_byte = time.perf_counter()
+                if line.startswith("event: error"):
+                    stream_error = True
+            elapsed_ms = (time.perf_counter() - started) * 1000
+    except httpx.HTTPError as e:
+        recorder.error(key, type(e).__name__)
+        return
+    finally:
+        recorder.requests += 1
+
+    if response.status_code >= 400 or stream_error:
+        recorder.error(key, f"HTTP {response.status_code}" if response.status_code >= 400 else "stream error")
+        return
+    recorder.add(key, elapsed_ms)
+    if item.get("stream") and first_byte is not None:
+        recorder.add(f"ttfb:{key}", (first_byte - started) * 1000)
+    for stage, ms in parse_server_timing(response.headers.get("Server-Timing")).items():
+        recorder.add(f"stage:{stage}", ms)
+
+async def run_session(client, turns, recorder, deadline, think_time):
+    for item in turns:
+        if deadline and time.perf_counter() >= deadline:
+            return
+        await send(client, item, recorder)
+        if think_time:
+            await asyncio.sleep(think_time)
+
+async def run(args) -> dict:
+    if args.traces:
+        sessions = list(load_traces(args.traces).values())
+    else:
+        sessions = {}
+        for item in generate_traces(args.sessions, seed=args.seed):
+            sessions.setdefault(item["session_id"], []).append(item)
+        sessions = list(sessions.values())
+    if args.sessions:
+        sessions = sessions[:args.sessions]
+
+    recorder = Recorder()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    started = time.perf_counter()
+    deadline = started + args.duration if args.duration else None
+
+    async with httpx.AsyncClient(base_url=args.base_url, timeout=args.timeout, limits=limits) as client:
+        async def worker(turns, round_index):
+            async with semaphore:
+                if round_index:
+                    # Lặp lại trace khi chạy theo --duration: session_id mới để history không dồn lên
+                    turns = [dict(t, session_id=f"{t['session_id']}-r{round_index}") for t in turns]
+                await run_session(client, turns, recorder, deadline, args.think_time)
+
+        round_index = 0
+        while True:
+            await asyncio.gather(*(worker(turns, round_index) for turns in sessions))
+            round_index += 1
+            if not deadline or time.perf_counter() >= deadline:
+                break
+
+    return recorder.summary(time.perf_counter() - started)
+
+def print_report(report: dict):
+    print(f"\nRequests: {report['requests']} trong {report['elapsed_s']}s -> {report['throughput_rps']} req/s")
+    print(f"{'group':<28}{'count':>8}{'mean':>10}" + "".join(f"{'p' + str(q):>10}" for q in PERCENTILES))
+    for key, row in report["latency_ms"].items():
+        print(f"{key:<28}{row['count']:>8}{row['mean']:>10}" + "".join(f"{row['p' + str(q)]:>10}" for q in PERCENTILES))
+    for key, reasons in report["errors"].items():
+        print(f"errors {key}: " + ", ".join(f"{reason} x{count}" for reason, count in reasons.items()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test end-to-end cho /api/v1/chatbot và /api/v1/rag_test")
+    parser.add_argument("--base-url", default="http://127.0.0.1:5001")
+    parser.add_argument("--traces", help="File JSONL từ benchmarks.traces (mặc định: sinh trace với --seed)")
+    parser.add_argument("--sessions", type=int, default=0, help="Số session dùng (0 = toàn bộ trace; khi tự sinh trace mặc định 100)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--concurrency", type=int, default=16, help="Số session chạy song song")
+    parser.add_argument("--duration", type=float, default=0, help="Lặp trace tới khi hết số giây này (0 = chạy 1 lượt)")
+    parser.add_argument("--think-time", type=float, default=0, help="Nghỉ giữa các turn trong 1 session (giây)")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="Ghi báo cáo JSON ra file (để so sánh giữa các commit)")
+    args = parser.parse_args()
+    if not args.traces and not args.sessions:
+        args.sessions = 100
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,112 @@
+import json
+import random
+import argparse
+
+# Chạy: python -m benchmarks.traces --sessions 200 --out /tmp/traces.jsonl [--seed 7] [--stream-ratio 0.2]
+# Sinh trace hội thoại nhiều lượt (JSONL, mỗi dòng 1 request) để replay bằng benchmarks.load:
+#   {"session_id", "turn", "endpoint": "chatbot" | "rag_test", "query", "stream"}
+# Mỗi session: câu hỏi sản phẩm mở đầu, rồi hỏi tiếp (cần rewrite), lọc theo giá, chit-chat.
+# Cùng seed -> cùng trace, nên so sánh được kết quả giữa các lần chạy / commit.
+
+PRODUCTS = [
+    "iPhone 16 Pro Max", "iPhone 15", "Samsung Galaxy S25 Ultra", "Galaxy Z Fold7", "Galaxy A56",
+    "Xiaomi 15T Pro", "Redmi Note 14", "OPPO Reno14", "vivo V50", "realme C75", "Honor 400",
+    "Nubia A76", "TCL 60R", "MacBook Air M3", "ASUS Vivobook 15", "Dell Inspiron 15",
+]
+BRANDS = ["iPhone", "Samsung", "Xiaomi", "OPPO", "vivo", "realme", "Honor", "MacBook", "ASUS", "Dell"]
+CATEGORIES = ["điện thoại", "laptop"]
+
+OPENERS = [
+    "{product} giá bao nhiêu?",
+    "Cho mình xem thông tin {product}",
+    "{product} còn hàng không shop?",
+    "So sánh {product} với {other}",
+    "Tư vấn {category} {brand} dưới {budget} triệu",
+    "Có {category} nào khoảng {budget} triệu không?",
+]
+FOLLOW_UPS = [
+    "Máy đó có bản 256GB không?",
+    "Nó đang giảm giá bao nhiêu?",
+    "Còn màu nào khác không?",
+    "Bảo hành bao lâu vậy?",
+    "Có rẻ hơn không?",
+    "Pin của nó dùng được lâu không?",
+]
+PRICE_QUERIES = [
+    "{category} {brand} từ {low} đến {budget} triệu",
+    "{category} trên {low} triệu",
+    "{brand} dưới {budget}tr",
+]
+CHIT_CHAT = [
+    "Cảm ơn shop nhé",
+    "Shop mở cửa mấy giờ?",
+    "Có giao hàng tận nơi không?",
+    "Xin chào",
+]
+
+def make_session(rng: random.Random, session_id: str, max_turns: int, stream_ratio: float, rag_ratio: float) -> list:
+    def fill(template):
+        budget = rng.choice([5, 8, 10, 15, 20, 30])
+        return template.format(
+            product=rng.choice(PRODUCTS),
+            other=rng.choice(PRODUCTS),
+            brand=rng.choice(BRANDS),
+            category=rng.choice(CATEGORIES),
+            budget=budget,
+            low=max(budget - rng.choice([3, 5]), 1),
+        )
+
+    queries = [fill(rng.choice(OPENERS))]
+    for _ in range(rng.randint(1, max_turns) - 1):
+        kind = rng.random()
+        if kind < 0.5:
+            queries.append(rng.choice(FOLLOW_UPS))
+        elif kind < 0.8:
+            queries.append(fill(rng.choice(PRICE_QUERIES)))
+        else:
+            queries.append(rng.choice(CHIT_CHAT))
+
+    turns = []
+    for turn, query in enumerate(queries):
+        endpoint = "rag_test" if rng.random() < rag_ratio else "chatbot"
+        turns.append({
+            "session_id": session_id,
+            "turn": turn,
+            "endpoint": endpoint,
+            "query": query,
+            "stream": endpoint == "chatbot" and rng.random() < stream_ratio
+        })
+    return turns
+
+def generate_traces(sessions: int, seed: int = 7, max_turns: int = 6, stream_ratio: float = 0.2, rag_ratio: float = 0.1):
+    rng = random.Random(seed)
+    for i in range(sessions):
+        yield from make_session(rng, f"bench-{seed}-{i:06d}", max_turns, stream_ratio, rag_ratio)
+
+def load_traces(path: str) -> dict:
+    """JSONL -> {session_id: [turn theo thứ tự]}."""
+    sessions = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                sessions.setdefault(item["session_id"], []).append(item)
+    for turns in sessions.values():
+        turns.sort(key=lambda t: t["turn"])
+    return sessions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sinh trace hội thoại nhiều lượt cho benchmark")
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--max-turns", type=int, default=6)
+    parser.add_argument("--stream-ratio", type=float, default=0.2, help="Tỉ lệ request chatbot dùng SSE")
+    parser.add_argument("--rag-ratio", type=float, default=0.1, help="Tỉ lệ request gửi tới /api/v1/rag_test")
+    parser.add_argument("--out", default="traces.jsonl")
+    args = parser.parse_args()
+    count = 0
+    with open(args.out, "w", encoding="utf-8") as f:
+        for item in generate_traces(args.sessions, args.seed, args.max_turns, args.stream_ratio, args.rag_ratio):
+            f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            count += 1
+    print(f"✅ Đã ghi {count} request ({args.sessions} session) vào {args.out}")
@@ -1,10 +1,22 @@
-import chromadb
 import json
-import uuid
 import re
 import os
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from openai import OpenAI
+from embeddings import EmbeddingModel
+from resources import chroma_collection
+from rag import (
+    read_catalog_version, bump_catalog_version, new_catalog_version, NumpyIndex, numpy_index_path,
+    BM25Index, lexical_index_path, lexical_text,
+    AttributeIndex, attribute_index_path, parse_price, parse_discount, infer_brand,
+    EntityMatcher, entity_index_path, CatalogStore, records_path
+)
+
+# Chạy: python data_store.py [--data data.json] [--collection products] [--full]
+# Ingest incremental: chỉ embed sản phẩm mới / thay đổi, xoá sản phẩm không còn trong data.
 
 # ------------------- Load env -------------------
 load_dotenv()
@@ -12,20 +24,12 @@ load_dotenv()
 AZURE_OPENAI_EMBEDDING_API_KEY = os.getenv("OPENAI_API_KEY_EMBEDDED")
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.getenv("OPENAI_ENDPOINT")
 AZURE_OPENAI_EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL", "text-embedding-3-small")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")  # phải giống backend của app (openai / local / hashing)
 
-# ------------------- Load product data -------------------
-with open('data.json', 'r', encoding='utf-8') as f:
-    products = json.load(f)
-
-# ------------------- Khởi tạo client embedding -------------------
-embedding_client = OpenAI(
-    api_key=AZURE_OPENAI_EMBEDDING_API_KEY,
-    base_url=AZURE_OPENAI_EMBEDDING_ENDPOINT,
-)
-
-# ------------------- Khởi tạo ChromaDB -------------------
-chroma_client = chromadb.PersistentClient(path='VECTOR_STORE')
-collection = chroma_client.get_or_create_collection(name="product")
+DB_PATH = "VECTOR_STORE"
+COLLECTION_NAME = os.getenv("COLLECTION_NAME") or "products"
+BATCH_SIZE = 20  # Bạn có thể thay đổi batch size tuỳ theo RAM và API
+EMBED_WORKERS = int(os.getenv("INGEST_EMBED_WORKERS", "4"))
 
 # ------------------- Helper functions -------------------
 def preprocess_text(text: str) -> str:
@@ -44,43 +48,182 @@ Color: {product.get('color', '')}
 Capacity: {product.get('capacity', '')}
 Price: {product.get('price', '')}
 Ram: {product.get('ram', '')}
-Description: {product.get('description', '')}"""
-
-# ------------------- Chuẩn bị dữ liệu cho batch -------------------
-product_texts = [preprocess_text(create_product_text(p)) for p in products]
-product_ids = [str(p.get("index", str(uuid.uuid4()))) for p in products]
-metadatas = [{
-    "title": p.get("name",""),
-    "brand": p.get("brand",""),
-    "tags": p.get("category",""),
-    "price": p.get("price",""),
-    "ram": p.get("ram",""),
-    "color": p.get("color",""),
-    "capacity": p.get("capacity",""),
-} for p in products]
-
-# ------------------- Batching -------------------
-BATCH_SIZE = 20  # Bạn có thể thay đổi batch size tuỳ theo RAM và API
+Description: {product.get('description') or product.get('Description', '')}"""
 
-for i in range(0, len(products), BATCH_SIZE):
-    batch_texts = product_texts[i:i+BATCH_SIZE]
-    batch_ids = product_ids[i:i+BATCH_SIZE]
-    batch_meta = metadatas[i:i+BATCH_SIZE]
+def product_id(product: dict) -> str:
+    """Id ổn định theo nội dung nhận diện sản phẩm (index nếu có, nếu không thì link + tên + biến thể)."""
+    if product.get("index") not in (None, ""):
+        return str(product["index"])
+    key = "|".join(str(product.get(k, "")).strip().lower() for k in ("link", "name", "capacity", "ram", "color"))
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
 
-    # Tạo embedding cho batch
-    response = embedding_client.embeddings.create(
-        model=AZURE_OPENAI_EMBED_MODEL,
-        input=batch_texts
-    )
-    embeddings = [e.embedding for e in response.data]
-
-    # Thêm batch vào ChromaDB
-    collection.add(
-        embeddings=embeddings,
-        documents=batch_texts,
-        ids=batch_ids,
-        metadatas=batch_meta
+def product_metadata(product: dict) -> dict:
+    """Metadata lưu cùng embedding; price_value / discount_pct là số đã parse để lọc theo khoảng giá."""
+    return {
+        "title": product.get("name", ""),
+        "brand": infer_brand(product.get("name", ""), product.get("brand", "")),
+        "tags": product.get("category", ""),
+        "price": product.get("price", ""),
+        "price_value": parse_price(product.get("price")) or 0,
+        "discount": product.get("discount", ""),
+        "discount_pct": parse_discount(product.get("discount")),
+        "ram": product.get("ram", ""),
+        "color": product.get("color", ""),
+        "capacity": product.get("capacity", ""),
+        "link": product.get("link", ""),
+    }
+
+def build_records(products: list, model_name: str = AZURE_OPENAI_EMBED_MODEL) -> dict:
+    """
+    id -> {"text", "metadata"}; sản phẩm trùng id chỉ giữ bản cuối.
+    metadata có content_hash (gồm cả model_name -> đổi engine embedding thì embed lại).
+    """
+    records = {}
+    for p in products:
+        text = preprocess_text(create_product_text(p))
+        metadata = product_metadata(p)
+        digest = hashlib.sha256(
+            (model_name + "\n" + text + "\n" + json.dumps(metadata, sort_keys=True, ensure_ascii=False)).encode("utf-8")
+        ).hexdigest()
+        metadata["content_hash"] = digest
+        records[product_id(p)] = {"text": text, "metadata": metadata}
+    return records
+
+def existing_hashes(collection) -> dict:
+    data = collection.get(include=["metadatas"])
+    return {
+        doc_id: (meta or {}).get("content_hash")
+        for doc_id, meta in zip(data.get("ids") or [], data.get("metadatas") or [])
+    }
+
+def embed_batch(embedding_engine, texts: list) -> list:
+    return embedding_engine.embed_batch(texts)
+
+# ------------------- Checkpoint -------------------
+# Mỗi batch được upsert kèm content_hash nên chính collection là checkpoint: chạy lại sau khi crash
+# chỉ embed các batch chưa ghi. File checkpoint đánh dấu run đang dở để lần chạy sau vẫn
+# hoàn tất bước xoá + bump catalog version dù không còn sản phẩm nào cần embed.
+def checkpoint_path(collection_name: str) -> str:
+    return os.path.join(DB_PATH, f"{collection_name}.ingest_checkpoint.json")
+
+def load_checkpoint(path: str) -> dict:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_checkpoint(path: str, state: dict):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+# ------------------- Lexical index -------------------
+def update_lexical_index(collection, collection_name: str, records: dict, changed_ids: list, removed_ids: list,
+                         catalog_version: str, full: bool = False):
+    """
+    Cập nhật BM25 index incremental theo các id thay đổi / bị xoá. Build lại từ collection nếu chưa có file
+    hoặc file không khớp catalog version hiện tại (vd. run trước crash giữa chừng).
+    """
+    path = lexical_index_path(DB_PATH, collection_name)
+    index = None
+    if not full and os.path.exists(path):
+        try:
+            index = BM25Index.load(path)
+        except (ValueError, KeyError):
+            index = None
+        if index is not None and index.catalog_version != read_catalog_version(DB_PATH, collection_name):
+            index = None
+    if index is None:
+        index = BM25Index.build_from_collection(collection)
+    else:
+        for i in removed_ids:
+            index.remove(i)
+        for i in changed_ids:
+            index.add(i, lexical_text(records[i]["metadata"], records[i]["text"]))
+    index.catalog_version = catalog_version
+    index.save(path)
+
+# ------------------- Ingest -------------------
+def ingest(products: list, collection, embedding_engine, collection_name: str, full: bool = False,
+           batch_size: int = BATCH_SIZE, workers: int = EMBED_WORKERS) -> dict:
+    """embedding_engine: EmbeddingModel, phải cùng backend / model với engine app dùng để embed query."""
+    records = build_records(products, embedding_engine.name)
+    existing = existing_hashes(collection)
+    changed_ids = [i for i, r in records.items() if full or existing.get(i) != r["metadata"]["content_hash"]]
+    removed_ids = [i for i in existing if i not in records]
+
+    ckpt_path = checkpoint_path(collection_name)
+    checkpoint = load_checkpoint(ckpt_path)
+    if checkpoint:
+        print(f"[DEBUG] Resume ingest dở dang từ {checkpoint.get('started_at')} ({checkpoint.get('upserted', 0)} sản phẩm đã ghi)")
+    if not changed_ids and not removed_ids and not checkpoint:
+        return {"upserted": 0, "deleted": 0, "unchanged": len(records)}
+
+    checkpoint.setdefault("started_at", time.strftime("%Y-%m-%d %H:%M:%S"))
+    checkpoint.setdefault("upserted", 0)
+    save_checkpoint(ckpt_path, checkpoint)
+
+    # Embed các batch song song, upsert từng batch ngay khi xong
+    batches = [changed_ids[i:i + batch_size] for i in range(0, len(changed_ids), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            pool.submit(embed_batch, embedding_engine, [records[i]["text"] for i in batch]): batch
+            for batch in batches
+        }
+        for future in as_completed(futures):
+            batch = futures[future]
+            collection.upsert(
+                ids=batch,
+                embeddings=future.result(),
+                documents=[records[i]["text"] for i in batch],
+                metadatas=[records[i]["metadata"] for i in batch]
+            )
+            checkpoint["upserted"] += len(batch)
+            save_checkpoint(ckpt_path, checkpoint)
+            print(f"[DEBUG] Upserted batch of {len(batch)} ({checkpoint['upserted']} total)")
+
+    if removed_ids:
+        collection.delete(ids=removed_ids)
+        print(f"[DEBUG] Deleted {len(removed_ids)} removed products")
+
+    # Prebuild index cho backend numpy + BM25 + thuộc tính + entity matcher + catalog record, sau đó đổi catalog version
+    # -> semantic cache / index của catalog cũ hết hiệu lực
+    version = new_catalog_version()
+    NumpyIndex.build_from_collection(collection, numpy_index_path(DB_PATH, collection_name), catalog_version=version)
+    update_lexical_index(collection, collection_name, records, changed_ids, removed_ids, version, full=full)
+    AttributeIndex.build_from_collection(collection, catalog_version=version).save(attribute_index_path(DB_PATH, collection_name))
+    EntityMatcher.build_from_collection(collection, catalog_version=version).save(entity_index_path(DB_PATH, collection_name))
+    CatalogStore.build_from_collection(collection, records_path(DB_PATH, collection_name), catalog_version=version)
+    bump_catalog_version(DB_PATH, version, collection_name=collection_name)
+    os.remove(ckpt_path)
+    return {"upserted": len(changed_ids), "deleted": len(removed_ids), "unchanged": len(records) - len(changed_ids)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest catalog sản phẩm vào ChromaDB")
+    parser.add_argument("--data", default="data.json")
+    parser.add_argument("--collection", default=COLLECTION_NAME)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS)
+    parser.add_argument("--full", action="store_true", help="Embed lại toàn bộ sản phẩm")
+    args = parser.parse_args()
+
+    # ------------------- Load product data -------------------
+    with open(args.data, 'r', encoding='utf-8') as f:
+        products = json.load(f)
+
+    # ------------------- Khởi tạo engine embedding -------------------
+    embedding_engine = EmbeddingModel(
+        api_key=AZURE_OPENAI_EMBEDDING_API_KEY,
+        endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT,
+        model=AZURE_OPENAI_EMBED_MODEL if EMBEDDING_BACKEND == "openai" else None,
+        backend=EMBEDDING_BACKEND
     )
-    print(f"[DEBUG] Added batch {i}-{i+len(batch_texts)-1}")
 
-print(f"✅ Added {len(products)} products to ChromaDB successfully!")
+    # ------------------- Khởi tạo ChromaDB -------------------
+    collection = chroma_collection(DB_PATH, args.collection)
+
+    stats = ingest(products, collection, embedding_engine, args.collection, full=args.full,
+                   batch_size=args.batch_size, workers=args.workers)
+    print(f"✅ Ingest '{args.collection}': {stats['upserted']} upserted, {stats['deleted']} deleted, {stats['unchanged']} unchanged")
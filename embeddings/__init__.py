@@ -1 +1,2 @@
-from embeddings.core import EmbeddingModel
\ No newline at end of file
+from embeddings.core import EmbeddingModel, OpenAIEmbeddingBackend, LocalEmbeddingBackend, HashingEmbeddingBackend
+from embeddings.service import EmbeddingService, normalize_text
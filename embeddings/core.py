@@ -1,28 +1,243 @@
-from sentence_transformers import SentenceTransformer
-from openai import OpenAI
-import os   
+import os
+import re
+import time
+import queue
+import asyncio
+import hashlib
+import threading
+import numpy as np
+from concurrent.futures import Future
 from dotenv import load_dotenv
+from resources import reinit_after_fork
 
 load_dotenv()
 
+DEFAULT_LOCAL_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
+DEFAULT_HASHING_DIM = 384
+
+# ------------------- Backends -------------------
+# Mọi backend có cùng API: embed_batch(texts, timeout=None) -> list vector (giữ thứ tự), aembed_batch(texts) cho đường asyncio.
+
+class OpenAIEmbeddingBackend:
+    """Embedding qua API OpenAI-compatible (OpenAI / Azure OpenAI / server nội bộ)."""
+    def __init__(self, client, model: str, async_client=None, max_batch_size: int = 512):
+        self.client = client
+        self.async_client = async_client
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.name = model
+
+    def embed_batch(self, texts: list, timeout: float = None) -> list:
+        """timeout: tổng thời gian (giây) cho cả batch; khi có timeout thì không retry trong SDK."""
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            client = self.client
+            if expires_at is not None:
+                client = client.with_options(timeout=max(0.01, expires_at - time.monotonic()), max_retries=0)
+            response = client.embeddings.create(model=self.model, input=texts[start:start + self.max_batch_size])
+            vectors.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        return vectors
+
+    async def aembed_batch(self, texts: list) -> list:
+        if self.async_client is None:
+            return await asyncio.to_thread(self.embed_batch, texts)
+        vectors = []
+        for start in range(0, len(texts), self.max_batch_size):
+            response = await self.async_client.embeddings.create(model=self.model, input=texts[start:start + self.max_batch_size])
+            vectors.extend(d.embedding for d in sorted(response.data, key=lambda d: d.index))
+        return vectors
+
+
+class LocalEmbeddingBackend:
+    """
+    Model sentence-transformers chạy trên CPU trong process -> query embedding không tốn round-trip mạng.
+    - Model chỉ được load ở lần embed đầu tiên (import sentence_transformers cũng lazy).
+    - Micro-batching: 1 thread inference gom các request đến trong max_latency_ms (tối đa max_batch_size text)
+      thành 1 lần encode, thay vì mỗi request encode riêng.
+    """
+    def __init__(self, model: str = DEFAULT_LOCAL_MODEL, device: str = "cpu", max_batch_size: int = 32,
+                 max_latency_ms: float = 5.0, normalize: bool = True):
+        self.model_name = model
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.normalize = normalize
+        self.name = f"local:{model}"
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        """Sau fork: thread micro-batch của process cha không còn -> hàng đợi / lock mới; model đã load dùng lại."""
+        self._load_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+
+    def warmup(self):
+        self.load()
+
+    def load(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(self.model_name, device=self.device)
+        return self._model
+
+    def submit(self, texts: list) -> Future:
+        """Đưa texts vào hàng đợi micro-batch; Future trả về list vector theo thứ tự texts."""
+        future = Future()
+        if not texts:
+            future.set_result([])
+            return future
+        self._ensure_worker()
+        self._queue.put((list(texts), future))
+        return future
+
+    def embed_batch(self, texts: list, timeout: float = None) -> list:
+        # Hết timeout thì bỏ chờ (batch vẫn encode xong trong thread inference)
+        return self.submit(texts).result(timeout=timeout)
+
+    async def aembed_batch(self, texts: list) -> list:
+        return await asyncio.wrap_future(self.submit(texts))
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._load_lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name="local-embedding", daemon=True)
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            count = len(pending[0][0])
+            wait_until = time.monotonic() + self.max_latency
+            while count < self.max_batch_size:
+                timeout = wait_until - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(item)
+                count += len(item[0])
+            self._encode(pending)
+
+    def _encode(self, pending):
+        texts = [t for item_texts, _ in pending for t in item_texts]
+        try:
+            vectors = self.load().encode(
+                texts,
+                batch_size=self.max_batch_size,
+                normalize_embeddings=self.normalize,
+                convert_to_numpy=True,
+                show_progress_bar=False
+            ).tolist()
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        start = 0
+        for item_texts, future in pending:
+            future.set_result(vectors[start:start + len(item_texts)])
+            start += len(item_texts)
+
+
+class HashingEmbeddingBackend:
+    """
+    Embedder deterministic, không cần model / mạng: feature hashing từ + char 3-gram vào `dim` chiều, chuẩn hoá L2.
+    Dùng cho test và benchmark offline; cùng text luôn ra cùng vector trên mọi máy.
+    """
+    def __init__(self, dim: int = DEFAULT_HASHING_DIM):
+        self.dim = dim
+        self.name = f"hashing:{dim}"
+
+    def embed_one(self, text: str) -> list:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for feature in self._features(text):
+            h = int.from_bytes(hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest(), "little")
+            vector[h % self.dim] += 1.0 if (h >> 63) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector.tolist()
+
+    def embed_batch(self, texts: list, timeout: float = None) -> list:
+        return [self.embed_one(t) for t in texts]
+
+    async def aembed_batch(self, texts: list) -> list:
+        return self.embed_batch(texts)
+
+    @staticmethod
+    def _features(text: str):
+        for word in re.findall(r"\w+", (text or "").lower()):
+            yield "w:" + word
+            padded = f"#{word}#"
+            for i in range(len(padded) - 2):
+                yield "c:" + padded[i:i + 3]
+
+
+# ------------------- Engine -------------------
 class EmbeddingModel():
-    def __init__(self, api_key=None, endpoint=None, model="text-embedding-3-small"):
+    def __init__(self, api_key=None, endpoint=None, model=None, backend=None, client=None, async_client=None,
+                 dim=None, device=None, max_batch_size=None, max_latency_ms=None):
         """
-        api_key: OpenAI API Key hoặc Azure OpenAI Key
-        endpoint: Nếu dùng Azure OpenAI thì truyền base_url
-        model: model embedding
+        backend: "openai" (mặc định), "local" (sentence-transformers trên CPU) hoặc "hashing" (deterministic, offline).
+            Mặc định lấy từ env EMBEDDING_BACKEND.
+        api_key / endpoint / client / async_client: cho backend openai (Azure OpenAI thì truyền base_url).
+        model: model embedding (openai: tên model; local: tên / path model sentence-transformers).
+        dim: số chiều của backend hashing.
         """
-        self.model = model
-        self.client = OpenAI(
-            api_key=api_key or os.getenv("OPENAI_API_KEY_EMBEDDED"),
-            base_url=endpoint or os.getenv("OPENAI_ENDPOINT")
-        )
+        self.backend_name = backend or os.getenv("EMBEDDING_BACKEND", "openai")
+        if self.backend_name == "openai":
+            if client is None:
+                from openai import OpenAI   # import lazy: backend local / hashing không cần SDK openai
+                client = OpenAI(
+                    api_key=api_key or os.getenv("OPENAI_API_KEY_EMBEDDED"),
+                    base_url=endpoint or os.getenv("OPENAI_ENDPOINT")
+                )
+            self.model = model or "text-embedding-3-small"
+            self.backend = OpenAIEmbeddingBackend(client, self.model, async_client=async_client)
+        elif self.backend_name == "local":
+            self.model = model or os.getenv("LOCAL_EMBEDDING_MODEL", DEFAULT_LOCAL_MODEL)
+            self.backend = LocalEmbeddingBackend(
+                self.model,
+                device=device or os.getenv("LOCAL_EMBEDDING_DEVICE", "cpu"),
+                max_batch_size=max_batch_size or int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", "32")),
+                max_latency_ms=max_latency_ms if max_latency_ms is not None else float(os.getenv("LOCAL_EMBEDDING_MAX_LATENCY_MS", "5"))
+            )
+        elif self.backend_name == "hashing":
+            self.backend = HashingEmbeddingBackend(dim or int(os.getenv("HASHING_EMBEDDING_DIM", str(DEFAULT_HASHING_DIM))))
+            self.model = self.backend.name
+        else:
+            raise ValueError(f"EMBEDDING_BACKEND không hợp lệ: {self.backend_name} (openai / local / hashing)")
+
+    @property
+    def name(self) -> str:
+        """Định danh model + backend, dùng làm key cache / content hash (đổi backend -> embed lại)."""
+        return self.backend.name
+
+    def embed_batch(self, texts: list, timeout: float = None) -> list:
+        """timeout (giây): giới hạn thời gian chờ backend, hết hạn -> TimeoutError / APITimeoutError."""
+        return self.backend.embed_batch(list(texts), timeout=timeout)
+
+    async def aembed_batch(self, texts: list) -> list:
+        return await self.backend.aembed_batch(list(texts))
+
+    def warmup(self):
+        """Load trước model (backend local) để request đầu tiên không chịu thời gian load."""
+        warmup = getattr(self.backend, "warmup", None)
+        if warmup is not None:
+            warmup()
 
     def get_embedding(self, text):
         if isinstance(text, list):
             text = " ".join(text)
         if not text.strip():
             return []
-        embedding = self.embeddingModel.encode(text, convert_to_tensor=True)
-        return embedding.tolist()
-
+        return self.embed_batch([text])[0]
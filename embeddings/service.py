@@ -0,0 +1,230 @@
+import os
+import re
+import asyncio
+import sqlite3
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from embeddings.core import EmbeddingModel
+from metrics import CACHE_LOOKUPS, UPSTREAM_ERRORS
+from admission import AdmissionRejected
+from resources import abandon, reinit_after_fork
+
+def normalize_text(text: str) -> str:
+    """Cache key của text: Unicode NFC, lowercase, gộp khoảng trắng (text gửi đi embed vẫn là text gốc)."""
+    text = unicodedata.normalize("NFC", text or "")
+    return re.sub(r"\s+", " ", text.lower()).strip()
+
+
+def _timeout(deadline):
+    """Thời gian còn lại của deadline cho call engine (None: không giới hạn); đã hết hạn thì không gọi engine."""
+    if deadline is None:
+        return None
+    if deadline.expired:
+        raise AdmissionRejected("deadline", "Hết deadline trước khi embed")
+    return deadline.remaining()
+
+
+def _deadline_error(error: Exception) -> Exception:
+    # TimeoutError: backend local (Future.result) / asyncio.wait_for hết thời gian chờ
+    if isinstance(error, TimeoutError):
+        rejected = AdmissionRejected("deadline", "Embed vượt deadline của request")
+        rejected.__cause__ = error
+        return rejected
+    return error
+
+
+class EmbeddingService:
+    """
+    Service embedding dùng chung cho mọi call site (agent, rag_test, product_tool).
+    Cache 2 tầng theo key (model, normalized text), model nhận text gốc (giống lúc ingest):
+    - Tầng 1: LRU trong process.
+    - Tầng 2: SQLite trên đĩa (WAL), sống qua restart và dùng chung giữa các worker process.
+      Mỗi thread 1 connection; lock chỉ bảo vệ LRU trong RAM, không giữ trong lúc đọc / ghi SQLite.
+    Miss mới gọi engine (EmbeddingModel: openai / local / hashing), nhiều text miss được embed trong 1 batch.
+    `client` là EmbeddingModel, hoặc OpenAI client (+ `model`, `async_client`) để dùng backend openai.
+    """
+    def __init__(self, client, model: str = None, cache_path: str = None, max_memory_items: int = 10000, async_client=None):
+        if isinstance(client, EmbeddingModel):
+            self.engine = client
+        else:
+            self.engine = EmbeddingModel(model=model, backend="openai", client=client, async_client=async_client)
+        # Key cache theo tên engine ("text-embedding-3-small", "local:<model>", "hashing:<dim>")
+        self.model = self.engine.name
+        # Namespace trong SQLite: vector cũ (embed từ text đã lowercase) không được dùng lại
+        self._cache_model = self.model + "#raw"
+        self.max_memory_items = max_memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        self.cache_path = cache_path
+        self._local = threading.local()
+        self._conns = []   # connection của mọi thread (bỏ hết sau fork)
+        if cache_path:
+            directory = os.path.dirname(cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = self._db()
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS embeddings (
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    PRIMARY KEY (model, text)
+                )
+            """)
+            conn.commit()
+        reinit_after_fork(self)
+
+    def _db(self):
+        """Connection SQLite của thread hiện tại (mở ở lần dùng đầu tiên)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.cache_path, check_same_thread=False, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._lock:
+                self._conns.append(conn)
+        return conn
+
+    def _reopen(self):
+        """Sau fork: lock + connection SQLite mới cho process con; LRU trong RAM giữ nguyên (copy-on-write)."""
+        abandon(*self._conns)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._conns = []
+
+    def warmup(self, open_stores: bool = True):
+        """Load trước model của engine (backend local). Cache SQLite luôn được mở lại sau fork nên bỏ qua open_stores."""
+        self.engine.warmup()
+
+    def embed(self, text: str, deadline=None) -> list:
+        return self.embed_batch([text], deadline=deadline)[0]
+
+    def embed_batch(self, texts: list, return_exceptions: bool = False, deadline=None) -> list:
+        """
+        Embed nhiều text, giữ đúng thứ tự input. Text rỗng -> [].
+        return_exceptions: batch lỗi thì embed lại từng text; text vẫn lỗi nhận exception ở vị trí của nó
+        thay vì làm hỏng cả batch (giống asyncio.gather).
+        deadline (admission.Deadline): chỉ chờ engine trong thời gian còn lại, hết hạn -> AdmissionRejected("deadline").
+        """
+        keys, found, missing = self._lookup(texts)
+        if missing:
+            timeout = _timeout(deadline)
+            try:
+                vectors = self.engine.embed_batch(list(missing.values()), timeout=timeout)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(service="embedding", error=type(e).__name__)
+                e = _deadline_error(e)
+                if not return_exceptions:
+                    raise e
+                if len(missing) == 1:
+                    return [e if k in missing else found[k] for k in keys]
+                # Batch lỗi: embed lại từng text để cô lập text gây lỗi
+                return [self.embed_batch([text], return_exceptions=True, deadline=deadline)[0] for text in texts]
+            self._store_missing(found, missing, vectors)
+        return [found[k] for k in keys]
+
+    async def aembed(self, text: str, deadline=None) -> list:
+        return (await self.aembed_batch([text], deadline=deadline))[0]
+
+    async def aembed_batch(self, texts: list, return_exceptions: bool = False, deadline=None) -> list:
+        """Như embed_batch; đọc / ghi cache SQLite chạy trong thread pool, không chặn event loop."""
+        keys, found, missing = await self._in_thread(self._lookup, texts)
+        if missing:
+            timeout = _timeout(deadline)
+            try:
+                vectors = await asyncio.wait_for(self.engine.aembed_batch(list(missing.values())), timeout=timeout)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(service="embedding", error=type(e).__name__)
+                e = _deadline_error(e)
+                if not return_exceptions:
+                    raise e
+                if len(missing) == 1:
+                    return [e if k in missing else found[k] for k in keys]
+                # Batch lỗi: embed lại từng text để cô lập text gây lỗi
+                return [(await self.aembed_batch([text], return_exceptions=True, deadline=deadline))[0] for text in texts]
+            await self._in_thread(self._store_missing, found, missing, vectors)
+        return [found[k] for k in keys]
+
+    async def _in_thread(self, fn, *args):
+        # Không có cache đĩa: chỉ LRU trong RAM, gọi trực tiếp (khỏi tốn 1 lần chuyển thread)
+        if not self.cache_path:
+            return fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    def _lookup(self, texts):
+        """keys (cache key theo thứ tự input), found {key: vector}, missing {key: text gốc đầu tiên cần embed}."""
+        keys = [normalize_text(t) for t in texts]
+        found = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in found or key in missing:
+                continue
+            if not key:
+                found[key] = []
+                continue
+            vector = self._get_cached(key)
+            if vector is None:
+                missing[key] = text
+            else:
+                found[key] = vector
+        return keys, found, missing
+
+    def _store_missing(self, found, missing, vectors):
+        self._put_cached(dict(zip(missing, vectors)))
+        found.update(zip(missing, vectors))
+        with self._lock:
+            self._counters["misses"] += len(missing)
+        CACHE_LOOKUPS.inc(len(missing), cache="embedding", result="miss")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._counters)
+            stats["memory_items"] = len(self._memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _get_cached(self, key):
+        with self._lock:
+            vector = self._memory.get(key)
+            if vector is not None:
+                self._memory.move_to_end(key)
+                self._counters["memory_hits"] += 1
+        if vector is not None:
+            CACHE_LOOKUPS.inc(cache="embedding", result="memory_hit")
+            return vector
+        if not self.cache_path:
+            return None
+        row = self._db().execute(
+            "SELECT vector FROM embeddings WHERE model = ? AND text = ?", (self._cache_model, key)
+        ).fetchone()
+        if row is None:
+            return None
+        vector = array("f", row[0]).tolist()
+        with self._lock:
+            self._counters["disk_hits"] += 1
+            self._remember(key, vector)
+        CACHE_LOOKUPS.inc(cache="embedding", result="disk_hit")
+        return vector
+
+    def _put_cached(self, items: dict):
+        with self._lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+        if self.cache_path:
+            conn = self._db()
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, text, vector) VALUES (?, ?, ?)",
+                [(self._cache_model, key, array("f", vector).tobytes()) for key, vector in items.items()]
+            )
+            conn.commit()
+
+    def _remember(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
@@ -0,0 +1,30 @@
+import os
+
+# Chạy:
+#   gunicorn app:app -c gunicorn.conf.py                                        (Flask, worker gthread)
+#   gunicorn asgi:app -c gunicorn.conf.py -k uvicorn.workers.UvicornWorker     (Starlette)
+# Preload (mặc định bật): master import app + warmup phần an toàn trước fork (index, model, tokenizer, import chromadb)
+# 1 lần rồi fork worker -> worker dùng chung trang nhớ của index memory-map / model (copy-on-write) và chỉ còn
+# mở store của mình (collection Chroma). Connection SQLite / HTTP pool được mở lại trong worker (resources.reinit_after_fork).
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('PORT', '5001')}")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") != "0"
+
+
+def when_ready(server):
+    # Master (preload): app đã được import, warmup trước khi fork worker đầu tiên
+    if preload_app:
+        import app
+        app.warmup(open_stores=False)
+
+def post_fork(server, worker):
+    server.log.info("Worker %s: resource kế thừa từ master được mở lại khi dùng", worker.pid)
+
+def post_worker_init(worker):
+    # Worker mở store của mình trước khi nhận request (preload: index / model đã có sẵn từ master)
+    import app
+    app.warmup()
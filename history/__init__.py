@@ -0,0 +1,3 @@
+from history.core import SQLiteHistoryStore, SQLiteSummaryStore, ChromaHistoryStore, migrate_chroma_history
+from history.writer import WriteBehindHistoryStore
+from history.retention import HistoryRetention, ArchiveFallbackHistoryStore
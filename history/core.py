@@ -0,0 +1,261 @@
+import os
+import json
+import uuid
+import time
+import sqlite3
+import threading
+from datetime import datetime
+from resources import abandon, reinit_after_fork
+
+def _connect(path: str):
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+
+class SQLiteHistoryStore:
+    """
+    Lưu chat history theo session trong SQLite.
+    - Mỗi message là 1 dòng, `id` tăng dần nên thứ tự các turn luôn được giữ.
+    - Index (session_id, id) cho phép đọc "N turn cuối" mà không quét toàn bộ bảng.
+    - Đọc (recent / between) dùng connection riêng: WAL cho phép đọc song song với transaction đang ghi,
+      request không phải chờ group commit của WriteBehindHistoryStore.
+    """
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                session_id TEXT NOT NULL,
+                type TEXT NOT NULL,
+                content TEXT NOT NULL,
+                enhanced_content TEXT,
+                created_at REAL NOT NULL,
+                legacy_id TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_messages_session ON messages(session_id, id);
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_legacy ON messages(legacy_id);
+        """)
+        self._conn.commit()
+        self._read_lock = threading.Lock()
+        self._read_conn = _connect(path)
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        """Sau fork: connection riêng cho process con (connection SQLite không dùng chung qua fork được)."""
+        abandon(self._conn)
+        abandon(self._read_conn)
+        self._lock = threading.Lock()
+        self._conn = _connect(self.path)
+        self._read_lock = threading.Lock()
+        self._read_conn = _connect(self.path)
+
+    def append(self, session_id: str, msg_type: str, content: str, enhanced_content: str = None, legacy_id: str = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO messages (session_id, type, content, enhanced_content, created_at, legacy_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (session_id, msg_type, content or "", enhanced_content, time.time(), legacy_id)
+            )
+            self._conn.commit()
+
+    def append_many(self, records: list):
+        """Ghi nhiều message (của nhiều session) trong 1 transaction; record như tham số của append (+ created_at)."""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO messages (session_id, type, content, enhanced_content, created_at, legacy_id) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (r["session_id"], r["type"], r.get("content") or "", r.get("enhanced_content"),
+                     r.get("created_at") or now, r.get("legacy_id"))
+                    for r in records
+                ]
+            )
+            self._conn.commit()
+
+    def recent(self, session_id: str, limit: int = None):
+        """Trả về `limit` message cuối của session (cũ -> mới). limit=None: toàn bộ."""
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                "SELECT id, type, content, enhanced_content FROM messages "
+                "WHERE session_id = ? ORDER BY id DESC LIMIT ?",
+                (session_id, -1 if limit is None else int(limit))
+            ).fetchall()
+        return [
+            {"id": r[0], "type": r[1], "content": r[2], "enhanced_content": r[3]}
+            for r in reversed(rows)
+        ]
+
+    def between(self, session_id: str, after_id: int, before_id: int):
+        """Các message có after_id < id < before_id của session (cũ -> mới), dùng để cập nhật summary."""
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                "SELECT id, type, content, enhanced_content FROM messages "
+                "WHERE session_id = ? AND id > ? AND id < ? ORDER BY id",
+                (session_id, int(after_id), int(before_id))
+            ).fetchall()
+        return [{"id": r[0], "type": r[1], "content": r[2], "enhanced_content": r[3]} for r in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+        with self._read_lock:
+            self._read_conn.close()
+
+
+class SQLiteSummaryStore:
+    """
+    Summary cuốn chiếu của từng session: nội dung tóm tắt các message có id <= last_message_id.
+    Có thể dùng chung file SQLite với SQLiteHistoryStore.
+    """
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = _connect(path)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS session_summaries (
+                session_id TEXT PRIMARY KEY,
+                summary TEXT NOT NULL,
+                last_message_id INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.commit()
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        """Sau fork: mở connection mới (như SQLiteHistoryStore._reopen)."""
+        abandon(self._conn)
+        self._lock = threading.Lock()
+        self._conn = _connect(self.path)
+
+    def get(self, session_id: str):
+        """Trả về (summary, last_message_id); session chưa có summary -> ("", 0)."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT summary, last_message_id FROM session_summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    def put(self, session_id: str, summary: str, last_message_id: int):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO session_summaries (session_id, summary, last_message_id, updated_at) "
+                "VALUES (?, ?, ?, ?)",
+                (session_id, summary, int(last_message_id), time.time())
+            )
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ChromaHistoryStore:
+    """
+    Backend cũ: mỗi message là 1 JSON document trong collection Chroma.
+    Chỉ giữ lại để tương thích / migrate, vì đọc history phải quét `$contains` toàn collection.
+    """
+    def __init__(self, collection):
+        self.collection = collection
+
+    def append(self, session_id: str, msg_type: str, content: str, enhanced_content: str = None, legacy_id: str = None):
+        self.append_many([{
+            "session_id": session_id, "type": msg_type, "content": content,
+            "enhanced_content": enhanced_content, "legacy_id": legacy_id
+        }])
+
+    def append_many(self, records: list):
+        ids, documents = [], []
+        for r in records:
+            data = {"type": r["type"], "content": r.get("content")}
+            if r.get("enhanced_content") is not None:
+                data["enhanced_content"] = r["enhanced_content"]
+            ids.append(r.get("legacy_id") or str(uuid.uuid4()))
+            documents.append(json.dumps({"SessionId": r["session_id"], "History": {"type": r["type"], "data": data}}))
+        if ids:
+            self.collection.add(ids=ids, documents=documents)
+
+    def recent(self, session_id: str, limit: int = None):
+        session_messages = self.collection.get(where_document={"$contains": session_id})
+        result = []
+        for doc_id, doc in zip(session_messages.get("ids") or [], session_messages.get("documents") or []):
+            parsed = json.loads(doc)
+            if parsed.get("SessionId") != session_id:
+                continue
+            hist = parsed.get("History", {})
+            data = hist.get("data", {})
+            result.append({
+                "id": doc_id,
+                "type": hist.get("type", "human"),
+                "content": data.get("content", ""),
+                "enhanced_content": data.get("enhanced_content")
+            })
+        return result if limit is None else result[-limit:]
+
+
+def _legacy_created_at(metadata):
+    """Thời điểm gốc của message trong metadata Chroma (epoch hoặc chuỗi ISO), không có -> None."""
+    for key in ("created_at", "timestamp"):
+        value = (metadata or {}).get(key)
+        if value is None or value == "":
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+        try:
+            return datetime.fromisoformat(str(value)).timestamp()
+        except ValueError:
+            continue
+    return None
+
+
+def migrate_chroma_history(collection, store, batch_size: int = 500):
+    """
+    Copy toàn bộ history từ collection Chroma cũ sang `store`.
+    - Giữ thứ tự Chroma trả về (thứ tự insert).
+    - Mỗi trang ghi bằng append_many theo từng session (1 transaction / session thay vì 1 / message).
+    - Giữ `created_at` gốc nếu metadata Chroma có; không có thì lấy thời điểm migrate.
+    - Dùng id Chroma làm `legacy_id` nên chạy lại nhiều lần không bị nhân đôi.
+    Trả về số message đã đọc.
+    """
+    offset = 0
+    migrated = 0
+    while True:
+        page = collection.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+        ids = page.get("ids") or []
+        if not ids:
+            break
+        sessions = {}
+        for doc_id, doc, metadata in zip(ids, page.get("documents") or [], page.get("metadatas") or [None] * len(ids)):
+            try:
+                parsed = json.loads(doc)
+            except (TypeError, ValueError):
+                continue
+            hist = parsed.get("History", {})
+            data = hist.get("data", {})
+            session_id = parsed.get("SessionId", "")
+            sessions.setdefault(session_id, []).append({
+                "session_id": session_id,
+                "type": hist.get("type", "human"),
+                "content": data.get("content", ""),
+                "enhanced_content": data.get("enhanced_content"),
+                "created_at": _legacy_created_at(metadata),
+                "legacy_id": doc_id
+            })
+        for records in sessions.values():
+            store.append_many(records)
+            migrated += len(records)
+        offset += len(ids)
+    return migrated
@@ -0,0 +1,21 @@
+import os
+import chromadb
+from dotenv import load_dotenv
+from history.core import SQLiteHistoryStore, migrate_chroma_history
+
+# Chạy: python -m history.migrate
+# Copy chat history từ collection Chroma cũ sang SQLite (chạy lại nhiều lần vẫn an toàn).
+
+load_dotenv()
+
+DB_PATH = "VECTOR_STORE"
+DB_CHAT_HISTORY_COLLECTION = os.getenv("DB_CHAT_HISTORY_COLLECTION") or "chat_history"
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH") or os.path.join(DB_PATH, "chat_history.sqlite3")
+
+if __name__ == "__main__":
+    client = chromadb.PersistentClient(path=DB_PATH)
+    collection = client.get_or_create_collection(name=DB_CHAT_HISTORY_COLLECTION)
+    store = SQLiteHistoryStore(HISTORY_DB_PATH)
+    count = migrate_chroma_history(collection, store)
+    store.close()
+    print(f"✅ Migrated {count} messages from '{DB_CHAT_HISTORY_COLLECTION}' to {HISTORY_DB_PATH}")
@@ -0,0 +1,386 @@
+import os
+import gzip
+import json
+import time
+import random
+import logging
+import sqlite3
+import argparse
+import threading
+from collections import OrderedDict
+from history.core import _connect
+from resources import abandon, reinit_after_fork
+from metrics import HISTORY_ARCHIVED, HISTORY_RECLAIMED_BYTES
+
+logger = logging.getLogger(__name__)
+
+# Chạy 1 lần (cron) hoặc xem lại 1 session đã archive:
+#   python -m history.retention [--max-turns 500] [--ttl-days 30]
+#   python -m history.retention --load <session_id>
+# app.py chạy job này nền trong mỗi worker khi HISTORY_RETENTION_INTERVAL_S > 0;
+# ArchiveFallbackHistoryStore đọc lại archive khi session quay lại (history + summary trong prompt không bị mất).
+
+class HistoryRetention:
+    """
+    Retention cho SQLiteHistoryStore (cùng file SQLite):
+    - Session không có message mới trong `session_ttl` giây -> chuyển toàn bộ message (+ summary) sang archive.
+    - Session vượt `max_turns` turn (human + ai) -> các message cũ nhất vượt cap chuyển sang archive.
+    Archive: segment `segment-NNNNNN.jsonl.gz` append-only trong `archive_dir`; mỗi lần archive 1 session là
+    1 gzip member (1 dòng JSON) -> đọc lại đúng đoạn bytes đó theo bảng `archived_sessions` (session -> segment,
+    offset, length) trong file SQLite history.
+    Segment được fsync trước khi commit transaction xoá message: lỗi giữa chừng chỉ để lại bytes thừa trong segment,
+    không mất message. BEGIN IMMEDIATE: nhiều worker cùng chạy job thì chỉ 1 worker archive 1 session.
+    """
+    def __init__(self, path: str, archive_dir: str = None, max_turns: int = 500, session_ttl: float = 30 * 86400,
+                 interval: float = 3600, segment_max_bytes: int = 64 * 1024 * 1024, batch_sessions: int = 200,
+                 vacuum_threshold: float = 0.2, max_loaded_sessions: int = 256):
+        """
+        max_turns / session_ttl: None hoặc <= 0 để tắt điều kiện tương ứng.
+        interval: chu kỳ (giây) của job nền, xem start().
+        vacuum_threshold: VACUUM khi tỉ lệ page trống của file SQLite >= ngưỡng này (file mới thật sự nhỏ lại).
+        max_loaded_sessions: số session đã giải nén giữ trong RAM (LRU) cho đường đọc recent().
+        """
+        self.path = path
+        self.archive_dir = archive_dir or path + ".archive"
+        self.max_turns = max_turns
+        self.session_ttl = session_ttl
+        self.interval = interval
+        self.segment_max_bytes = segment_max_bytes
+        self.batch_sessions = batch_sessions
+        self.vacuum_threshold = vacuum_threshold
+        self.max_loaded_sessions = max_loaded_sessions
+        os.makedirs(self.archive_dir, exist_ok=True)
+        self._stop = threading.Event()
+        self._reopen()
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS archived_sessions (
+                session_id TEXT NOT NULL,
+                segment TEXT NOT NULL,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                messages INTEGER NOT NULL,
+                reason TEXT NOT NULL,
+                archived_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS idx_archived_session ON archived_sessions(session_id);
+        """)
+        self._conn.commit()
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        """Sau fork: connection riêng; job nền của process cha (nếu có) được start lại trong worker."""
+        if getattr(self, "_conn", None) is not None:
+            abandon(self._conn)
+            abandon(self._read_conn)
+        self._lock = threading.Lock()
+        self._conn = _connect(self.path)
+        # Đường đọc (request) dùng connection riêng: không phải chờ job compaction đang giữ _lock
+        self._read_lock = threading.Lock()
+        self._read_conn = _connect(self.path)
+        self._loaded = OrderedDict()   # session_id -> (số lần archive, messages)
+        running = getattr(self, "_worker", None) is not None
+        self._worker = None
+        if running and not self._stop.is_set():
+            self.start()
+
+    # ------------------- Compaction -------------------
+    def run_once(self, now: float = None) -> dict:
+        """Archive session hết hạn / phần vượt cap rồi thu hồi dung lượng file SQLite. Trả về báo cáo."""
+        started = time.perf_counter()
+        now = now or time.time()
+        report = {
+            "sessions_expired": 0, "sessions_trimmed": 0, "messages_archived": 0, "archive_bytes": 0,
+            "db_bytes_before": self.db_bytes(), "db_bytes_after": 0, "bytes_reclaimed": 0, "vacuumed": False
+        }
+        with self._lock:
+            while self._compact_batch(now, report) >= self.batch_sessions:
+                pass
+            report["vacuumed"] = self._reclaim()
+        report["db_bytes_after"] = self.db_bytes()
+        report["bytes_reclaimed"] = max(0, report["db_bytes_before"] - report["db_bytes_after"])
+        report["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        HISTORY_RECLAIMED_BYTES.inc(report["bytes_reclaimed"])
+        if report["messages_archived"] or report["vacuumed"]:
+            logger.info("History retention: %s", report)
+        return report
+
+    def _compact_batch(self, now: float, report: dict) -> int:
+        """1 transaction: tối đa batch_sessions session. Trả về số session đã xử lý."""
+        keep = self.max_turns * 2 if self.max_turns and self.max_turns > 0 else None
+        cutoff = now - self.session_ttl if self.session_ttl and self.session_ttl > 0 else None
+        if keep is None and cutoff is None:
+            return 0
+
+        conn = self._conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            sessions = conn.execute(
+                "SELECT session_id, COUNT(*) FROM messages GROUP BY session_id "
+                "HAVING MAX(created_at) < ? OR COUNT(*) > ? LIMIT ?",
+                (cutoff if cutoff is not None else float("-inf"), keep if keep is not None else 2 ** 62, self.batch_sessions)
+            ).fetchall()
+            if not sessions:
+                conn.rollback()
+                return 0
+
+            entries = []
+            for session_id, count in sessions:
+                expired = cutoff is not None and conn.execute(
+                    "SELECT MAX(created_at) FROM messages WHERE session_id = ?", (session_id,)
+                ).fetchone()[0] < cutoff
+                limit = -1 if expired else count - keep
+                rows = conn.execute(
+                    "SELECT id, type, content, enhanced_content, created_at FROM messages "
+                    "WHERE session_id = ? ORDER BY id LIMIT ?",
+                    (session_id, limit)
+                ).fetchall()
+                record = {
+                    "session_id": session_id,
+                    "reason": "ttl" if expired else "cap",
+                    "archived_at": now,
+                    "messages": [
+                        {"id": r[0], "type": r[1], "content": r[2], "enhanced_content": r[3], "created_at": r[4]}
+                        for r in rows
+                    ]
+                }
+                if expired:
+                    record["summary"] = self._summary(session_id)
+                entries.append(record)
+
+            for record, (segment, offset, length) in zip(entries, self._write_segment(entries)):
+                session_id, reason = record["session_id"], record["reason"]
+                conn.execute(
+                    "INSERT INTO archived_sessions (session_id, segment, offset, length, messages, reason, archived_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (session_id, segment, offset, length, len(record["messages"]), reason, now)
+                )
+                conn.execute(
+                    "DELETE FROM messages WHERE session_id = ? AND id <= ?",
+                    (session_id, record["messages"][-1]["id"])
+                )
+                if reason == "ttl" and record.get("summary") is not None:
+                    conn.execute("DELETE FROM session_summaries WHERE session_id = ?", (session_id,))
+                report["sessions_expired" if reason == "ttl" else "sessions_trimmed"] += 1
+                report["messages_archived"] += len(record["messages"])
+                report["archive_bytes"] += length
+                HISTORY_ARCHIVED.inc(len(record["messages"]), reason=reason)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        return len(sessions)
+
+    def _summary(self, session_id: str):
+        """Summary cuốn chiếu (SQLiteSummaryStore, cùng file) của session, None nếu không có bảng / summary."""
+        try:
+            row = self._conn.execute(
+                "SELECT summary, last_message_id FROM session_summaries WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        except Exception:
+            return None
+        return {"summary": row[0], "last_message_id": row[1]} if row else None
+
+    def _write_segment(self, entries: list) -> list:
+        """Append mỗi entry thành 1 gzip member vào segment hiện tại (fsync). Trả về [(segment, offset, length)]."""
+        segment = self._current_segment()
+        locations = []
+        with open(os.path.join(self.archive_dir, segment), "ab") as f:
+            offset = f.tell()
+            for record in entries:
+                data = gzip.compress((json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8"))
+                f.write(data)
+                locations.append((segment, offset, len(data)))
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        return locations
+
+    def _current_segment(self) -> str:
+        segments = sorted(name for name in os.listdir(self.archive_dir) if name.startswith("segment-") and name.endswith(".jsonl.gz"))
+        if segments and os.path.getsize(os.path.join(self.archive_dir, segments[-1])) < self.segment_max_bytes:
+            return segments[-1]
+        number = int(segments[-1][len("segment-"):-len(".jsonl.gz")]) + 1 if segments else 1
+        return f"segment-{number:06d}.jsonl.gz"
+
+    def _reclaim(self) -> bool:
+        """Checkpoint WAL; VACUUM nếu đủ nhiều page trống. Trả về True nếu đã VACUUM."""
+        conn = self._conn
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not pages or free / pages < self.vacuum_threshold:
+            return False
+        try:
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except Exception:
+            # Worker khác đang đọc / ghi: page trống vẫn được dùng lại, lần sau thử VACUUM tiếp
+            logger.warning("VACUUM history thất bại, bỏ qua lần này", exc_info=True)
+            return False
+        return True
+
+    def db_bytes(self) -> int:
+        return sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p))
+
+    # ------------------- Đọc archive -------------------
+    def load_session(self, session_id: str) -> dict:
+        """
+        Toàn bộ message đã archive của session (cũ -> mới, cùng dạng row với store.recent + created_at)
+        và summary lúc hết hạn (None nếu không có). Chỉ đọc đúng các gzip member của session.
+        """
+        with self._read_lock:
+            locations = self._read_conn.execute(
+                "SELECT segment, offset, length FROM archived_sessions WHERE session_id = ? ORDER BY archived_at, rowid",
+                (session_id,)
+            ).fetchall()
+        return self._load(locations)
+
+    def _load(self, locations: list) -> dict:
+        messages, summary = {}, None
+        for segment, offset, length in locations:
+            with open(os.path.join(self.archive_dir, segment), "rb") as f:
+                f.seek(offset)
+                record = json.loads(gzip.decompress(f.read(length)))
+            for message in record["messages"]:
+                messages[message["id"]] = message
+            summary = record.get("summary") or summary
+        return {"messages": [messages[i] for i in sorted(messages)], "summary": summary}
+
+    def recent(self, session_id: str, limit: int = None) -> list:
+        """
+        `limit` message archive mới nhất của session (cũ -> mới, cùng dạng row với store.recent), [] nếu không có.
+        Session đã giải nén được giữ trong LRU, giải nén lại khi session có thêm lần archive; mỗi lần giải nén thì
+        summary lúc hết hạn được ghi lại vào session_summaries (xem restore_summary).
+        """
+        if limit is not None and limit <= 0:
+            return []
+        with self._read_lock:
+            locations = self._read_conn.execute(
+                "SELECT segment, offset, length FROM archived_sessions WHERE session_id = ? ORDER BY archived_at, rowid",
+                (session_id,)
+            ).fetchall()
+            cached = self._loaded.get(session_id)
+            if cached is not None and cached[0] == len(locations):
+                self._loaded.move_to_end(session_id)
+                messages = cached[1]
+            else:
+                messages = None
+        if not locations:
+            return []
+        if messages is None:
+            archived = self._load(locations)
+            self.restore_summary(session_id, archived["summary"])
+            messages = [
+                {"id": m["id"], "type": m["type"], "content": m["content"], "enhanced_content": m.get("enhanced_content")}
+                for m in archived["messages"]
+            ]
+            with self._read_lock:
+                self._loaded[session_id] = (len(locations), messages)
+                self._loaded.move_to_end(session_id)
+                while len(self._loaded) > self.max_loaded_sessions:
+                    self._loaded.popitem(last=False)
+        return list(messages if limit is None else messages[-limit:])
+
+    def restore_summary(self, session_id: str, summary: dict) -> bool:
+        """
+        Ghi summary đã archive (TTL) trở lại session_summaries để ContextBuilder dùng tiếp.
+        Không ghi đè summary session đã có (mới hơn). Trả về True nếu đã ghi.
+        """
+        if not summary:
+            return False
+        try:
+            with self._read_lock:
+                cursor = self._read_conn.execute(
+                    "INSERT OR IGNORE INTO session_summaries (session_id, summary, last_message_id, updated_at) "
+                    "VALUES (?, ?, ?, ?)",
+                    (session_id, summary["summary"], int(summary["last_message_id"]), time.time())
+                )
+                self._read_conn.commit()
+        except sqlite3.OperationalError:
+            # Không dùng SQLiteSummaryStore (không có bảng) -> không có gì để khôi phục
+            return False
+        return cursor.rowcount > 0
+
+    # ------------------- Job nền -------------------
+    def start(self):
+        """Chạy run_once mỗi `interval` giây (lệch ngẫu nhiên để các worker không cùng lúc) trong thread nền."""
+        if self._worker is not None or not self.interval or self.interval <= 0:
+            return
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._run, name="history-retention", daemon=True)
+        self._worker.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval * random.uniform(0.5, 1.0)):
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("History retention thất bại")
+
+    def close(self):
+        self._stop.set()
+        worker, self._worker = self._worker, None
+        if worker is not None:
+            worker.join()
+        with self._lock:
+            self._conn.close()
+        with self._read_lock:
+            self._read_conn.close()
+
+
+class ArchiveFallbackHistoryStore:
+    """
+    Bọc history store (SQLiteHistoryStore): recent() ghép thêm message đã archive (HistoryRetention) khi phần còn
+    trong store chưa đủ `limit` -> session hết hạn (TTL) quay lại vẫn có history trong prompt, summary cuốn chiếu
+    của session cũng được khôi phục (HistoryRetention.restore_summary).
+    Session còn đủ message trong store (vd bị cắt theo max_turns) không phải đọc archive.
+    between() cũng gồm message đã archive, để summary được cập nhật tiếp từ đúng chỗ đã dừng.
+    """
+    def __init__(self, store, retention: HistoryRetention):
+        self.store = store
+        self.retention = retention
+
+    def __getattr__(self, name):
+        # append / append_many / between / close / path ... của store gốc
+        return getattr(self.store, name)
+
+    def recent(self, session_id: str, limit: int = None):
+        rows = self.store.recent(session_id, limit)
+        if limit is not None and len(rows) >= limit:
+            return rows
+        try:
+            older = self.retention.recent(session_id, None if limit is None else limit - len(rows))
+        except Exception:
+            logger.exception("Đọc archive history của session %s thất bại", session_id)
+            return rows
+        return older + rows
+
+    def between(self, session_id: str, after_id: int, before_id: int):
+        rows = self.store.between(session_id, after_id, before_id)
+        try:
+            archived = self.retention.recent(session_id)
+        except Exception:
+            logger.exception("Đọc archive history của session %s thất bại", session_id)
+            return rows
+        older = [row for row in archived if after_id < row["id"] < before_id and (not rows or row["id"] < rows[0]["id"])]
+        return older + rows
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    load_dotenv()
+    db_path = os.getenv("HISTORY_DB_PATH") or os.path.join("VECTOR_STORE", "chat_history.sqlite3")
+    parser = argparse.ArgumentParser(description="Archive / thu hồi dung lượng chat history")
+    parser.add_argument("--max-turns", type=int, default=int(os.getenv("HISTORY_MAX_TURNS", "500")))
+    parser.add_argument("--ttl-days", type=float, default=float(os.getenv("HISTORY_SESSION_TTL_DAYS", "30")))
+    parser.add_argument("--archive-dir", default=os.getenv("HISTORY_ARCHIVE_DIR") or os.path.join("VECTOR_STORE", "chat_history_archive"))
+    parser.add_argument("--load", metavar="SESSION_ID", help="In các message đã archive của session")
+    args = parser.parse_args()
+
+    retention = HistoryRetention(db_path, archive_dir=args.archive_dir, max_turns=args.max_turns,
+                                 session_ttl=args.ttl_days * 86400, interval=0)
+    if args.load:
+        print(json.dumps(retention.load_session(args.load), ensure_ascii=False, indent=2))
+    else:
+        print(json.dumps(retention.run_once(), ensure_ascii=False, indent=2))
+    retention.close()
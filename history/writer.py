@@ -0,0 +1,177 @@
+import time
+import atexit
+import logging
+import threading
+from resources import reinit_after_fork
+from metrics import HISTORY_WRITES
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindHistoryStore:
+    """
+    Bọc 1 history store (SQLiteHistoryStore / ChromaHistoryStore): append chỉ đưa message vào hàng đợi trong RAM,
+    1 thread nền gom message của mọi session và ghi bằng 1 lần `append_many` (1 transaction).
+    - Flush khi đủ `max_batch` message hoặc message cũ nhất đã chờ `flush_interval` giây.
+    - Tail chưa flush của từng session được ghép vào `recent`, nên turn kế tiếp (cùng process) luôn thấy đủ history.
+    - close() / atexit: ghi hết hàng đợi trước khi thoát.
+    - Hàng đợi vượt `max_pending` (store chậm / lỗi) -> append chờ, không giữ RAM vô hạn.
+    Worker khác (nhiều process) chỉ thấy message sau khi flush, tức chậm tối đa ~flush_interval.
+    """
+    def __init__(self, store, max_batch: int = 256, flush_interval: float = 0.05, max_pending: int = 10000,
+                 retry_seconds: float = 1.0):
+        self.store = store
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_seconds = retry_seconds
+        self._reopen()
+        reinit_after_fork(self)
+        atexit.register(self.close)
+
+    def _reopen(self):
+        # Sau fork: hàng đợi của process cha do process cha ghi, worker bắt đầu rỗng với thread riêng
+        self._cond = threading.Condition()     # hàng đợi / tail: chỉ giữ trong thời gian rất ngắn, không giữ khi ghi store
+        self._queue = []       # record chờ ghi (kể cả batch đang ghi), theo thứ tự append
+        self._tail = {}        # session_id -> [row chưa ghi xong]
+        self._writing = 0      # số record đầu hàng đợi đang được ghi
+        self._writing_sessions = set()   # session có message trong batch đang ghi
+        self._closed = False
+        self._worker = None
+
+    def __getattr__(self, name):
+        # between / path / ... của store gốc (between chỉ đọc phần đã flush: dùng cho summary các message cũ)
+        return getattr(self.store, name)
+
+    def append(self, session_id: str, msg_type: str, content: str, enhanced_content: str = None, legacy_id: str = None):
+        self.append_many([{
+            "session_id": session_id, "type": msg_type, "content": content,
+            "enhanced_content": enhanced_content, "legacy_id": legacy_id
+        }])
+
+    def append_many(self, records: list):
+        """records: [{session_id, type, content, enhanced_content?, legacy_id?}] -> vào hàng đợi, không chờ ghi."""
+        now = time.time()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("WriteBehindHistoryStore đã đóng")
+            self._ensure_worker()
+            while len(self._queue) >= self.max_pending and not self._closed:
+                self._cond.wait()
+            for record in records:
+                record = dict(record, created_at=record.get("created_at") or now)
+                self._queue.append(record)
+                self._tail.setdefault(record["session_id"], []).append(record)
+            if len(self._queue) - self._writing >= self.max_batch:
+                self._cond.notify_all()
+
+    def recent(self, session_id: str, limit: int = None):
+        """
+        Message đã ghi + tail chưa ghi của session (cũ -> mới). Row chưa ghi có id None.
+        Không chờ batch đang ghi, trừ khi batch đó có message của chính session này (chưa biết store đã có hay chưa).
+        """
+        while True:
+            with self._cond:
+                while session_id in self._writing_sessions:
+                    self._cond.wait()
+                pending = list(self._tail.get(session_id, ()))
+            rows = self.store.recent(session_id, limit)
+            with self._cond:
+                # Trong lúc đọc store không có batch nào của session bắt đầu / ghi xong -> tail đã chụp vẫn đúng
+                tail = self._tail.get(session_id, ())
+                unchanged = len(tail) >= len(pending) and all(a is b for a, b in zip(tail, pending))
+                if unchanged and session_id not in self._writing_sessions:
+                    break
+        rows = rows + [
+            {"id": None, "type": r["type"], "content": r["content"], "enhanced_content": r.get("enhanced_content")}
+            for r in pending
+        ]
+        if limit is None:
+            return rows
+        return rows[-limit:] if limit > 0 else []
+
+    def flush(self, timeout: float = None) -> bool:
+        """Chờ tới khi mọi message đã append trước lời gọi này được ghi (hoặc hết timeout)."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._cond.notify_all()
+            while self._queue and (self._worker is not None and self._worker.is_alive()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return not self._queue
+
+    def close(self):
+        """Ghi hết hàng đợi, dừng thread nền rồi đóng store gốc."""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+            worker = self._worker
+        if worker is not None:
+            worker.join()
+        close = getattr(self.store, "close", None)
+        if close is not None:
+            close()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._queue)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._worker.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                # Chờ có record; group commit: chờ thêm tới flush_interval (tính từ record cũ nhất) hoặc đủ batch
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return   # đã close và ghi hết
+                wait_until = self._queue[0]["created_at"] + self.flush_interval
+                while len(self._queue) < self.max_batch and not self._closed:
+                    remaining = wait_until - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self.max_batch]
+                self._writing = len(batch)
+                self._writing_sessions = {record["session_id"] for record in batch}
+
+            try:
+                self._write(batch)
+            except Exception:
+                HISTORY_WRITES.inc(len(batch), result="failed")
+                logger.exception("Ghi %d message history thất bại, thử lại sau %.1fs", len(batch), self.retry_seconds)
+                with self._cond:
+                    self._writing = 0
+                    self._writing_sessions = set()
+                    self._cond.notify_all()
+                    if self._closed:
+                        logger.error("Bỏ %d message history chưa ghi được khi đóng", len(self._queue))
+                        self._queue.clear()
+                        self._tail.clear()
+                        self._cond.notify_all()
+                        return
+                    self._cond.wait(self.retry_seconds)
+                continue
+            HISTORY_WRITES.inc(len(batch), result="flushed")
+
+    def _write(self, batch: list):
+        # Commit không giữ lock nào: append / recent của session khác chạy song song; xong mới bỏ batch khỏi tail
+        self.store.append_many(batch)
+        with self._cond:
+            del self._queue[:len(batch)]
+            self._writing = 0
+            self._writing_sessions = set()
+            for record in batch:
+                rows = self._tail[record["session_id"]]
+                rows.pop(0)
+                if not rows:
+                    del self._tail[record["session_id"]]
+            self._cond.notify_all()
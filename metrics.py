@@ -0,0 +1,256 @@
+import os
+import time
+import uuid
+import asyncio
+import bisect
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# Instrumentation dùng chung: request id (contextvars), span theo stage, counter / histogram xuất ra
+# định dạng text của Prometheus ở /metrics. Số liệu nằm trong process: chạy nhiều worker thì Prometheus
+# scrape từng worker (hoặc gom ở tầng proxy).
+
+logger = logging.getLogger("chatbot")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# ------------------- Counter / Histogram -------------------
+def _label_text(labelnames, labels) -> str:
+    if not labelnames:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for v in labels)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labelnames, escaped)) + "}"
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f"{self.name}{_label_text(self.labelnames, key)} {_format_value(v)}" for key, v in items]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}   # labels -> [số mẫu theo bucket (không cộng dồn)..., +Inf], sum
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((key, list(counts), total) for key, (counts, total) in self._series.items())
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_label_text(self.labelnames + ('le',), key + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{_label_text(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_label_text(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Toàn bộ metric ở định dạng text exposition của Prometheus (0.0.4)."""
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "chatbot_request_duration_seconds", "Thời gian xử lý request theo endpoint.", ("endpoint",)))
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "chatbot_stage_duration_seconds", "Thời gian từng stage của pipeline (history, rewrite, embed, retrieve, llm, record...).", ("stage",)))
+REQUESTS = REGISTRY.register(Counter(
+    "chatbot_requests_total", "Số request theo endpoint và kết quả (answer / cache / fallback / error).", ("endpoint", "outcome")))
+FALLBACKS = REGISTRY.register(Counter(
+    "chatbot_fallbacks_total", "Số lần chuyển sang Reflection theo lý do.", ("reason",)))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "chatbot_cache_lookups_total", "Số lần tra cache theo loại cache và kết quả.", ("cache", "result")))
+HISTORY_WRITES = REGISTRY.register(Counter(
+    "chatbot_history_writes_total", "Số message history ghi nền (write-behind) theo kết quả (flushed / failed).", ("result",)))
+HISTORY_ARCHIVED = REGISTRY.register(Counter(
+    "chatbot_history_archived_messages_total", "Số message history chuyển sang archive theo lý do (ttl / cap).", ("reason",)))
+HISTORY_RECLAIMED_BYTES = REGISTRY.register(Counter(
+    "chatbot_history_reclaimed_bytes_total", "Số byte file SQLite history thu hồi được sau các lần compaction."))
+ADMISSIONS = REGISTRY.register(Counter(
+    "chatbot_admissions_total", "Số lần xin slot gọi LLM theo kết quả (admitted / shed_deadline / shed_queue / timeout).", ("result",)))
+CATALOG_LOAD_SECONDS = REGISTRY.register(Histogram(
+    "chatbot_catalog_load_seconds", "Thời gian load index của 1 catalog (lần dùng đầu tiên / sau khi bị evict).", ("catalog",)))
+CATALOG_EVICTIONS = REGISTRY.register(Counter(
+    "chatbot_catalog_evictions_total", "Số lần catalog bị evict khỏi bộ nhớ (vượt memory budget).", ("catalog",)))
+UPSTREAM_ERRORS = REGISTRY.register(Counter(
+    "chatbot_upstream_errors_total", "Số lỗi khi gọi upstream (LLM / embedding), kể cả lần được retry.", ("service", "error")))
+
+
+# ------------------- Request context -------------------
+class RequestContext:
+    def __init__(self, endpoint: str, request_id: str):
+        self.endpoint = endpoint
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.timings = {}      # stage -> ms (cộng dồn)
+        self.outcome = None
+        self.details = {}      # thông tin thêm cho slow-request log
+
+
+_current = contextvars.ContextVar("chatbot_request", default=None)
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+def current_request() -> RequestContext:
+    return _current.get()
+
+def current_request_id() -> str:
+    ctx = _current.get()
+    return ctx.request_id if ctx else ""
+
+def request_timings() -> dict:
+    """Dict timings của request hiện tại (dict mới nếu đang chạy ngoài request)."""
+    ctx = _current.get()
+    return ctx.timings if ctx else {}
+
+def set_outcome(outcome: str, **details):
+    ctx = _current.get()
+    if ctx is not None:
+        ctx.outcome = outcome
+        ctx.details.update(details)
+
+def annotate(**details):
+    ctx = _current.get()
+    if ctx is not None:
+        ctx.details.update(details)
+
+@contextmanager
+def request_scope(endpoint: str, request_id: str = None):
+    """
+    Gắn request id + timings cho mọi code chạy trong block (kể cả asyncio.to_thread / task con).
+    Kết thúc: ghi histogram latency, counter theo outcome và slow-request log (có sampling).
+    """
+    ctx = RequestContext(endpoint, request_id or new_request_id())
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    except (GeneratorExit, asyncio.CancelledError):
+        ctx.outcome = "cancelled"   # client ngắt kết nối giữa chừng
+        raise
+    except BaseException:
+        ctx.outcome = "error"
+        raise
+    finally:
+        _finish(ctx)
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Generator SSE bị đóng từ context khác -> chỉ cần bỏ giá trị
+            _current.set(None)
+
+
+# ------------------- Span -------------------
+def observe_stage(stage: str, seconds: float, timings: dict = None):
+    """Ghi 1 stage vào histogram và vào timings (mặc định timings của request hiện tại)."""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if timings is None:
+        ctx = _current.get()
+        timings = ctx.timings if ctx else None
+    if timings is not None:
+        timings[stage] = round(timings.get(stage, 0.0) + seconds * 1000, 2)
+
+def lap(timings: dict, stage: str, started: float) -> float:
+    """Ghi stage từ mốc `started` tới hiện tại; trả về mốc thời gian mới cho stage kế tiếp."""
+    now = time.perf_counter()
+    observe_stage(stage, now - started, timings)
+    return now
+
+@contextmanager
+def span(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+# ------------------- Slow-request log -------------------
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "2000"))
+SLOW_REQUEST_SAMPLE_RATE = float(os.getenv("SLOW_REQUEST_SAMPLE_RATE", "1.0"))
+
+def _finish(ctx: RequestContext):
+    elapsed = time.perf_counter() - ctx.started
+    outcome = ctx.outcome or "answer"
+    REQUEST_SECONDS.observe(elapsed, endpoint=ctx.endpoint)
+    REQUESTS.inc(endpoint=ctx.endpoint, outcome=outcome)
+    if elapsed * 1000 >= SLOW_REQUEST_MS and random.random() < SLOW_REQUEST_SAMPLE_RATE:
+        logger.warning(
+            "slow request id=%s endpoint=%s outcome=%s total_ms=%.1f timings=%s details=%s",
+            ctx.request_id, ctx.endpoint, outcome, elapsed * 1000, ctx.timings, ctx.details
+        )
+
+
+# ------------------- Logging -------------------
+class RequestIdFilter(logging.Filter):
+    """Thêm %(request_id)s vào mọi log record."""
+    def filter(self, record):
+        record.request_id = current_request_id() or "-"
+        return True
+
+def configure_logging(level: str = None):
+    """Log ra stderr kèm request id; level mặc định lấy từ env LOG_LEVEL (INFO)."""
+    handler = logging.StreamHandler()
+    handler.addFilter(RequestIdFilter())
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"))
+    root = logging.getLogger()
+    root.handlers = [h for h in root.handlers if not getattr(h, "_chatbot_handler", False)]
+    handler._chatbot_handler = True
+    root.addHandler(handler)
+    root.setLevel((level or os.getenv("LOG_LEVEL", "INFO")).upper())
+    # httpx log mỗi upstream call ở INFO -> chỉ giữ cảnh báo
+    logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -1,16 +1,281 @@
-from openai import OpenAI
+import json
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import httpx
+from openai import OpenAI, AsyncOpenAI, APIConnectionError, APITimeoutError, RateLimitError, InternalServerError
+from metrics import UPSTREAM_ERRORS
+from admission import AdmissionRejected
+from resources import abandon, reinit_after_fork
+
+RETRYABLE_ERRORS = (APIConnectionError, APITimeoutError, RateLimitError, InternalServerError)
+
+def _client_kwargs(gateway) -> dict:
+    kwargs = {"api_key": gateway.api_key, "http_client": gateway.http_client, "max_retries": 0, "timeout": gateway.timeout}
+    if gateway.base_url:
+        kwargs["base_url"] = gateway.base_url
+    return kwargs
+
+
+def _check_stream_deadline(deadline):
+    # Timeout của httpx chỉ giới hạn từng lần đọc: stream nhả token đều đặn vẫn có thể chạy quá deadline
+    if deadline is not None and deadline.expired:
+        raise AdmissionRejected("deadline", "Stream LLM vượt deadline của request")
+
+
+class _InFlightCall:
+    """Kết quả của 1 upstream call đang chạy, dùng chung cho các caller trùng prompt."""
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
 
 class OpenAiClient:
-    def __init__(self, api_key: str, base_url: str = None):
-        if base_url:
-            self.client = OpenAI(api_key=api_key, base_url=base_url)
-        else:
-            self.client = OpenAI(api_key=api_key)
-
-    def chat(self, messages, model="gpt-4o-mini"):
-        response = self.client.chat.completions.create(
+    """
+    Gateway LLM dùng chung cho cả process (agent, Reflection, query rewrite).
+    - 1 httpx.Client với connection pool giới hạn -> tái sử dụng kết nối / TLS session.
+    - Timeout theo từng call, retry với exponential backoff cho lỗi tạm thời.
+    - deadline (admission.Deadline) của request: timeout mỗi lần thử không vượt quá thời gian còn lại,
+      không retry khi backoff đã vượt deadline.
+    - Giới hạn số call upstream đồng thời.
+    - Single-flight: các prompt giống hệt nhau đang chạy dùng chung 1 upstream call.
+    """
+    def __init__(self, api_key: str, base_url: str = None, max_connections: int = 20, max_concurrency: int = 16,
+                 timeout: float = 30.0, max_retries: int = 2, backoff_seconds: float = 0.5):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._open()
+        reinit_after_fork(self)
+
+    def _open(self):
+        self.http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            timeout=self.timeout
+        )
+        self.client = OpenAI(**_client_kwargs(self))
+        self._slots = threading.BoundedSemaphore(self.max_concurrency)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+
+    def _reopen(self):
+        """Sau fork: connection pool / semaphore / single-flight mới; pool của process cha bị bỏ, không đóng."""
+        abandon(self.http_client)
+        self._open()
+
+    def chat(self, messages, model="gpt-4o-mini", timeout: float = None, deadline=None):
+        key = self._call_key(model, messages)
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._inflight[key] = _InFlightCall()
+
+        if not is_leader:
+            # Follower chỉ chờ trong deadline của chính nó (leader có thể còn đang retry)
+            if not call.done.wait(timeout=deadline.remaining() if deadline is not None else None):
+                raise AdmissionRejected("deadline", "Hết thời gian chờ call LLM trùng prompt")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._chat_with_retry(messages, model, timeout, deadline)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            call.done.set()
+
+    def chat_stream(self, messages, model="gpt-4o-mini", timeout: float = None, deadline=None):
+        """
+        Yield từng đoạn text khi LLM sinh ra (stream=True).
+        Giữ 1 slot concurrency đến khi stream kết thúc hoặc generator bị close.
+        Chỉ retry khi chưa nhận được token nào.
+        Hết deadline giữa chừng -> đóng upstream stream, AdmissionRejected("deadline").
+        """
+        with self._slots:
+            stream = self._create_with_retry(
+                acquire_slot=False,
+                deadline=deadline,
+                model=model,
+                messages=messages,
+                timeout=timeout or self.timeout,
+                stream=True
+            )
+            try:
+                for chunk in stream:
+                    _check_stream_deadline(deadline)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                stream.close()
+
+    def close(self):
+        self.http_client.close()
+
+    def _chat_with_retry(self, messages, model, timeout, deadline=None):
+        response = self._create_with_retry(
+            acquire_slot=True,
+            deadline=deadline,
             model=model,
-            messages=messages
+            messages=messages,
+            timeout=timeout or self.timeout
         )
         # Trả về thẳng string content thay vì object
         return response.choices[0].message.content
+
+    def _create_with_retry(self, acquire_slot: bool, deadline=None, **kwargs):
+        attempt = 0
+        timeout = kwargs["timeout"]
+        while True:
+            if deadline is not None:
+                kwargs["timeout"] = max(0.01, min(timeout, deadline.remaining()))
+            try:
+                if not acquire_slot:
+                    return self.client.chat.completions.create(**kwargs)
+                with self._slots:
+                    return self.client.chat.completions.create(**kwargs)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(service="llm", error=type(e).__name__)
+                if not isinstance(e, RETRYABLE_ERRORS) or attempt >= self.max_retries:
+                    raise
+                backoff = self.backoff_seconds * (2 ** attempt) * (1 + random.random())
+                if deadline is not None and backoff >= deadline.remaining():
+                    raise
+                time.sleep(backoff)
+                attempt += 1
+
+    @staticmethod
+    def _call_key(model, messages):
+        payload = json.dumps([model, messages], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class AsyncOpenAiClient:
+    """
+    Bản asyncio của OpenAiClient (AsyncOpenAI + httpx.AsyncClient), cùng các chính sách:
+    connection pool, timeout, retry/backoff, giới hạn concurrency, single-flight.
+    """
+    def __init__(self, api_key: str, base_url: str = None, max_connections: int = 100, max_concurrency: int = 64,
+                 timeout: float = 30.0, max_retries: int = 2, backoff_seconds: float = 0.5):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self._open()
+        reinit_after_fork(self)
+
+    def _open(self):
+        self.http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            timeout=self.timeout
+        )
+        self.client = AsyncOpenAI(**_client_kwargs(self))
+        self._slots = None
+        self._inflight = {}
+
+    def _reopen(self):
+        abandon(self.http_client)
+        self._open()
+
+    async def chat(self, messages, model="gpt-4o-mini", timeout: float = None, deadline=None):
+        key = OpenAiClient._call_key(model, messages)
+        future = self._inflight.get(key)
+        while future is not None:
+            # Follower: chờ trong deadline của chính nó; leader bị cancel -> follower đầu tiên thành leader mới
+            try:
+                return await asyncio.wait_for(
+                    asyncio.shield(future), timeout=deadline.remaining() if deadline is not None else None
+                )
+            except asyncio.TimeoutError:
+                raise AdmissionRejected("deadline", "Hết thời gian chờ call LLM trùng prompt") from None
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise   # chính request này bị cancel
+            future = self._inflight.get(key)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            response = await self._create_with_retry(
+                acquire_slot=True,
+                deadline=deadline,
+                model=model,
+                messages=messages,
+                timeout=timeout or self.timeout
+            )
+            future.set_result(response.choices[0].message.content)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Không để "Future exception was never retrieved" khi không có follower
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        return future.result()
+
+    async def chat_stream(self, messages, model="gpt-4o-mini", timeout: float = None, deadline=None):
+        """Async generator yield từng đoạn text; giữ 1 slot đến khi stream kết thúc / bị đóng / hết deadline."""
+        async with self._get_slots():
+            stream = await self._create_with_retry(
+                acquire_slot=False,
+                deadline=deadline,
+                model=model,
+                messages=messages,
+                timeout=timeout or self.timeout,
+                stream=True
+            )
+            try:
+                async for chunk in stream:
+                    _check_stream_deadline(deadline)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+            finally:
+                await stream.close()
+
+    async def close(self):
+        await self.http_client.aclose()
+
+    def _get_slots(self):
+        # Semaphore tạo lazily để gắn với event loop đang chạy
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        return self._slots
+
+    async def _create_with_retry(self, acquire_slot: bool, deadline=None, **kwargs):
+        attempt = 0
+        timeout = kwargs["timeout"]
+        while True:
+            if deadline is not None:
+                kwargs["timeout"] = max(0.01, min(timeout, deadline.remaining()))
+            try:
+                if not acquire_slot:
+                    return await self.client.chat.completions.create(**kwargs)
+                async with self._get_slots():
+                    return await self.client.chat.completions.create(**kwargs)
+            except Exception as e:
+                UPSTREAM_ERRORS.inc(service="llm", error=type(e).__name__)
+                if not isinstance(e, RETRYABLE_ERRORS) or attempt >= self.max_retries:
+                    raise
+                backoff = self.backoff_seconds * (2 ** attempt) * (1 + random.random())
+                if deadline is not None and backoff >= deadline.remaining():
+                    raise
+                await asyncio.sleep(backoff)
+                attempt += 1
@@ -1 +1,10 @@
-from rag.core import RAG
\ No newline at end of file
+from rag.core import RAG
+from rag.catalog import read_catalog_version, bump_catalog_version, new_catalog_version
+from rag.vector_index import ChromaIndex, NumpyIndex, numpy_index_path
+from rag.lexical import BM25Index, lexical_index_path, lexical_text, fold_vietnamese, reciprocal_rank_fusion
+from rag.attributes import (
+    AttributeIndex, attribute_index_path, extract_constraints, parse_price, parse_discount, infer_brand
+)
+from rag.matcher import EntityMatcher, AhoCorasick, entity_index_path, normalize_for_match
+from rag.records import CatalogStore, ProductHit, records_path
+from rag.registry import CatalogRegistry, current_catalog, catalog_scope
@@ -0,0 +1,245 @@
+import os
+import re
+import json
+import numpy as np
+from rag.lexical import fold_vietnamese
+
+# Tên dòng máy -> brand, vì data chỉ có tên sản phẩm ("iPhone 16 128GB", "MacBook Air M2 ...")
+BRAND_ALIASES = {
+    "iphone": "Apple",
+    "ipad": "Apple",
+    "macbook": "Apple",
+    "imac": "Apple",
+    "galaxy": "Samsung",
+    "redmi": "Xiaomi",
+    "poco": "Xiaomi",
+}
+
+# Category (đã bỏ dấu) -> các cách gọi trong câu hỏi
+CATEGORY_KEYWORDS = {
+    "dien thoai": ["dien thoai", "smartphone", "dt"],
+    "laptop": ["laptop", "may tinh xach tay", "notebook", "macbook"],
+}
+
+MIN_PRICE = 100_000     # số tiền nhỏ hơn coi như không phải giá (vd "8gb", "15")
+AROUND_RATIO = 0.15     # "khoảng / tầm X" -> X ± 15%
+
+# ------------------- Parse giá / brand -------------------
+def parse_price(value) -> int:
+    """"2.290.000 ₫" -> 2290000. Không parse được (vd "Liên hệ") -> None."""
+    if isinstance(value, (int, float)):
+        return int(value) if value > 0 else None
+    digits = re.sub(r"\D", "", str(value or ""))
+    return int(digits) if digits else None
+
+def parse_discount(value) -> int:
+    """"-8%" -> 8 (phần trăm giảm). Không có -> 0."""
+    match = re.search(r"(\d+(?:[.,]\d+)?)", str(value or ""))
+    return int(round(float(match.group(1).replace(",", ".")))) if match else 0
+
+def infer_brand(name: str, brand: str = "") -> str:
+    """Brand có sẵn thì giữ nguyên, nếu không thì suy từ từ đầu tiên của tên sản phẩm."""
+    if brand:
+        return brand
+    words = (name or "").split()
+    if not words:
+        return ""
+    return BRAND_ALIASES.get(fold_vietnamese(words[0]), words[0])
+
+
+# ------------------- Column index -------------------
+class AttributeIndex:
+    """
+    Index dạng cột cho các thuộc tính có cấu trúc của catalog:
+    - price: mảng giá đã sort + thứ tự row -> lọc khoảng giá bằng searchsorted.
+    - brand / category: bitmap (mảng bool theo row) cho từng giá trị.
+    filter(constraints) trả về các row thỏa điều kiện để vector / BM25 chỉ chấm điểm trên tập con đó.
+    Lưu ra <db>/<collection>.attributes.npz lúc ingest.
+    """
+    def __init__(self, ids, prices, discounts, brand_codes, brand_names, category_codes, category_names, catalog_version=None):
+        self.ids = np.asarray(ids, dtype=object)
+        self.prices = np.asarray(prices, dtype=np.int64)          # -1: không có giá
+        self.discounts = np.asarray(discounts, dtype=np.int16)
+        self.brand_codes = np.asarray(brand_codes, dtype=np.int32)
+        self.brand_names = list(brand_names)
+        self.category_codes = np.asarray(category_codes, dtype=np.int32)
+        self.category_names = list(category_names)
+        self.catalog_version = catalog_version
+
+        self.price_order = np.argsort(self.prices, kind="stable")
+        self.sorted_prices = self.prices[self.price_order]
+        self.brand_bitmaps = {
+            fold_vietnamese(name): self.brand_codes == code for code, name in enumerate(self.brand_names) if name
+        }
+        self.category_bitmaps = {
+            fold_vietnamese(name): self.category_codes == code for code, name in enumerate(self.category_names) if name
+        }
+
+    def __len__(self):
+        return len(self.ids)
+
+    def filter(self, constraints: dict):
+        """
+        constraints: {"min_price", "max_price", "brands", "categories"} (brand / category đã bỏ dấu).
+        Trả về mảng row thỏa tất cả điều kiện (tăng dần), hoặc None nếu không có điều kiện nào.
+        """
+        constraints = constraints or {}
+        mask = None
+
+        min_price, max_price = constraints.get("min_price"), constraints.get("max_price")
+        if min_price is not None or max_price is not None:
+            lo = np.searchsorted(self.sorted_prices, max(min_price or 0, 0), side="left")
+            hi = np.searchsorted(self.sorted_prices, max_price, side="right") if max_price is not None else len(self.sorted_prices)
+            mask = np.zeros(len(self.ids), dtype=bool)
+            mask[self.price_order[lo:hi]] = True
+
+        for key, bitmaps in (("brands", self.brand_bitmaps), ("categories", self.category_bitmaps)):
+            values = constraints.get(key)
+            if not values:
+                continue
+            selected = np.zeros(len(self.ids), dtype=bool)
+            for value in values:
+                if value in bitmaps:
+                    selected |= bitmaps[value]
+            mask = selected if mask is None else mask & selected
+
+        return None if mask is None else np.flatnonzero(mask)
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            ids=np.asarray([str(i) for i in self.ids], dtype=str),
+            prices=self.prices,
+            discounts=self.discounts,
+            brand_codes=self.brand_codes,
+            category_codes=self.category_codes,
+            info=np.asarray(json.dumps({
+                "brand_names": self.brand_names,
+                "category_names": self.category_names,
+                "catalog_version": self.catalog_version
+            }, ensure_ascii=False))
+        )
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str):
+        with np.load(path, allow_pickle=False) as data:
+            info = json.loads(str(data["info"]))
+            return AttributeIndex(
+                ids=data["ids"].tolist(),
+                prices=data["prices"],
+                discounts=data["discounts"],
+                brand_codes=data["brand_codes"],
+                brand_names=info["brand_names"],
+                category_codes=data["category_codes"],
+                category_names=info["category_names"],
+                catalog_version=info.get("catalog_version")
+            )
+
+    @staticmethod
+    def from_metadatas(ids: list, metadatas: list, catalog_version: str = None):
+        """Build từ metadata của collection; collection ingest bản cũ (chưa có price_value / brand) thì parse lại."""
+        brand_codes, brand_names, brand_lookup = [], [], {}
+        category_codes, category_names, category_lookup = [], [], {}
+        prices, discounts = [], []
+        for meta in metadatas:
+            meta = meta or {}
+            price = meta.get("price_value") or parse_price(meta.get("price"))
+            prices.append(price if price else -1)
+            discounts.append(meta["discount_pct"] if "discount_pct" in meta else parse_discount(meta.get("discount")))
+            for value, codes, names, lookup in (
+                (infer_brand(meta.get("title", ""), meta.get("brand", "")), brand_codes, brand_names, brand_lookup),
+                (meta.get("tags", ""), category_codes, category_names, category_lookup),
+            ):
+                key = fold_vietnamese(value)
+                if key not in lookup:
+                    lookup[key] = len(names)
+                    names.append(value)
+                codes.append(lookup[key])
+        return AttributeIndex(ids, prices, discounts, brand_codes, brand_names, category_codes, category_names, catalog_version)
+
+    @staticmethod
+    def build_from_collection(collection, catalog_version: str = None):
+        data = collection.get(include=["metadatas"])
+        return AttributeIndex.from_metadatas(data.get("ids") or [], data.get("metadatas") or [], catalog_version)
+
+
+def attribute_index_path(db_path: str, collection_name: str) -> str:
+    return os.path.join(db_path, f"{collection_name}.attributes.npz")
+
+
+# ------------------- Trích điều kiện từ câu hỏi -------------------
+_NUMBER = r"(\d+(?:[.,]\d+)*)"
+_UNIT = r"(ty|ti|trieu|tr|cu|nghin|ngan|k|vnd|dong|d)?"
+_MONEY = _NUMBER + r"\s*" + _UNIT + r"(?![a-z0-9])"
+
+_RANGE_RE = re.compile(r"(?:tu|gia|tam|khoang|trong khoang)?\s*" + _MONEY + r"\s*(?:den|toi|-|~)\s*" + _MONEY)
+_MAX_RE = re.compile(r"(?:duoi|nho hon|re hon|it hon|khong qua|toi da|<=?)\s*" + _MONEY)
+_MIN_RE = re.compile(r"(?:tren|lon hon|cao hon|toi thieu|it nhat|>=?)\s*" + _MONEY + r"|(?:tu)\s*" + _MONEY + r"\s*tro len")
+_AROUND_RE = re.compile(r"(?:khoang|tam|tam gia|gia)\s*" + _MONEY)
+_BARE_RE = re.compile(_NUMBER + r"\s*(ty|ti|trieu|tr|cu|nghin|ngan|k|vnd|dong|d)(?![a-z0-9])")
+
+def _to_vnd(number: str, unit: str, cue: bool):
+    """Số + đơn vị -> VND. Có từ chỉ giá (dưới / trên / khoảng ...) mà không có đơn vị thì hiểu là triệu."""
+    if re.fullmatch(r"\d{1,3}(?:[.,]\d{3})+", number):
+        value = float(re.sub(r"[.,]", "", number))
+    else:
+        value = float(number.replace(",", "."))
+    if unit in ("ty", "ti"):
+        value *= 1_000_000_000
+    elif unit in ("trieu", "tr", "cu") or (not unit and cue and value < 1000):
+        value *= 1_000_000
+    elif unit in ("nghin", "ngan", "k"):
+        value *= 1_000
+    value = int(value)
+    return value if value >= MIN_PRICE else None
+
+def extract_constraints(query: str, matcher=None) -> dict:
+    """
+    Trích điều kiện lọc từ câu hỏi (đã bỏ dấu):
+    - giá: "dưới 10 triệu", "trên 5tr", "trên 1 tỷ", "từ 5 đến 10 triệu", "khoảng 8 triệu", "15.990.000đ".
+    - brand / category: từ các entity EntityMatcher (rag.matcher) nhận diện được, nếu truyền matcher.
+    Trả về dict chỉ gồm các điều kiện tìm thấy ({} nếu không có).
+    """
+    text = " " + re.sub(r"\s+", " ", fold_vietnamese(query)) + " "
+    constraints = {}
+
+    def consume(match):
+        nonlocal text
+        text = text[:match.start()] + " " * (match.end() - match.start()) + text[match.end():]
+
+    match = _RANGE_RE.search(text)
+    if match and (match.group(2) or match.group(4)):
+        low = _to_vnd(match.group(1), match.group(2) or match.group(4), True)
+        high = _to_vnd(match.group(3), match.group(4) or match.group(2), True)
+        if low and high:
+            constraints["min_price"], constraints["max_price"] = min(low, high), max(low, high)
+            consume(match)
+    if "max_price" not in constraints:
+        match = _MAX_RE.search(text)
+        if match and _to_vnd(match.group(1), match.group(2), True):
+            constraints["max_price"] = _to_vnd(match.group(1), match.group(2), True)
+            consume(match)
+    if "min_price" not in constraints:
+        match = _MIN_RE.search(text)
+        if match:
+            number, unit = (match.group(1), match.group(2)) if match.group(1) else (match.group(3), match.group(4))
+            value = _to_vnd(number, unit, True)
+            if value:
+                constraints["min_price"] = value
+                consume(match)
+    if not constraints:
+        match = _AROUND_RE.search(text) or _BARE_RE.search(text)
+        if match:
+            value = _to_vnd(match.group(1), match.group(2), match.re is _AROUND_RE)
+            if value:
+                constraints["min_price"] = int(value * (1 - AROUND_RATIO))
+                constraints["max_price"] = int(value * (1 + AROUND_RATIO))
+
+    if matcher is not None:
+        constraints.update(matcher.constraints(matcher.match(query)))
+    return constraints
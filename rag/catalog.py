@@ -0,0 +1,40 @@
+import os
+import uuid
+
+CATALOG_VERSION_FILE = "catalog_version"
+
+def catalog_version_path(db_path: str, collection_name: str = None) -> str:
+    name = f"{collection_name}.{CATALOG_VERSION_FILE}" if collection_name else CATALOG_VERSION_FILE
+    return os.path.join(db_path, name)
+
+def read_catalog_version(db_path: str, collection_name: str = None) -> str:
+    """
+    Version hiện tại của catalog sản phẩm (đổi mỗi lần ingest lại data).
+    collection_name: version riêng của catalog đó (ingest catalog khác không làm index của nó phải load lại);
+    catalog chưa có version riêng (ingest trước đây) dùng version chung.
+    """
+    paths = [catalog_version_path(db_path, collection_name)] if collection_name else []
+    for path in paths + [catalog_version_path(db_path)]:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return f.read().strip() or "0"
+        except FileNotFoundError:
+            continue
+    return "0"
+
+def new_catalog_version() -> str:
+    return uuid.uuid4().hex
+
+def bump_catalog_version(db_path: str, version: str = None, collection_name: str = None) -> str:
+    """
+    Gọi sau khi ingest: đổi version để các cache phụ thuộc catalog tự mất hiệu lực.
+    Có collection_name: ghi version riêng của catalog đó, sau đó version chung.
+    """
+    os.makedirs(db_path, exist_ok=True)
+    version = version or new_catalog_version()
+    for path in ([catalog_version_path(db_path, collection_name)] if collection_name else []) + [catalog_version_path(db_path)]:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(version)
+        os.replace(tmp_path, path)
+    return version
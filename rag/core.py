@@ -1,63 +1,357 @@
-import chromadb
+import os
+import sys
+import time
+import types
+import logging
+import threading
 import numpy as np
+from resources import LazyCollection, chroma_client, import_chroma
+from rag.catalog import read_catalog_version
+from rag.vector_index import ChromaIndex, NumpyIndex, numpy_index_path
+from rag.lexical import BM25Index, lexical_index_path, reciprocal_rank_fusion
+from rag.attributes import AttributeIndex, attribute_index_path, extract_constraints
+from rag.matcher import EntityMatcher, entity_index_path
+from rag.records import CatalogStore, ProductHit, records_path
+
+logger = logging.getLogger(__name__)
 
 DEFAULT_SEARCH_LIMIT = 5
+HYBRID_CANDIDATES = 20  # số ứng viên lấy từ mỗi nhánh (vector / BM25) trước khi fusion
+CATALOG_VERSION_TTL = 1.0  # giây: version catalog đọc lại từ file tối đa 1 lần / TTL (ingest mới có hiệu lực sau <= TTL)
+
+def object_bytes(obj) -> int:
+    """
+    Bộ nhớ của 1 index đã load: mảng numpy (nbytes, kể cả memory-map) + mọi object Python nó tham chiếu
+    (dict postings, list, str...), mỗi object tính 1 lần. Không đi vào module / class / function.
+    """
+    seen = set()
+    total = 0
+    stack = [obj]
+    while stack:
+        item = stack.pop()
+        if id(item) in seen or isinstance(item, _SKIP_TYPES):
+            continue
+        seen.add(id(item))
+        if isinstance(item, np.ndarray):
+            # View của mảng khác: phần dữ liệu đã tính ở mảng gốc
+            if isinstance(item, np.memmap) or not isinstance(item.base, np.ndarray):
+                total += item.nbytes
+            if item.dtype == object:
+                stack.extend(item.ravel().tolist())
+            continue
+        total += sys.getsizeof(item)
+        if isinstance(item, dict):
+            stack.extend(item.keys())
+            stack.extend(item.values())
+        elif isinstance(item, (list, tuple, set, frozenset)):
+            stack.extend(item)
+        elif not isinstance(item, (str, bytes, int, float, memoryview)):
+            stack.extend(getattr(item, "__dict__", {}).values())
+            for slot in getattr(type(item), "__slots__", ()):
+                if hasattr(item, slot):
+                    stack.append(getattr(item, slot))
+    return total
+
+_SKIP_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, types.MethodType, type(threading.Lock()))
+
 
 class RAG:
-    def __init__(self, collection_name: str, db_path: str):
-        self.client = chromadb.PersistentClient(path=db_path)
-        self.collection = self.client.get_or_create_collection(name=collection_name)
+    def __init__(self, collection_name: str, db_path: str, backend: str = "chroma"):
+        """
+        backend: "chroma" (query HNSW của Chroma) hoặc "numpy" (NumpyIndex memory-map, exact top-k).
+        """
+        self.db_path = db_path
+        self.collection_name = collection_name
+        self.backend = backend
+        # Client / collection Chroma dùng chung trong process (resources), chỉ mở khi cần lần đầu
+        self.collection = LazyCollection(db_path, collection_name)
+        self._index = ChromaIndex(self.collection) if backend == "chroma" else None
+        self._index_lock = threading.Lock()
+        self._lexical = None
+        self._attributes = None
+        self._matcher = None
+        self._catalog = None
+        self._attribute_rows = None   # (index, attributes, row của index theo từng row attribute) cho backend numpy
+        self._version = None          # (version, thời điểm đọc) dùng chung cho mọi accessor
+        self.version_ttl = CATALOG_VERSION_TTL
+        self.generation = 0           # tăng mỗi lần 1 index được (re)load, CatalogRegistry dựa vào để tính lại bộ nhớ
+
+    @property
+    def client(self):
+        return chroma_client(self.db_path)
+
+    def warmup(self, open_stores: bool = True):
+        """
+        Load trước index vector / BM25 / attribute / entity matcher / catalog record (gọi lúc startup).
+        open_stores=False (master gunicorn trước fork): không mở collection Chroma, xem resources.import_chroma.
+        """
+        if self.backend == "chroma":
+            if open_stores:
+                self.collection.count()
+            else:
+                import_chroma()
+        self.index()
+        self.lexical()
+        self.attributes()
+        self.matcher()
+        self.catalog()
+
+    def catalog_version(self) -> str:
+        """Version catalog hiện tại; file version chỉ được đọc lại sau version_ttl giây (accessor gọi nhiều lần / request)."""
+        cached = self._version
+        now = time.monotonic()
+        if cached is not None and now - cached[1] < self.version_ttl:
+            return cached[0]
+        version = read_catalog_version(self.db_path, self.collection_name)
+        self._version = (version, now)
+        return version
+
+    def index(self):
+        """Index vector hiện tại; với backend numpy thì load (hoặc build từ collection) khi catalog đổi."""
+        if self.backend == "chroma":
+            return self._index
+        version = self.catalog_version()
+        if self._index is not None and self._index.catalog_version == version:
+            return self._index
+        with self._index_lock:
+            if self._index is None or self._index.catalog_version != version:
+                path = numpy_index_path(self.db_path, self.collection_name)
+                try:
+                    index = NumpyIndex(path) if os.path.exists(path + ".json") else None
+                except ValueError:
+                    index = None
+                if index is None or index.catalog_version != version:
+                    NumpyIndex.build_from_collection(self.collection, path, catalog_version=version)
+                    index = NumpyIndex(path)
+                self._index = index
+                self.generation += 1
+        return self._index
+
+    def matcher(self):
+        """EntityMatcher (brand / model / category) của catalog: load pattern prebuilt lúc ingest, build nếu thiếu / cũ."""
+        version = self.catalog_version()
+        if self._matcher is not None and self._matcher.catalog_version == version:
+            return self._matcher
+        with self._index_lock:
+            if self._matcher is None or self._matcher.catalog_version != version:
+                path = entity_index_path(self.db_path, self.collection_name)
+                try:
+                    matcher = EntityMatcher.load(path) if os.path.exists(path) else None
+                except (ValueError, KeyError, OSError):
+                    matcher = None
+                if matcher is None or matcher.catalog_version != version:
+                    matcher = EntityMatcher.build_from_collection(self.collection, catalog_version=version)
+                self._matcher = matcher
+                self.generation += 1
+        return self._matcher
+
+    def match_entities(self, query_text: str) -> list:
+        """Các entity sản phẩm (brand / model / category / từ khoá) trong câu hỏi, 1 lượt quét Aho–Corasick."""
+        return self.matcher().match(query_text)
+
+    def lexical(self):
+        """BM25Index của catalog: load file prebuilt lúc ingest, build từ collection nếu thiếu / cũ."""
+        version = self.catalog_version()
+        if self._lexical is not None and self._lexical.catalog_version == version:
+            return self._lexical
+        with self._index_lock:
+            if self._lexical is None or self._lexical.catalog_version != version:
+                path = lexical_index_path(self.db_path, self.collection_name)
+                try:
+                    index = BM25Index.load(path) if os.path.exists(path) else None
+                except (ValueError, KeyError, OSError):
+                    index = None
+                if index is None or index.catalog_version != version:
+                    index = BM25Index.build_from_collection(self.collection)
+                    index.catalog_version = version
+                self._lexical = index
+                self.generation += 1
+        return self._lexical
+
+    def attributes(self):
+        """AttributeIndex (giá / brand / category) của catalog: load file prebuilt lúc ingest, build nếu thiếu / cũ."""
+        version = self.catalog_version()
+        if self._attributes is not None and self._attributes.catalog_version == version:
+            return self._attributes
+        with self._index_lock:
+            if self._attributes is None or self._attributes.catalog_version != version:
+                path = attribute_index_path(self.db_path, self.collection_name)
+                try:
+                    index = AttributeIndex.load(path) if os.path.exists(path) else None
+                except (ValueError, KeyError, OSError):
+                    index = None
+                if index is None or index.catalog_version != version:
+                    index = AttributeIndex.build_from_collection(self.collection, catalog_version=version)
+                self._attributes = index
+                self.generation += 1
+        return self._attributes
+
+    def catalog(self):
+        """CatalogStore (cột title / mô tả / giá / snippet prompt) của catalog: load file prebuilt lúc ingest, build nếu thiếu / cũ."""
+        version = self.catalog_version()
+        if self._catalog is not None and self._catalog.catalog_version == version:
+            return self._catalog
+        with self._index_lock:
+            if self._catalog is None or self._catalog.catalog_version != version:
+                path = records_path(self.db_path, self.collection_name)
+                try:
+                    store = CatalogStore(path) if os.path.exists(path + ".json") else None
+                except (ValueError, KeyError, OSError):
+                    store = None
+                if store is None or store.catalog_version != version:
+                    CatalogStore.build_from_collection(self.collection, path, catalog_version=version)
+                    store = CatalogStore(path)
+                self._catalog = store
+                self.generation += 1
+        return self._catalog
 
-    def _format_results(self, results):
-        """Chuyển kết quả từ ChromaDB thành dict dễ dùng."""
-        if not results or not results.get("documents") or not results.get("metadatas"):
+    def resident_bytes(self) -> dict:
+        """
+        Bộ nhớ các index đang load trong process, theo thành phần (xem object_bytes). Backend chroma: ước lượng HNSW
+        của collection (ChromaIndex.nbytes), tính khi collection đã được mở.
+        """
+        loaded = {"index": self._index if self.backend == "numpy" else None, "lexical": self._lexical,
+                  "attributes": self._attributes, "matcher": self._matcher, "catalog": self._catalog}
+        sizes = {name: object_bytes(component) for name, component in loaded.items() if component is not None}
+        if self.backend == "chroma" and self.collection.is_open():
+            sizes["index"] = self._index.nbytes
+        return sizes
+
+    def extract_constraints(self, query_text: str) -> dict:
+        """Điều kiện giá / brand / category trong câu hỏi, theo các giá trị có trong catalog."""
+        return extract_constraints(query_text, self.matcher())
+
+    def _index_rows(self, attribute_rows):
+        """Row của AttributeIndex -> row của NumpyIndex (bảng ánh xạ tính 1 lần cho mỗi cặp index)."""
+        index, attributes = self.index(), self.attributes()
+        cached = self._attribute_rows
+        if cached is None or cached[0] is not index or cached[1] is not attributes:
+            cached = self._attribute_rows = (index, attributes, index.rows_for(attributes.ids))
+        rows = cached[2][attribute_rows]
+        return rows[rows >= 0]
+
+    def _format_results(self, results, query_index: int = 0):
+        """
+        Kết quả index (ids + distances) -> list ProductHit trỏ vào CatalogStore.
+        Đọc như dict cũ (_id, title, description, price, brand, category, distance); to_dict() khi cần serialize.
+        """
+        if not results or not results.get("ids"):
             return []
 
-        docs_list = results["documents"][0]
-        metas_list = results["metadatas"][0]
-        ids_list = results["ids"][0] if "ids" in results and results["ids"] else [None]*len(docs_list)
-        distances_list = results["distances"][0] if "distances" in results and results["distances"] else [0]*len(docs_list)
+        ids_list = results["ids"][query_index]
+        distances_list = results["distances"][query_index] if results.get("distances") else [0] * len(ids_list)
 
+        store = self.catalog()
         formatted = []
-        for i in range(len(docs_list)):
-            meta = metas_list[i] if isinstance(metas_list[i], dict) else {}
-            formatted.append({
-                "_id": ids_list[i],
-                "title": meta.get("title") or meta.get("name") or "N/A",
-                "description": docs_list[i],
-                "price": meta.get("price", "N/A"),
-                "brand": meta.get("brand", "N/A"),
-                "category": meta.get("tags", "N/A"),
-                "distance": distances_list[i]
-            })
+        for doc_id, distance in zip(ids_list, distances_list):
+            row = store.row(doc_id)
+            if row is None:
+                logger.warning("Document %s không có trong catalog record (catalog_version %s)", doc_id, store.catalog_version)
+                continue
+            formatted.append(ProductHit(store, row, distance))
         return formatted
 
-    def vector_search(self, query_embedding: list, limit=DEFAULT_SEARCH_LIMIT):
-        if not query_embedding:
+    def vector_search(self, query_embedding: list, limit=DEFAULT_SEARCH_LIMIT, allowed_rows=None):
+        """allowed_rows: row của AttributeIndex (kết quả attributes().filter) -> chỉ score trên tập con này."""
+        if query_embedding is None or len(query_embedding) == 0:
             return []
 
-        results_raw = self.collection.query(
-            query_embeddings=[query_embedding],
-            n_results=limit
-        )
+        if allowed_rows is None:
+            results_raw = self.index().query([query_embedding], limit, documents=False)
+        elif self.backend == "chroma":
+            results_raw = self.index().query([query_embedding], limit, ids=self.attributes().ids[allowed_rows].tolist(), documents=False)
+        else:
+            results_raw = self.index().query([query_embedding], limit, rows=self._index_rows(allowed_rows), documents=False)
         results = self._format_results(results_raw)
-        print(f"[DEBUG] Vector search results ({len(results)} items):")
-        for r in results:
-            print(f"  {r['_id']}: {r['title']}, distance={r['distance']:.4f}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Vector search results: %s", [(r['_id'], round(r['distance'], 4)) for r in results])
         return results
 
-    def hybrid_search(self, query_embedding: list, limit=DEFAULT_SEARCH_LIMIT):
-        vector_results = self.vector_search(query_embedding, limit)
-        return vector_results
+    def vector_search_batch(self, query_embeddings: list, limit=DEFAULT_SEARCH_LIMIT):
+        """Search nhiều query trong 1 lần gọi index; trả về list kết quả theo đúng thứ tự input (embedding rỗng -> [])."""
+        positions = [i for i, emb in enumerate(query_embeddings) if emb is not None and len(emb) > 0]
+        batched = [[] for _ in query_embeddings]
+        if positions:
+            results_raw = self.index().query([query_embeddings[i] for i in positions], limit, documents=False)
+            for k, i in enumerate(positions):
+                batched[i] = self._format_results(results_raw, k)
+        return batched
+
+    def hybrid_search(self, query_embedding: list, limit=DEFAULT_SEARCH_LIMIT, query_text: str = None, constraints: dict = None):
+        """
+        Vector search + BM25 (tên, brand, category, mô tả; không phân biệt dấu), gộp bằng reciprocal rank fusion.
+        Không có query_text thì chỉ dùng vector search. Mỗi kết quả có thêm "score" (RRF).
+        constraints: điều kiện giá / brand / category (mặc định trích từ query_text), lọc trước khi score;
+        không sản phẩm nào thỏa -> [].
+        """
+        return self.hybrid_search_batch([query_embedding], limit, [query_text], [constraints])[0]
+
+    def hybrid_search_batch(self, query_embeddings: list, limit=DEFAULT_SEARCH_LIMIT, query_texts: list = None, constraints: list = None):
+        """
+        hybrid_search cho nhiều query, kết quả theo thứ tự input. Các query không có điều kiện lọc được
+        vector search chung 1 lần gọi index (multi-query); query có điều kiện search trên tập con của riêng nó.
+        """
+        count = len(query_embeddings)
+        query_texts = list(query_texts) if query_texts is not None else [None] * count
+        constraints = list(constraints) if constraints is not None else [None] * count
+        candidates = max(limit, HYBRID_CANDIDATES)
+
+        allowed = []
+        for text, item_constraints in zip(query_texts, constraints):
+            if item_constraints is None:
+                item_constraints = self.extract_constraints(text) if text else {}
+            rows = self.attributes().filter(item_constraints) if item_constraints else None
+            if rows is not None:
+                logger.debug("Constraints %s: %d sản phẩm thỏa điều kiện", item_constraints, len(rows))
+            allowed.append(rows)
+
+        # Vector search: 1 lần gọi cho nhóm không lọc, từng query cho nhóm có lọc
+        vector_results = [[] for _ in range(count)]
+        unfiltered = [i for i in range(count) if allowed[i] is None]
+        for i, results in zip(unfiltered, self.vector_search_batch([query_embeddings[i] for i in unfiltered], candidates)):
+            vector_results[i] = results
+        for i in range(count):
+            if allowed[i] is not None and len(allowed[i]) > 0:
+                vector_results[i] = self.vector_search(query_embeddings[i], candidates, allowed[i])
+
+        return [
+            self._fuse(query_embeddings[i], vector_results[i], query_texts[i], allowed[i], limit)
+            if allowed[i] is None or len(allowed[i]) > 0 else []
+            for i in range(count)
+        ]
+
+    def _fuse(self, query_embedding, vector_results: list, query_text: str, allowed_rows, limit: int) -> list:
+        """Gộp kết quả vector với BM25 bằng RRF; document chỉ có ở nhánh BM25 được lấy thêm kèm distance."""
+        if not query_text:
+            return vector_results[:limit]
+
+        has_embedding = query_embedding is not None and len(query_embedding) > 0
+        allowed_ids = set(self.attributes().ids[allowed_rows].tolist()) if allowed_rows is not None else None
+        lexical_hits = self.lexical().search(query_text, max(limit, HYBRID_CANDIDATES), allowed_ids=allowed_ids)
+        fused = reciprocal_rank_fusion([
+            [r["_id"] for r in vector_results],
+            [doc_id for doc_id, _ in lexical_hits]
+        ])[:limit]
+
+        by_id = {r["_id"]: r for r in vector_results}
+        missing = [doc_id for doc_id, _ in fused if doc_id not in by_id]
+        if missing and has_embedding:
+            for r in self._format_results(self.index().get(missing, query_embedding, documents=False)):
+                by_id[r["_id"]] = r
+
+        results = []
+        for doc_id, score in fused:
+            if doc_id in by_id:
+                hit = by_id[doc_id]
+                hit.score = score
+                results.append(hit)
+        return results
 
-    def enhance_prompt(self, query_embedding: list):
-        results = self.hybrid_search(query_embedding)
+    def enhance_prompt(self, query_embedding: list, query_text: str = None):
+        results = self.hybrid_search(query_embedding, query_text=query_text)
         if not results:
-            print("[DEBUG] No knowledge retrieved from RAG.")
+            logger.debug("No knowledge retrieved from RAG.")
             return ""
 
-        prompt = "\n".join([
-            f"Title: {r['title']}, Content: {r['description']}, Price: {r['price']}, Brand: {r['brand']}"
-            for r in results
-        ])
-        return prompt
+        # Snippet đã render sẵn lúc ingest (CatalogStore), chỉ còn nối chuỗi
+        return "\n".join(r.snippet for r in results)
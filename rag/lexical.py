@@ -0,0 +1,146 @@
+import os
+import re
+import json
+import math
+import heapq
+import unicodedata
+from collections import Counter
+
+def fold_vietnamese(text: str) -> str:
+    """Bỏ dấu tiếng Việt + lowercase: "Điện thoại" -> "dien thoai"."""
+    text = unicodedata.normalize("NFD", (text or "").lower())
+    text = "".join(c for c in text if unicodedata.category(c) != "Mn")
+    return unicodedata.normalize("NFC", text.replace("đ", "d"))
+
+def tokenize(text: str) -> list:
+    """
+    Token không dấu, chữ + số. Token trộn chữ/số được tách thêm phần con
+    ("fold7" -> "fold7", "fold", "7"; "256gb" -> "256gb", "256", "gb") để "Fold 7" vẫn khớp "Fold7".
+    """
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", fold_vietnamese(text)):
+        tokens.append(token)
+        parts = re.findall(r"[a-z]+|[0-9]+", token)
+        if len(parts) > 1:
+            tokens.extend(parts)
+    return tokens
+
+def lexical_text(metadata: dict, document: str = "") -> str:
+    """Text được index cho 1 sản phẩm: tên (x2 để ưu tiên), brand, category và document."""
+    metadata = metadata or {}
+    title = metadata.get("title", "")
+    return " ".join([title, title, metadata.get("brand", ""), metadata.get("tags", ""), document or ""])
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list:
+    """Gộp nhiều danh sách id đã xếp hạng: score(d) = sum 1 / (k + rank). Trả về [(id, score)] giảm dần."""
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class BM25Index:
+    """
+    Inverted index BM25 in-memory, cập nhật incremental (add / remove theo id).
+    Được build + serialize lúc ingest (data_store.py) để app không phải build lại khi khởi động.
+    """
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}   # term -> {doc_id: tf}
+        self.doc_len = {}    # doc_id -> số token
+        self.doc_terms = {}  # doc_id -> [term]: remove chỉ động tới posting của doc đó
+        self.total_len = 0
+        self.catalog_version = None
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, doc_id: str, text: str):
+        if doc_id in self.doc_len:
+            self.remove(doc_id)
+        terms = Counter(tokenize(text))
+        for term, tf in terms.items():
+            self.postings.setdefault(term, {})[doc_id] = tf
+        self.doc_terms[doc_id] = list(terms)
+        length = sum(terms.values())
+        self.doc_len[doc_id] = length
+        self.total_len += length
+
+    def remove(self, doc_id: str):
+        length = self.doc_len.pop(doc_id, None)
+        if length is None:
+            return
+        self.total_len -= length
+        for term in self.doc_terms.pop(doc_id, ()):
+            docs = self.postings.get(term)
+            if docs is not None and docs.pop(doc_id, None) is not None and not docs:
+                del self.postings[term]
+
+    def search(self, query: str, limit: int = 5, allowed_ids=None) -> list:
+        """Trả về [(doc_id, score)] giảm dần theo BM25. allowed_ids: chỉ chấm điểm trong tập này."""
+        if not self.doc_len:
+            return []
+        n_docs = len(self.doc_len)
+        avg_len = self.total_len / n_docs
+        scores = {}
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (n_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, tf in docs.items():
+                if allowed_ids is not None and doc_id not in allowed_ids:
+                    continue
+                norm = tf + self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({
+                "k1": self.k1,
+                "b": self.b,
+                "postings": self.postings,
+                "doc_len": self.doc_len,
+                "doc_terms": self.doc_terms,
+                "catalog_version": self.catalog_version
+            }, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        index = BM25Index(k1=data.get("k1", 1.5), b=data.get("b", 0.75))
+        index.postings = data["postings"]
+        index.doc_len = data["doc_len"]
+        index.total_len = sum(index.doc_len.values())
+        # Term trong doc_terms dùng chung object str với key của postings (không nhân đôi bộ nhớ)
+        terms = {term: term for term in index.postings}
+        if "doc_terms" in data:
+            index.doc_terms = {doc_id: [terms.get(t, t) for t in doc_terms] for doc_id, doc_terms in data["doc_terms"].items()}
+        else:
+            # File cũ chưa có doc_terms: dựng lại từ postings (1 lần lúc load)
+            for term, docs in index.postings.items():
+                for doc_id in docs:
+                    index.doc_terms.setdefault(doc_id, []).append(term)
+        index.catalog_version = data.get("catalog_version")
+        return index
+
+    @staticmethod
+    def build_from_collection(collection):
+        index = BM25Index()
+        data = collection.get(include=["documents", "metadatas"])
+        for doc_id, doc, meta in zip(data.get("ids") or [], data.get("documents") or [], data.get("metadatas") or []):
+            index.add(doc_id, lexical_text(meta, doc))
+        return index
+
+
+def lexical_index_path(db_path: str, collection_name: str) -> str:
+    return os.path.join(db_path, f"{collection_name}.bm25.json")
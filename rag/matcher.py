@@ -0,0 +1,208 @@
+import os
+import re
+import json
+from collections import deque
+from rag.lexical import fold_vietnamese
+from rag.attributes import BRAND_ALIASES, CATEGORY_KEYWORDS, infer_brand
+
+# Cách gọi / viết sai thường gặp (đã bỏ dấu) -> tên chuẩn (đã bỏ dấu)
+SPELLING_ALIASES = {
+    "ai phon": "iphone",
+    "ai phone": "iphone",
+    "iphon": "iphone",
+    "sam sung": "samsung",
+    "samsum": "samsung",
+    "xiao mi": "xiaomi",
+    "xiomi": "xiaomi",
+    "sao mi": "xiaomi",
+    "op po": "oppo",
+    "mac book": "macbook",
+    "lap top": "laptop",
+    "dtdd": "dien thoai",
+    "dt": "dien thoai",
+}
+
+# Từ chung cho thấy câu hỏi về sản phẩm dù không nêu brand / model
+PRODUCT_KEYWORDS = [
+    "dien thoai", "laptop", "may tinh", "may anh", "smartphone", "dien thoai di dong",
+    "may tinh bang", "tablet", "tai nghe", "dong ho thong minh", "smartwatch",
+]
+
+def normalize_for_match(text: str) -> str:
+    """
+    Text dạng chuẩn để match: bỏ dấu, chỉ giữ chữ / số, tách chữ-số ("fold7" -> "fold 7", "256gb" -> "256 gb"),
+    bọc bởi khoảng trắng để pattern " x " chỉ match nguyên từ.
+    """
+    text = re.sub(r"[^a-z0-9]+", " ", fold_vietnamese(text))
+    text = re.sub(r"(?<=[a-z])(?=[0-9])|(?<=[0-9])(?=[a-z])", " ", text)
+    return " " + " ".join(text.split()) + " "
+
+def model_name(title: str) -> str:
+    """Tên model từ tên sản phẩm: bỏ dung lượng / RAM / 5G / inch / năm, cấu hình sau "/" và phần trong ngoặc."""
+    name = re.sub(r"\(.*?\)|/.*$", " ", title or "")
+    name = re.sub(r"(?<= )(\d+ (gb|tb|inch)|5 g|20\d\d)(?= )", " ", normalize_for_match(name))
+    return " ".join(name.split())
+
+
+class AhoCorasick:
+    """Automaton Aho–Corasick trên ký tự: tìm mọi pattern trong 1 lượt quét text (O(len(text) + số match))."""
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+
+    def add(self, pattern: str, payload):
+        state = 0
+        for ch in pattern:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[state][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = nxt
+        self.outputs[state].append((len(pattern), payload))
+
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0) if state else 0
+                self.outputs[nxt] = self.outputs[nxt] + self.outputs[self.fail[nxt]]
+        return self
+
+    def iter(self, text: str):
+        """Yield (start, end, payload) cho mọi lần xuất hiện của các pattern."""
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(ch, 0)
+            for length, payload in self.outputs[state]:
+                yield i - length + 1, i + 1, payload
+
+
+class EntityMatcher:
+    """
+    Nhận diện brand / model / category / từ khoá sản phẩm trong câu hỏi, sinh từ catalog.
+    Pattern được build lúc ingest (<db>/<collection>.entities.json), automaton compile 1 lần mỗi catalog version.
+    """
+    def __init__(self, patterns: list, catalog_version: str = None):
+        """patterns: [[pattern đã normalize, type, value, brand]]."""
+        self.patterns = patterns
+        self.catalog_version = catalog_version
+        self.automaton = AhoCorasick()
+        for pattern, entity_type, value, brand in patterns:
+            self.automaton.add(" " + pattern + " ", (entity_type, value, brand))
+        self.automaton.build()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def match(self, query: str) -> list:
+        """[{"type", "value", "brand", "span"}] theo thứ tự xuất hiện; [] nếu không liên quan sản phẩm."""
+        text = normalize_for_match(query)
+        matches = []
+        seen = set()
+        for start, end, (entity_type, value, brand) in self.automaton.iter(text):
+            if (entity_type, value) in seen:
+                continue
+            seen.add((entity_type, value))
+            matches.append({"type": entity_type, "value": value, "brand": brand, "span": (start, end - 2)})
+        matches.sort(key=lambda m: m["span"])
+        return matches
+
+    @staticmethod
+    def constraints(matches: list) -> dict:
+        """Brand / category từ các entity đã match -> điều kiện lọc cho RAG.hybrid_search."""
+        brands = {m["brand"] for m in matches if m["type"] in ("brand", "model") and m["brand"]}
+        categories = {m["value"] for m in matches if m["type"] == "category"}
+        constraints = {}
+        if brands:
+            constraints["brands"] = sorted(brands)
+        if categories:
+            constraints["categories"] = sorted(categories)
+        return constraints
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"patterns": self.patterns, "catalog_version": self.catalog_version}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def load(path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return EntityMatcher(data["patterns"], data.get("catalog_version"))
+
+    @staticmethod
+    def from_catalog(titles: list, brands: list, categories: list, catalog_version: str = None):
+        """
+        Pattern từ catalog: brand (+ tên dòng máy trong BRAND_ALIASES), model (có / không kèm brand),
+        category (+ CATEGORY_KEYWORDS), từ khoá chung và SPELLING_ALIASES.
+        """
+        patterns = {}   # (pattern, type) -> [pattern, type, value, brand]
+
+        def add(pattern, entity_type, value, brand=""):
+            pattern = normalize_for_match(pattern).strip()
+            if pattern and (pattern, entity_type) not in patterns:
+                patterns[(pattern, entity_type)] = [pattern, entity_type, value, brand]
+
+        brand_keys = {fold_vietnamese(b) for b in brands if b}
+        for brand in sorted(brand_keys):
+            add(brand, "brand", brand, brand)
+        for alias, brand in BRAND_ALIASES.items():
+            if fold_vietnamese(brand) in brand_keys:
+                add(alias, "brand", fold_vietnamese(brand), fold_vietnamese(brand))
+
+        for title in titles:
+            name = model_name(title)
+            if not name:
+                continue
+            brand = fold_vietnamese(infer_brand(title))
+            add(name, "model", name, brand)
+            # Model không kèm brand ("galaxy z fold 7"), chỉ khi còn đủ cụ thể để không match nhầm
+            words = name.split()
+            rest = words[1:]
+            if words and words[0] == brand and len(rest) > 1 and any(len(w) >= 3 and w.isalpha() for w in rest):
+                add(" ".join(rest), "model", name, brand)
+
+        category_keys = {fold_vietnamese(c) for c in categories if c}
+        for category in sorted(category_keys):
+            add(category, "category", category)
+            for keyword in CATEGORY_KEYWORDS.get(category, []):
+                add(keyword, "category", category)
+        for keyword in PRODUCT_KEYWORDS:
+            add(keyword, "keyword", keyword)
+
+        for alias, canonical in SPELLING_ALIASES.items():
+            canonical = normalize_for_match(canonical).strip()
+            for _, entity_type, value, brand in [p for p in patterns.values() if p[0] == canonical]:
+                add(alias, entity_type, value, brand)
+
+        # Pattern sort ổn định -> file entities.json giống nhau giữa các lần ingest cùng data
+        return EntityMatcher(sorted(patterns.values()), catalog_version)
+
+    @staticmethod
+    def build_from_collection(collection, catalog_version: str = None):
+        metadatas = [m or {} for m in (collection.get(include=["metadatas"]).get("metadatas") or [])]
+        return EntityMatcher.from_catalog(
+            titles=[m.get("title", "") for m in metadatas],
+            brands=[infer_brand(m.get("title", ""), m.get("brand", "")) for m in metadatas],
+            categories=[m.get("tags", "") for m in metadatas],
+            catalog_version=catalog_version
+        )
+
+
+def entity_index_path(db_path: str, collection_name: str) -> str:
+    return os.path.join(db_path, f"{collection_name}.entities.json")
@@ -0,0 +1,185 @@
+import os
+import json
+import uuid
+import numpy as np
+
+# Catalog dạng cột (struct-of-arrays) cho kết quả retrieval: mỗi cột text là 1 blob UTF-8 + mảng offset, memory-map
+# (các worker dùng chung page cache, không có 1 dict / str Python cho mỗi sản phẩm). Snippet đưa vào prompt
+# ("Title: ..., Content: ..., Price: ..., Brand: ...") được render 1 lần lúc ingest.
+# Files: <path>.json (ids, columns, catalog_version, build) trỏ tới <path>.<build>.npy (blob uint8) và
+# <path>.<build>.offsets.npy (cột x (n + 1)). Như NumpyIndex: build mới ghi file mới rồi thay .json bằng 1 lần rename,
+# reader luôn thấy ids + blob + offsets của cùng 1 lần build.
+
+COLUMNS = ("title", "description", "price", "brand", "category", "link", "snippet")
+
+def render_snippet(title: str, description: str, price: str, brand: str) -> str:
+    return f"Title: {title}, Content: {description}, Price: {price}, Brand: {brand}"
+
+def product_fields(document: str, metadata: dict) -> dict:
+    """Các cột của 1 sản phẩm từ document + metadata của collection (cùng quy tắc với RAG._format_results cũ)."""
+    meta = metadata if isinstance(metadata, dict) else {}
+    fields = {
+        "title": meta.get("title") or meta.get("name") or "N/A",
+        "description": document or "",
+        "price": meta.get("price", "N/A"),
+        "brand": meta.get("brand", "N/A"),
+        "category": meta.get("tags", "N/A"),
+        "link": meta.get("link") or "",
+    }
+    fields = {key: str(value) for key, value in fields.items()}
+    fields["snippet"] = render_snippet(fields["title"], fields["description"], fields["price"], fields["brand"])
+    return fields
+
+
+class CatalogStore:
+    """Cột text của catalog + map id -> row. Đọc 1 ô chỉ decode đúng đoạn bytes của ô đó."""
+    def __init__(self, path: str, retries: int = 3):
+        self.path = path
+        for attempt in range(retries):
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                info = json.load(f)
+            if tuple(info["columns"]) != COLUMNS:
+                raise ValueError(f"CatalogStore {path}: cột {info['columns']} khác {COLUMNS} (cần build lại)")
+            try:
+                self.blob, self.offsets = self._load_arrays(path, info)
+                break
+            except FileNotFoundError:
+                # Build khác vừa thay .json và xoá file của build cũ -> đọc lại .json
+                if attempt + 1 >= retries:
+                    raise
+        self.ids = info["ids"]
+        self.columns = {name: i for i, name in enumerate(info["columns"])}
+        self.build_id = info.get("build")
+        self.catalog_version = info.get("catalog_version")
+        if self.offsets.shape[1] != len(self.ids) + 1:
+            raise ValueError(f"CatalogStore {path}: offsets và ids không khớp (cần build lại)")
+        self._rows = {doc_id: i for i, doc_id in enumerate(self.ids)}
+        self._view = memoryview(self.blob)   # slice memoryview nhanh hơn nhiều so với slice mảng numpy
+
+    @staticmethod
+    def _load_arrays(path: str, info: dict):
+        if not info["ids"]:
+            return np.zeros(0, dtype=np.uint8), np.zeros((len(COLUMNS), 1), dtype=np.int64)
+        base = f"{path}.{info['build']}" if info.get("build") else path   # không có build: file của bản cũ
+        return np.load(base + ".npy", mmap_mode="r"), np.load(base + ".offsets.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, doc_id):
+        return self._rows.get(doc_id)
+
+    def value(self, row: int, column: str) -> str:
+        if column == "_id":
+            return self.ids[row]
+        start, end = self.offsets[self.columns[column], row:row + 2].tolist()
+        return str(self._view[start:end], "utf-8")
+
+    @staticmethod
+    def build(path: str, ids: list, documents: list, metadatas: list, catalog_version: str = None):
+        """
+        Ghi store ra đĩa như NumpyIndex.build: blob / offsets vào file của build mới, rename .json là bước duy nhất
+        reader thấy được, sau đó xoá file của build trước (worker đã memory-map vẫn đọc được).
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        chunks = []
+        offsets = np.zeros((len(COLUMNS), len(ids) + 1), dtype=np.int64)
+        position = 0
+        rows = [product_fields(doc, meta) for doc, meta in zip(documents, metadatas)]
+        for c, column in enumerate(COLUMNS):
+            for r, fields in enumerate(rows):
+                data = fields[column].encode("utf-8")
+                chunks.append(data)
+                position += len(data)
+                offsets[c, r + 1] = position
+            if c + 1 < len(COLUMNS):
+                offsets[c + 1, 0] = position
+        blob = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+        build = uuid.uuid4().hex[:12]
+        base = f"{path}.{build}"
+        np.save(base + ".npy", blob)
+        np.save(base + ".offsets.npy", offsets)
+
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                previous = json.load(f).get("build")
+            previous = f"{path}.{previous}" if previous else path
+        except (FileNotFoundError, ValueError):
+            previous = None
+
+        with open(path + ".tmp.json", "w", encoding="utf-8") as f:
+            json.dump({"ids": list(ids), "columns": list(COLUMNS), "catalog_version": catalog_version, "build": build}, f, ensure_ascii=False)
+        os.replace(path + ".tmp.json", path + ".json")
+
+        if previous is not None:
+            for stale in (previous + ".npy", previous + ".offsets.npy"):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def build_from_collection(collection, path: str, catalog_version: str = None):
+        data = collection.get(include=["documents", "metadatas"])
+        CatalogStore.build(
+            path,
+            ids=data.get("ids") or [],
+            documents=data.get("documents") or [],
+            metadatas=data.get("metadatas") or [],
+            catalog_version=catalog_version
+        )
+
+
+class ProductHit:
+    """
+    1 kết quả retrieval: tham chiếu (store, row) + distance / score, chưa tạo dict hay str nào.
+    Đọc như dict cũ (hit["title"], hit.get("price")); to_dict() khi cần serialize (JSON response).
+    """
+    __slots__ = ("store", "row", "distance", "score")
+
+    FIELDS = ("_id", "title", "description", "price", "brand", "category")
+
+    def __init__(self, store: CatalogStore, row: int, distance: float, score: float = None):
+        self.store = store
+        self.row = row
+        self.distance = distance
+        self.score = score
+
+    @property
+    def snippet(self) -> str:
+        return self.store.value(self.row, "snippet")
+
+    @property
+    def link(self) -> str:
+        return self.store.value(self.row, "link")
+
+    def __getitem__(self, key):
+        if key == "distance":
+            return self.distance
+        if key == "score" and self.score is not None:
+            return self.score
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return self.store.value(self.row, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        item = {field: self.store.value(self.row, field) for field in self.FIELDS}
+        item["distance"] = self.distance
+        if self.score is not None:
+            item["score"] = self.score
+        return item
+
+    def __repr__(self):
+        return f"ProductHit({self.store.ids[self.row]!r}, distance={self.distance:.4f})"
+
+
+def records_path(db_path: str, collection_name: str) -> str:
+    return os.path.join(db_path, f"{collection_name}.records")
@@ -0,0 +1,183 @@
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+from resources import reinit_after_fork, release_chroma_collection
+from metrics import CATALOG_LOAD_SECONDS, CATALOG_EVICTIONS
+from rag.core import RAG
+
+logger = logging.getLogger(__name__)
+
+# Nhiều catalog (mỗi catalog là 1 collection trong cùng db_path) trong 1 process:
+# - RAG của từng catalog được tạo + load index (vector / BM25 / attribute / entity / record) ở lần dùng đầu tiên.
+# - LRU: tổng bộ nhớ index đang load (RAG.resident_bytes: mảng + object Python, HNSW ước lượng) vượt max_bytes
+#   -> evict catalog lâu không dùng (catalog pinned thì không). Request đang dùng catalog bị evict vẫn chạy bình
+#   thường (giữ reference tới RAG), index được giải phóng sau đó.
+# - Catalog tạo lazy mặc định dùng backend numpy: Chroma 1.x không giải phóng được HNSW của riêng 1 collection
+#   trong client dùng chung, còn NumpyIndex / BM25 / CatalogStore được giải phóng hết khi bỏ reference.
+# - catalog_scope(rag): RAG của request hiện tại (contextvar, như metrics.request_scope), agent đọc qua current_catalog().
+
+_current = contextvars.ContextVar("catalog_rag", default=None)
+
+def current_catalog():
+    """RAG của catalog trong request hiện tại, None nếu không có catalog_scope."""
+    return _current.get()
+
+@contextmanager
+def catalog_scope(rag):
+    token = _current.set(rag)
+    try:
+        yield rag
+    finally:
+        try:
+            _current.reset(token)
+        except ValueError:
+            # Generator SSE bị đóng từ context khác -> chỉ cần bỏ giá trị
+            _current.set(None)
+
+
+class _Entry:
+    __slots__ = ("rag", "pinned", "loaded", "load_ms", "bytes", "generation", "hits", "last_used", "lock")
+
+    def __init__(self, rag: RAG, pinned: bool = False):
+        self.rag = rag
+        self.pinned = pinned
+        self.loaded = False
+        self.load_ms = None
+        self.bytes = 0
+        self.generation = None   # RAG.generation lúc tính `bytes`
+        self.hits = 0
+        self.last_used = None
+        self.lock = threading.Lock()
+
+
+class CatalogRegistry:
+    """
+    RAG theo catalog id, load lazy, evict LRU theo memory budget.
+    catalogs: danh sách catalog id (tên collection) được phục vụ; None -> chỉ các catalog đã register.
+    backend: backend vector của catalog tạo lazy ("chroma": HNSW vẫn nằm trong cache Chroma sau khi evict).
+    """
+    def __init__(self, db_path: str, backend: str = "numpy", max_bytes: int = 1024 * 1024 * 1024, catalogs: list = None):
+        self.db_path = db_path
+        self.backend = backend
+        self.max_bytes = max_bytes
+        self.catalogs = set(catalogs or ())
+        self._entries = OrderedDict()   # catalog id -> _Entry, cũ -> mới theo lần dùng
+        self._loads = {}       # catalog id -> số lần load (giữ cả sau khi bị evict)
+        self._evictions = {}
+        self._lock = threading.Lock()
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        """Sau fork: lock mới (index đã load ở master được dùng chung trang nhớ, giữ nguyên)."""
+        self._lock = threading.Lock()
+        for entry in self._entries.values():
+            entry.lock = threading.Lock()
+
+    def register(self, catalog_id: str, rag: RAG = None, pinned: bool = False) -> RAG:
+        """Thêm catalog (RAG có sẵn hoặc tạo mới, chưa load). pinned: không bao giờ bị evict."""
+        with self._lock:
+            entry = self._entries.get(catalog_id)
+            if entry is None:
+                entry = self._entries[catalog_id] = _Entry(rag or RAG(catalog_id, self.db_path, backend=self.backend), pinned)
+            entry.pinned = entry.pinned or pinned
+            self.catalogs.add(catalog_id)
+            return entry.rag
+
+    def __contains__(self, catalog_id: str) -> bool:
+        return catalog_id in self.catalogs
+
+    def get(self, catalog_id: str) -> RAG:
+        """RAG của catalog (load index nếu chưa load / đã bị evict). Catalog không được phục vụ -> KeyError."""
+        if catalog_id not in self.catalogs:
+            raise KeyError(catalog_id)
+        with self._lock:
+            entry = self._entries.get(catalog_id)
+            if entry is None:
+                entry = self._entries[catalog_id] = _Entry(RAG(catalog_id, self.db_path, backend=self.backend))
+            self._entries.move_to_end(catalog_id)
+            entry.hits += 1
+            entry.last_used = time.time()
+        if not entry.loaded:
+            self._load(catalog_id, entry)
+        elif entry.generation != entry.rag.generation:
+            self._refresh(catalog_id, entry)
+        return entry.rag
+
+    def _load(self, catalog_id: str, entry: _Entry, open_stores: bool = True):
+        # Lock riêng từng catalog: load catalog này không chặn request của catalog khác
+        with entry.lock:
+            if entry.loaded:
+                return
+            started = time.perf_counter()
+            entry.rag.warmup(open_stores=open_stores)
+            elapsed = time.perf_counter() - started
+            entry.load_ms = round(elapsed * 1000, 1)
+            entry.generation = entry.rag.generation
+            entry.bytes = sum(entry.rag.resident_bytes().values())
+            entry.loaded = open_stores
+        with self._lock:
+            self._loads[catalog_id] = self._loads.get(catalog_id, 0) + 1
+        CATALOG_LOAD_SECONDS.observe(elapsed, catalog=catalog_id)
+        logger.info("Catalog %s: load %.0f ms, %.1f MB", catalog_id, entry.load_ms, entry.bytes / 1e6)
+        self._evict(keep=catalog_id)
+
+    def _refresh(self, catalog_id: str, entry: _Entry):
+        """Index của catalog đã load lại (catalog đổi version): tính lại dung lượng rồi evict nếu vượt budget."""
+        with entry.lock:
+            generation = entry.rag.generation
+            if entry.generation == generation:
+                return
+            entry.generation = generation
+            entry.bytes = sum(entry.rag.resident_bytes().values())
+        logger.info("Catalog %s: index load lại, %.1f MB", catalog_id, entry.bytes / 1e6)
+        self._evict(keep=catalog_id)
+
+    def _evict(self, keep: str = None):
+        """Evict LRU (trừ catalog pinned / vừa load) tới khi tổng dung lượng <= max_bytes."""
+        with self._lock:
+            total = sum(e.bytes for e in self._entries.values())
+            for catalog_id in list(self._entries):
+                if total <= self.max_bytes:
+                    break
+                entry = self._entries[catalog_id]
+                if entry.pinned or catalog_id == keep or not entry.loaded:
+                    continue
+                del self._entries[catalog_id]
+                release_chroma_collection(self.db_path, catalog_id)
+                total -= entry.bytes
+                self._evictions[catalog_id] = self._evictions.get(catalog_id, 0) + 1
+                CATALOG_EVICTIONS.inc(catalog=catalog_id)
+                logger.info("Evict catalog %s (%.1f MB), còn %.1f MB", catalog_id, entry.bytes / 1e6, total / 1e6)
+            if total > self.max_bytes:
+                logger.warning("Index đang load (%.1f MB) vượt memory budget %.1f MB", total / 1e6, self.max_bytes / 1e6)
+
+    def warmup(self, open_stores: bool = True):
+        """Load trước các catalog pinned (catalog mặc định), xem app.warmup."""
+        for catalog_id, entry in list(self._entries.items()):
+            if entry.pinned:
+                self._load(catalog_id, entry, open_stores=open_stores)
+
+    def stats(self) -> dict:
+        """Theo catalog: đã load chưa, thời gian load lần gần nhất, dung lượng index, số lần dùng / load / evict."""
+        with self._lock:
+            entries = list(self._entries.items())
+            loads, evictions = dict(self._loads), dict(self._evictions)
+        catalogs = {
+            catalog_id: {"resident": False, "bytes": 0, "load_ms": None, "hits": 0,
+                         "loads": loads.get(catalog_id, 0), "evictions": count}
+            for catalog_id, count in evictions.items()
+        }
+        for catalog_id, entry in entries:
+            catalogs[catalog_id] = {
+                "resident": entry.loaded, "pinned": entry.pinned, "bytes": entry.bytes, "load_ms": entry.load_ms,
+                "hits": entry.hits, "loads": loads.get(catalog_id, 0), "last_used": entry.last_used,
+                "evictions": evictions.get(catalog_id, 0)
+            }
+        return {
+            "max_bytes": self.max_bytes,
+            "resident_bytes": sum(c["bytes"] for c in catalogs.values() if c["resident"]),
+            "catalogs": catalogs
+        }
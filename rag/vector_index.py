@@ -0,0 +1,249 @@
+import os
+import json
+import uuid
+import numpy as np
+
+# Các index đều trả về kết quả cùng dạng với collection.query của Chroma
+# ({"ids", "documents", "metadatas", "distances"}: list theo từng query) để RAG._format_results dùng chung.
+
+# Mỗi vector trong HNSW của Chroma: dim x float32 + link level 0 (2 x M, M mặc định 16, int32) + label / header
+HNSW_ELEMENT_OVERHEAD = 2 * 16 * 4 + 16
+
+class ChromaIndex:
+    """Backend mặc định: query thẳng vào collection Chroma (HNSW)."""
+    def __init__(self, collection):
+        self.collection = collection
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Ước lượng bộ nhớ HNSW của collection khi được load (Chroma không báo con số thật):
+        số vector x (dim x 4 byte + HNSW_ELEMENT_OVERHEAD).
+        """
+        count = self.collection.count()
+        if not count:
+            return 0
+        sample = self.collection.get(limit=1, include=["embeddings"])["embeddings"]
+        dim = len(sample[0]) if sample is not None and len(sample) else 0
+        return count * (dim * 4 + HNSW_ELEMENT_OVERHEAD)
+
+    def query(self, query_embeddings: list, n_results: int, ids: list = None, documents: bool = True):
+        """
+        ids: chỉ search trong tập id này (pre-filter theo thuộc tính).
+        documents=False: chỉ lấy ids + distances (nội dung đọc từ CatalogStore).
+        """
+        include = ["documents", "metadatas", "distances"] if documents else ["distances"]
+        if ids is None:
+            return self.collection.query(query_embeddings=query_embeddings, n_results=n_results, include=include)
+        return self.collection.query(query_embeddings=query_embeddings, n_results=min(n_results, len(ids)), ids=list(ids), include=include)
+
+    def get(self, ids: list, query_embedding: list, documents: bool = True):
+        """Lấy document theo id, kèm distance tới query_embedding (dạng kết quả của 1 query)."""
+        data = self.collection.get(ids=list(ids), include=["embeddings", "documents", "metadatas"] if documents else ["embeddings"])
+        vectors = np.asarray(data["embeddings"], dtype=np.float32)
+        distances = pairwise_distances(
+            np.asarray([query_embedding], dtype=np.float32),
+            vectors,
+            np.einsum("ij,ij->i", vectors, vectors) if len(vectors) else np.zeros(0, dtype=np.float32),
+            collection_space(self.collection)
+        )[0] if len(vectors) else []
+        return {
+            "ids": [list(data["ids"])],
+            "documents": [list(data["documents"] or [])],
+            "metadatas": [list(data["metadatas"] or [])],
+            "distances": [[float(d) for d in distances]]
+        }
+
+
+class NumpyIndex:
+    """
+    Index in-process: toàn bộ embedding nằm trong 1 ma trận float32 liên tục.
+    - File .npy được memory-map (mmap_mode="r") nên các worker process dùng chung page cache.
+    - Score = 1 phép nhân ma trận-vector, top-k bằng argpartition (exact, không xấp xỉ như HNSW).
+    - distance tính cùng metric với collection Chroma (l2 / cosine / ip) để kết quả thay thế được nhau.
+    Files: <path>.json (ids, space, catalog_version, build) trỏ tới <path>.<build>.npy (vectors) và
+    <path>.<build>.norms.npy (||x||^2). Build mới ghi file mới rồi thay .json bằng 1 lần rename, nên reader luôn
+    thấy ids + vectors của cùng 1 lần build. Index chỉ có ids + distances, nội dung đọc từ CatalogStore.
+    """
+    def __init__(self, path: str, retries: int = 3):
+        self.path = path
+        for attempt in range(retries):
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                info = json.load(f)
+            try:
+                self.vectors, self.sq_norms = self._load_arrays(path, info)
+                break
+            except FileNotFoundError:
+                # Build khác vừa thay .json và xoá file của build cũ -> đọc lại .json
+                if attempt + 1 >= retries:
+                    raise
+        if self.vectors.shape[0] != len(info["ids"]) or self.sq_norms.shape[0] != len(info["ids"]):
+            raise ValueError(f"NumpyIndex {path}: vectors và ids không khớp (cần build lại)")
+        self.ids = info["ids"]
+        self.build_id = info.get("build")
+        self.space = info.get("space", "l2")
+        self.catalog_version = info.get("catalog_version")
+        self._rows = {doc_id: i for i, doc_id in enumerate(self.ids)}
+
+    @staticmethod
+    def _load_arrays(path: str, info: dict):
+        if not info["ids"]:
+            return np.zeros((0, 0), dtype=np.float32), np.zeros((0,), dtype=np.float32)
+        base = f"{path}.{info['build']}" if info.get("build") else path   # không có build: file của bản cũ
+        return np.load(base + ".npy", mmap_mode="r"), np.load(base + ".norms.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def nbytes(self) -> int:
+        """Dung lượng vectors + norms (memory-map) + bảng id."""
+        return int(self.vectors.nbytes + self.sq_norms.nbytes + os.path.getsize(self.path + ".json"))
+
+    def query(self, query_embeddings: list, n_results: int, rows=None, documents: bool = False):
+        """
+        Batched: score nhiều query cùng lúc bằng 1 phép nhân ma trận.
+        rows: chỉ score các row này (pre-filter theo thuộc tính), xem rows_for().
+        documents: giữ cho cùng interface với ChromaIndex; documents / metadatas luôn rỗng.
+        """
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        if len(self.ids) == 0 or (rows is not None and len(rows) == 0):
+            for _ in query_embeddings:
+                for key in result:
+                    result[key].append([])
+            return result
+
+        queries = np.asarray(query_embeddings, dtype=np.float32)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if rows is None:
+            distances = self._distances(queries)
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            distances = pairwise_distances(queries, self.vectors[rows], self.sq_norms[rows], self.space)
+
+        k = min(n_results, distances.shape[1])
+        for row in distances:
+            top = np.argpartition(row, k - 1)[:k] if k < len(row) else np.arange(len(row))
+            top = top[np.argsort(row[top], kind="stable")]
+            index_rows = top if rows is None else rows[top]
+            result["ids"].append([self.ids[i] for i in index_rows])
+            result["documents"].append([])
+            result["metadatas"].append([])
+            result["distances"].append([float(row[i]) for i in top])
+        return result
+
+    def rows_for(self, ids) -> np.ndarray:
+        """Row trong ma trận của các id (-1 nếu id không có trong index)."""
+        return np.fromiter((self._rows.get(i, -1) for i in ids), dtype=np.int64)
+
+    def get(self, ids: list, query_embedding: list, documents: bool = False):
+        """Các id có trong index, kèm distance tới query_embedding (dạng kết quả của 1 query)."""
+        rows = self.rows_for(ids)
+        rows = rows[rows >= 0]
+        distances = pairwise_distances(
+            np.asarray([query_embedding], dtype=np.float32),
+            self.vectors[rows],
+            self.sq_norms[rows],
+            self.space
+        )[0] if len(rows) else []
+        return {
+            "ids": [[self.ids[i] for i in rows]],
+            "documents": [[]],
+            "metadatas": [[]],
+            "distances": [[float(d) for d in distances]]
+        }
+
+    def _distances(self, queries: np.ndarray) -> np.ndarray:
+        return pairwise_distances(queries, self.vectors, self.sq_norms, self.space)
+
+    @staticmethod
+    def build(path: str, ids: list, embeddings, space: str = "l2", catalog_version: str = None, chunk_size: int = 65536):
+        """
+        Ghi index ra đĩa: vectors / norms vào file của build mới, sau đó rename .json (trỏ tới build mới) là bước
+        duy nhất reader thấy được. File của build trước được xoá sau đó (worker đã memory-map vẫn đọc được).
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        count = len(ids)
+        dim = len(embeddings[0]) if count else 0
+        build = uuid.uuid4().hex[:12]
+        base = f"{path}.{build}"
+
+        vectors = np.lib.format.open_memmap(base + ".npy", mode="w+", dtype=np.float32, shape=(count, dim))
+        sq_norms = np.lib.format.open_memmap(base + ".norms.npy", mode="w+", dtype=np.float32, shape=(count,))
+        for start in range(0, count, chunk_size):
+            chunk = np.asarray(embeddings[start:start + chunk_size], dtype=np.float32)
+            vectors[start:start + len(chunk)] = chunk
+            sq_norms[start:start + len(chunk)] = np.einsum("ij,ij->i", chunk, chunk)
+        vectors.flush()
+        sq_norms.flush()
+        del vectors, sq_norms
+
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as f:
+                previous = json.load(f).get("build")
+            previous = f"{path}.{previous}" if previous else path
+        except (FileNotFoundError, ValueError):
+            previous = None
+
+        with open(path + ".tmp.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "ids": list(ids),
+                "space": space,
+                "catalog_version": catalog_version,
+                "build": build
+            }, f, ensure_ascii=False)
+        os.replace(path + ".tmp.json", path + ".json")
+
+        if previous is not None:
+            for stale in (previous + ".npy", previous + ".norms.npy"):
+                try:
+                    os.remove(stale)
+                except FileNotFoundError:
+                    pass
+
+    @staticmethod
+    def build_from_collection(collection, path: str, catalog_version: str = None):
+        """Export toàn bộ embedding của collection Chroma sang NumpyIndex."""
+        data = collection.get(include=["embeddings"])
+        embeddings = data.get("embeddings")
+        if embeddings is None:
+            embeddings = []
+        NumpyIndex.build(
+            path,
+            ids=data.get("ids") or [],
+            embeddings=embeddings,
+            space=collection_space(collection),
+            catalog_version=catalog_version
+        )
+
+
+def pairwise_distances(queries: np.ndarray, vectors: np.ndarray, sq_norms: np.ndarray, space: str) -> np.ndarray:
+    """Ma trận distance (số query x số vector) theo metric của Chroma, nhỏ hơn = gần hơn."""
+    dots = queries @ vectors.T
+    if space == "ip":
+        return 1.0 - dots
+    if space == "cosine":
+        q_norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        q_norms[q_norms == 0] = 1.0
+        x_norms = np.sqrt(sq_norms)
+        x_norms = np.where(x_norms == 0, 1.0, x_norms)
+        return 1.0 - dots / (q_norms * x_norms[None, :])
+    # l2 (Chroma trả về squared L2)
+    q_sq = np.einsum("ij,ij->i", queries, queries)[:, None]
+    return np.maximum(q_sq + sq_norms[None, :] - 2.0 * dots, 0.0)
+
+
+def collection_space(collection) -> str:
+    """Metric của collection Chroma: metadata "hnsw:space" (bản cũ) hoặc configuration["hnsw"]["space"]."""
+    space = (collection.metadata or {}).get("hnsw:space")
+    if not space:
+        configuration = getattr(collection, "configuration", None) or {}
+        space = (configuration.get("hnsw") or {}).get("space") if isinstance(configuration, dict) else None
+    return space or "l2"
+
+
+def numpy_index_path(db_path: str, collection_name: str) -> str:
+    return os.path.join(db_path, f"{collection_name}.vectors")
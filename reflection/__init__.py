@@ -1 +1,3 @@
 from reflection.core import Reflection
+from reflection.semantic_cache import SemanticCache
+from reflection.context import ContextBuilder, TokenCounter
@@ -0,0 +1,148 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from resources import reinit_after_fork
+
+logger = logging.getLogger(__name__)
+
+OPEN_AI_ROLE_MAPPING = {"human": "user", "ai": "assistant"}
+
+MESSAGE_OVERHEAD_TOKENS = 4  # token phụ cho mỗi message (role, phân cách) theo format chat của OpenAI
+
+SUMMARY_PROMPT = """Bạn đang tóm tắt cuộc trò chuyện giữa khách hàng và chatbot cửa hàng điện thoại/laptop.
+Cập nhật bản tóm tắt hiện có với các tin nhắn mới. Giữ lại: sản phẩm khách quan tâm, nhu cầu, ngân sách,
+thông tin / giá đã tư vấn và các câu hỏi còn dang dở. Viết tiếng Việt, tối đa {max_words} từ, chỉ trả về bản tóm tắt.
+
+Tóm tắt hiện có:
+{summary}
+
+Tin nhắn mới:
+{messages}"""
+
+
+class TokenCounter:
+    """Đếm token bằng tiktoken (local, không gọi API). Không có tiktoken / encoding thì ước lượng theo số ký tự."""
+    def __init__(self, encoding_name: str = "o200k_base"):
+        self.encoding_name = encoding_name
+        self._encoding = None
+        self._loaded = False
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self._get_encoding()
+        if encoding is None:
+            return len(text) // 3 + 1
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_message(self, message: dict) -> int:
+        return self.count(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+    def _get_encoding(self):
+        if not self._loaded:
+            try:
+                import tiktoken
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception:
+                self._encoding = None
+            self._loaded = True
+        return self._encoding
+
+
+class ContextBuilder:
+    """
+    Ghép history của session vào prompt trong giới hạn token:
+    - Giữ nguyên văn các message gần nhất cho đến khi hết `max_tokens`.
+    - Các message cũ hơn được thay bằng summary cuốn chiếu lưu trong `summary_store`; summary được cập nhật
+      incremental ở background (chỉ tóm tắt phần message mới rơi khỏi cửa sổ) thay vì tính lại mỗi request.
+    Dùng chung cho prompt rewrite, prompt trả lời của agent và Reflection.
+    """
+    def __init__(self, history_store, summary_store=None, llm=None, max_tokens: int = 1500, max_messages: int = None,
+                 summary_max_words: int = 150, min_summary_messages: int = 2, counter: TokenCounter = None):
+        """
+        max_messages: số message cuối tối đa đọc từ history_store mỗi request (None = toàn bộ).
+        min_summary_messages: chỉ gọi LLM tóm tắt khi có ít nhất chừng này message mới rơi khỏi cửa sổ.
+        Summary cần history_store có `between` (id message tăng dần, vd SQLiteHistoryStore).
+        """
+        self.history_store = history_store
+        self.summary_store = summary_store
+        self.llm = llm
+        self.max_tokens = max_tokens
+        self.max_messages = max_messages
+        self.summary_max_words = summary_max_words
+        self.min_summary_messages = min_summary_messages
+        self.counter = counter or TokenCounter()
+        self._reopen()
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        # Gọi lại sau fork: thread tóm tắt của process cha không còn trong process con
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-summary")
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    @property
+    def summaries_enabled(self) -> bool:
+        return self.summary_store is not None and self.llm is not None and hasattr(self.history_store, "between")
+
+    def messages(self, session_id: str, max_messages: int = None) -> list:
+        """Message OpenAI cho history của session: [system summary] + các turn gần nhất (cũ -> mới)."""
+        rows = self.history_store.recent(session_id, max_messages or self.max_messages)
+        summary, summarized_id = self.summary_store.get(session_id) if self.summaries_enabled else ("", 0)
+        summary_message = {"role": "system", "content": f"Tóm tắt cuộc trò chuyện trước đó: {summary}"} if summary else None
+
+        budget = self.max_tokens - (self.counter.count_message(summary_message) if summary_message else 0)
+        kept = []
+        used = 0
+        for row in reversed(rows):
+            if self.summaries_enabled and row["id"] is not None and row["id"] <= summarized_id:
+                break  # đã nằm trong summary (row id None: chưa ghi xuống store, luôn mới hơn summary)
+            message = {"role": OPEN_AI_ROLE_MAPPING.get(row["type"], "user"), "content": row["content"]}
+            cost = self.counter.count_message(message)
+            if used + cost > budget:
+                break
+            kept.append(message)
+            used += cost
+        kept.reverse()
+
+        # Chỉ tóm tắt message đã ghi xuống store (between đọc từ store)
+        dropped = [row for row in rows[:len(rows) - len(kept)] if row["id"] is not None]
+        if self.summaries_enabled and dropped:
+            unsummarized = [row for row in dropped if row["id"] > summarized_id]
+            if len(unsummarized) >= self.min_summary_messages:
+                self._schedule_summary(session_id, before_id=dropped[-1]["id"] + 1)
+
+        return ([summary_message] if summary_message else []) + kept
+
+    def wait(self):
+        """Chờ các lần cập nhật summary đang chạy (dùng khi shutdown / benchmark)."""
+        self._executor.submit(lambda: None).result()
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def _schedule_summary(self, session_id: str, before_id: int):
+        with self._pending_lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+        self._executor.submit(self._update_summary, session_id, before_id)
+
+    def _update_summary(self, session_id: str, before_id: int):
+        try:
+            summary, summarized_id = self.summary_store.get(session_id)
+            rows = self.history_store.between(session_id, summarized_id, before_id)
+            if not rows:
+                return
+            new_summary = self.llm.chat([{"role": "user", "content": SUMMARY_PROMPT.format(
+                max_words=self.summary_max_words,
+                summary=summary or "(chưa có)",
+                messages="\n".join(f"{OPEN_AI_ROLE_MAPPING.get(r['type'], 'user')}: {r['content']}" for r in rows)
+            )}])
+            self.summary_store.put(session_id, (new_summary or "").strip(), rows[-1]["id"])
+            logger.debug("Updated summary for session %s (đến message %s)", session_id, rows[-1]["id"])
+        except Exception:
+            logger.exception("Summary update failed for session %s", session_id)
+        finally:
+            with self._pending_lock:
+                self._pending.discard(session_id)
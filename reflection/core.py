@@ -1,19 +1,11 @@
-import chromadb
-import uuid
-import json
+import asyncio
+from history import ChromaHistoryStore
+from reflection.semantic_cache import SemanticCache
+from reflection.context import ContextBuilder, OPEN_AI_ROLE_MAPPING
+from metrics import span, CACHE_LOOKUPS
+from resources import LazyCollection, chroma_client, import_chroma
 
-OPEN_AI_ROLE_MAPPING = {"human": "user", "ai": "assistant"}
-
-class Reflection:
-    def __init__(self, llm, db_path: str, dbChatHistoryCollection: str, semanticCacheCollection: str):
-        self.client = chromadb.PersistentClient(path=db_path)
-        self.his_collection = self.client.get_or_create_collection(name=dbChatHistoryCollection)
-        self.semantic_cache_collection = self.client.get_or_create_collection(name=semanticCacheCollection)
-        self.llm = llm
-
-    def chat(self, session_id: str, enhanced_message: str, original_message: str = '', cache_response: bool = False, query_embedding: list = None):
-        # Build full prompt with context
-        system_prompt_content = """Bạn là chatbot cửa hàng bán điện thoại/laptop. Vai trò của bạn là hỗ trợ khách hàng trong việc tìm hiểu về các sản phẩm và dịch vụ của cửa hàng, cũng như tạo một trải nghiệm mua sắm dễ chịu và thân thiện. Bạn có thể trả lời các câu hỏi về loại hoa, dịch vụ giao hàng. Bạn cũng có thể trò chuyện với khách hàng về các chủ đề không liên quan đến sản phẩm như thời tiết, sở thích cá nhân, và những câu chuyện thú vị để tạo sự gắn kết. 
+SYSTEM_PROMPT = """Bạn là chatbot cửa hàng bán điện thoại/laptop. Vai trò của bạn là hỗ trợ khách hàng trong việc tìm hiểu về các sản phẩm và dịch vụ của cửa hàng, cũng như tạo một trải nghiệm mua sắm dễ chịu và thân thiện. Bạn có thể trả lời các câu hỏi về loại hoa, dịch vụ giao hàng. Bạn cũng có thể trò chuyện với khách hàng về các chủ đề không liên quan đến sản phẩm như thời tiết, sở thích cá nhân, và những câu chuyện thú vị để tạo sự gắn kết. 
 Hãy luôn giữ thái độ lịch sự và chuyên nghiệp. Nếu khách hàng hỏi về sản phẩm cụ thể, hãy cung cấp thông tin chi tiết và gợi ý các lựa chọn phù hợp. Nếu khách hàng trò chuyện về các chủ đề không liên quan đến sản phẩm, hãy tham gia vào cuộc trò chuyện một cách vui vẻ và thân thiện.
 một số điểm chính bạn cần lưu ý:
 1. Đáp ứng nhanh chóng và chính xác, sử dụng xưng hô là "Mình và bạn".
@@ -21,70 +13,134 @@ một số điểm chính bạn cần lưu ý:
 3. Cung cấp thông tin hữu ích về tiệm bánh và dịch vụ của cửa hàng.
 4. Giữ cho cuộc trò chuyện mang tính chất hỗ trợ và giúp đỡ.
 Hãy làm cho khách hàng cảm thấy được chào đón và quan tâm!"""
-        system_prompt = [{"role": "system", "content": system_prompt_content}]
-        session_msgs = self.__construct_session_messages__(session_id)
-        user_prompt = [{"role": "user", "content": enhanced_message}]
-        messages = system_prompt + session_msgs + user_prompt
 
-        response_text = self.llm.chat(messages)
+class Reflection:
+    """
+    Chat có history (fallback của agent). Các stage history / llm / record / cache được ghi qua metrics.span,
+    nên nằm trong timings + request id của request đang chạy (metrics.request_scope).
+    """
+    def __init__(self, llm, db_path: str, dbChatHistoryCollection: str, semanticCacheCollection: str, history_store=None, max_history_items: int = None, semantic_cache=None, async_llm=None, context_builder=None):
+        """
+        history_store: backend lưu chat history (append/recent). Mặc định dùng collection Chroma cũ.
+        max_history_items: số message history tối đa đọc cho mỗi prompt (None = toàn bộ).
+        context_builder: ContextBuilder ghép history theo token budget (+ summary). Mặc định: budget mặc định, không summary.
+        semantic_cache: SemanticCache đọc/ghi semanticCacheCollection (mặc định: cấu hình mặc định).
+        async_llm: AsyncOpenAiClient cho achat / achat_stream (đường ASGI).
+        """
+        self.db_path = db_path
+        self.his_collection = LazyCollection(db_path, dbChatHistoryCollection)
+        self.semantic_cache_collection = LazyCollection(db_path, semanticCacheCollection)
+        self.history_store = history_store or ChromaHistoryStore(self.his_collection)
+        self.semantic_cache = semantic_cache or SemanticCache(self.semantic_cache_collection)
+        self.max_history_items = max_history_items
+        self.context_builder = context_builder or ContextBuilder(self.history_store, max_messages=max_history_items)
+        self.llm = llm
+        self.async_llm = async_llm
+
+    @property
+    def client(self):
+        return chroma_client(self.db_path)
 
-        # Lưu history
-        self.__record_human_prompt__(session_id, enhanced_message, original_message)
-        self.__record_ai_response__(session_id, response_text)
+    def warmup(self, open_stores: bool = True):
+        """Load tokenizer của ContextBuilder và mở trước collection semantic cache (open_stores=False: chỉ import chromadb)."""
+        if open_stores:
+            self.semantic_cache.collection.count()
+        else:
+            import_chroma()
+        self.context_builder.counter.count("warmup")
 
-        # Cache nếu cần
+    def chat(self, session_id: str, enhanced_message: str, original_message: str = '', cache_response: bool = False, query_embedding: list = None, deadline=None):
+        """deadline (admission.Deadline): giới hạn call LLM như đường trả lời sản phẩm của agent."""
+        # Trả lời từ semantic cache nếu có câu hỏi tương tự
         if cache_response and query_embedding:
-            self.__cache_ai_response__(enhanced_message, original_message, response_text, query_embedding)
+            with span("cache"):
+                cached = self.__lookup_cached_response__(query_embedding)
+            if cached is not None:
+                with span("record"):
+                    self.__record_turn__(session_id, enhanced_message, original_message, cached)
+                return cached
+
+        with span("history"):
+            messages = self.__build_messages__(session_id, enhanced_message)
+        with span("llm"):
+            response_text = self.llm.chat(messages, deadline=deadline)
+
+        # Lưu history + cache nếu cần
+        with span("record"):
+            self.__record_turn__(session_id, enhanced_message, original_message, response_text)
+            if cache_response and query_embedding:
+                self.__cache_ai_response__(enhanced_message, original_message, response_text, query_embedding)
 
         return response_text
 
-    def __construct_session_messages__(self, session_id: str):
-        session_messages = self.his_collection.get(where_document={"$contains": session_id})
-        result = []
-        if not session_messages.get('ids'):
-            return result
-        for doc in session_messages.get('documents', []):
-            hist = json.loads(doc).get('History', {})
-            role = OPEN_AI_ROLE_MAPPING.get(hist.get('type', 'human'), 'user')
-            content = hist.get('data', {}).get('content', '')
-            result.append({"role": role, "content": content})
-        return result
-
-    def __record_human_prompt__(self, session_id, enhanced_message, original_message):
-        self.his_collection.add(
-            ids=[str(uuid.uuid4())],
-            documents=[json.dumps({
-                "SessionId": session_id,
-                "History": {
-                    "type": "human",
-                    "data": {
-                        "type": "human",
-                        "content": original_message,
-                        "enhanced_content": enhanced_message
-                    }
-                }
-            })]
-        )
-
-    def __record_ai_response__(self, session_id, response_text):
-        self.his_collection.add(
-            ids=[str(uuid.uuid4())],
-            documents=[json.dumps({
-                "SessionId": session_id,
-                "History": {
-                    "type": "ai",
-                    "data": {"type": "ai", "content": response_text}
-                }
-            })]
-        )
+    def chat_stream(self, session_id: str, enhanced_message: str, original_message: str = '', deadline=None):
+        """Giống chat nhưng yield từng đoạn text; history chỉ lưu khi stream hoàn tất (hết deadline giữa chừng -> không lưu)."""
+        with span("history"):
+            messages = self.__build_messages__(session_id, enhanced_message)
+        chunks = []
+        with span("llm"):
+            stream = self.llm.chat_stream(messages, deadline=deadline)
+            try:
+                for delta in stream:
+                    chunks.append(delta)
+                    yield delta
+            finally:
+                stream.close()
+
+        with span("record"):
+            self.__record_turn__(session_id, enhanced_message, original_message, "".join(chunks))
+
+    async def achat(self, session_id: str, enhanced_message: str, original_message: str = '', deadline=None):
+        """Bản async của chat: gọi async_llm, đọc/ghi history trong thread pool."""
+        with span("history"):
+            messages = await asyncio.to_thread(self.__build_messages__, session_id, enhanced_message)
+        with span("llm"):
+            response_text = await self.async_llm.chat(messages, deadline=deadline)
+        with span("record"):
+            await asyncio.to_thread(self.__record_turn__, session_id, enhanced_message, original_message, response_text)
+        return response_text
+
+    async def achat_stream(self, session_id: str, enhanced_message: str, original_message: str = '', deadline=None):
+        with span("history"):
+            messages = await asyncio.to_thread(self.__build_messages__, session_id, enhanced_message)
+        chunks = []
+        with span("llm"):
+            stream = self.async_llm.chat_stream(messages, deadline=deadline)
+            try:
+                async for delta in stream:
+                    chunks.append(delta)
+                    yield delta
+            finally:
+                await stream.aclose()
+
+        with span("record"):
+            await asyncio.to_thread(self.__record_turn__, session_id, enhanced_message, original_message, "".join(chunks))
+
+    def __build_messages__(self, session_id: str, enhanced_message: str):
+        # Build full prompt with context
+        system_prompt = [{"role": "system", "content": SYSTEM_PROMPT}]
+        session_msgs = self.context_builder.messages(session_id)
+        user_prompt = [{"role": "user", "content": enhanced_message}]
+        return system_prompt + session_msgs + user_prompt
+
+    def __construct_session_messages__(self, session_id: str, limit: int = None):
+        """Lấy `limit` message cuối của session (theo thứ tự), dạng message OpenAI."""
+        return [
+            {"role": OPEN_AI_ROLE_MAPPING.get(row["type"], "user"), "content": row["content"]}
+            for row in self.history_store.recent(session_id, limit)
+        ]
+
+    def __record_turn__(self, session_id, enhanced_message, original_message, response_text):
+        """Câu hỏi + câu trả lời của 1 turn trong 1 lần append_many (write-behind: chỉ vào hàng đợi)."""
+        self.history_store.append_many([
+            {"session_id": session_id, "type": "human", "content": original_message, "enhanced_content": enhanced_message},
+            {"session_id": session_id, "type": "ai", "content": response_text}
+        ])
+
+    def __lookup_cached_response__(self, query_embedding):
+        cached = self.semantic_cache.lookup(query_embedding)
+        CACHE_LOOKUPS.inc(cache="semantic", result="miss" if cached is None else "hit")
+        return cached
 
     def __cache_ai_response__(self, enhanced_message, original_message, response_text, query_embedding):
-        self.semantic_cache_collection.add(
-            ids=[str(uuid.uuid4())],
-            embeddings=[query_embedding],
-            documents=[json.dumps({
-                "text": [{"type": "human", "content": original_message, "enhanced_content": enhanced_message}],
-                "llm_string": {"model_name": "gpt-4o-mini", "name": "ChatOpenAI"},
-                "return_val": [{"type": "ai", "content": response_text}]
-            })]
-        )
+        self.semantic_cache.store(enhanced_message, original_message, response_text, query_embedding)
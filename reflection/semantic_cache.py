@@ -0,0 +1,171 @@
+import json
+import time
+import uuid
+import threading
+import numpy as np
+from resources import reinit_after_fork
+
+class SemanticCache:
+    """
+    Semantic cache trước LLM call, lưu trong collection Chroma.
+    - Hit khi cosine(query, entry) >= threshold và entry chưa hết TTL.
+    - Entry gắn `catalog_version`, ingest lại catalog thì entry cũ không còn được dùng.
+    - Entry gắn `catalog` (catalog_fn: catalog id của request), câu trả lời của catalog này không dùng cho catalog khác.
+    - Dọn dẹp theo đợt (sweep): mỗi sweep_interval giây hoặc khi vượt max_size -> xoá entry hết TTL, entry của
+      version cũ (mọi catalog), rồi evict LRU (metadata `last_used`) xuống evict_ratio * max_size.
+      Nhờ vậy scan toàn bộ metadata chỉ xảy ra 1 lần mỗi ~(1 - evict_ratio) * max_size lần store.
+    - Hit không ghi `last_used` vào Chroma ngay: thời điểm dùng được gom trong RAM (mỗi entry 1 giá trị) và ghi
+      1 lần trong sweep, LRU của sweep dùng giá trị mới nhất trong RAM.
+    version_fn(catalog_id) -> version hiện tại của catalog đó.
+    """
+    def __init__(self, collection, threshold: float = 0.95, ttl_seconds: int = 24 * 3600, max_size: int = 5000, version_fn=None, candidates: int = 3,
+                 catalog_fn=None, evict_ratio: float = 0.9, sweep_interval: float = 600):
+        self.collection = collection
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_size = max_size
+        self.version_fn = version_fn or (lambda catalog: "0")
+        self.candidates = candidates
+        self.catalog_fn = catalog_fn or (lambda: "")
+        self.evict_ratio = evict_ratio
+        self.sweep_interval = sweep_interval
+        self._next_sweep = 0.0
+        self._reopen()
+        reinit_after_fork(self)
+
+    def _reopen(self):
+        self._sweep_lock = threading.Lock()
+        self._touch_lock = threading.Lock()
+        self._touched = {}   # doc_id -> last_used chưa ghi vào Chroma
+
+    def _touch(self, doc_id: str, now: float):
+        with self._touch_lock:
+            self._touched[doc_id] = now
+
+    def _take_touches(self) -> dict:
+        with self._touch_lock:
+            touched, self._touched = self._touched, {}
+        return touched
+
+    def _restore_touches(self, touched: dict):
+        """Sweep lỗi: trả lại các lần dùng chưa ghi để đợt sau ghi tiếp (không đè giá trị mới hơn)."""
+        with self._touch_lock:
+            for doc_id, last_used in touched.items():
+                if self._touched.get(doc_id, 0) < last_used:
+                    self._touched[doc_id] = last_used
+
+    def _scope(self) -> dict:
+        catalog = self.catalog_fn()
+        return {"$and": [{"catalog": catalog}, {"catalog_version": self.version_fn(catalog)}]}
+
+    def lookup(self, query_embedding: list):
+        """Trả về câu trả lời đã cache (string) hoặc None."""
+        if not query_embedding or self.collection.count() == 0:
+            return None
+
+        results = self.collection.query(
+            query_embeddings=[query_embedding],
+            n_results=self.candidates,
+            where=self._scope(),
+            include=["embeddings", "documents", "metadatas"]
+        )
+        ids = results["ids"][0] if results.get("ids") else []
+        if not ids:
+            return None
+
+        query_vec = np.asarray(query_embedding, dtype=np.float32)
+        query_vec /= (np.linalg.norm(query_vec) or 1.0)
+        now = time.time()
+        expired = []
+        hit = None
+        for doc_id, emb, doc, meta in zip(ids, results["embeddings"][0], results["documents"][0], results["metadatas"][0]):
+            meta = meta or {}
+            if now - meta.get("created_at", 0) > self.ttl_seconds:
+                expired.append(doc_id)
+                continue
+            vec = np.asarray(emb, dtype=np.float32)
+            similarity = float(vec @ query_vec) / (float(np.linalg.norm(vec)) or 1.0)
+            if similarity >= self.threshold:
+                hit = (doc_id, doc, meta)
+                break
+
+        if expired:
+            self.collection.delete(ids=expired)
+        if hit is None:
+            return None
+
+        doc_id, doc, meta = hit
+        self._touch(doc_id, now)
+        return_val = json.loads(doc).get("return_val") or [{}]
+        return return_val[0].get("content")
+
+    def store(self, enhanced_message: str, original_message: str, response_text: str, query_embedding: list, model_name: str = "gpt-4o-mini"):
+        if not query_embedding:
+            return
+        now = time.time()
+        catalog = self.catalog_fn()
+        self.collection.add(
+            ids=[str(uuid.uuid4())],
+            embeddings=[query_embedding],
+            documents=[json.dumps({
+                "text": [{"type": "human", "content": original_message, "enhanced_content": enhanced_message}],
+                "llm_string": {"model_name": model_name, "name": "ChatOpenAI"},
+                "return_val": [{"type": "ai", "content": response_text}]
+            })],
+            metadatas=[{"created_at": now, "last_used": now, "catalog": catalog, "catalog_version": self.version_fn(catalog)}]
+        )
+        if now >= self._next_sweep or self.collection.count() > self.max_size:
+            self.evict(now)
+
+    def evict(self, now: float = None) -> int:
+        """
+        1 đợt dọn dẹp, trả về số entry đã xoá. Đợt khác đang chạy (thread khác) thì bỏ qua.
+        Entry chưa gắn catalog (tạo trước khi cache tách theo catalog) không còn được lookup -> xoá luôn.
+        """
+        if not self._sweep_lock.acquire(blocking=False):
+            return 0
+        touched = self._take_touches()
+        try:
+            now = now or time.time()
+            self._next_sweep = now + self.sweep_interval
+            before = self.collection.count()
+            self.collection.delete(where={"created_at": {"$lt": now - self.ttl_seconds}})
+            entries = self.collection.get(include=["metadatas"])
+            versions = {}
+            stale, alive = [], []
+            touches = {}
+            for doc_id, meta in zip(entries["ids"], entries["metadatas"]):
+                meta = meta or {}
+                catalog = meta.get("catalog")
+                if catalog is not None and catalog not in versions:
+                    versions[catalog] = self.version_fn(catalog)
+                if catalog is None or meta.get("catalog_version") != versions[catalog]:
+                    stale.append(doc_id)
+                    continue
+                last_used = meta.get("last_used", 0)
+                if touched.get(doc_id, 0) > last_used:
+                    last_used = touched[doc_id]
+                    touches[doc_id] = {**meta, "last_used": last_used}
+                alive.append((last_used, doc_id))
+            overflow = len(alive) - int(self.max_size * self.evict_ratio) if len(alive) > self.max_size else 0
+            if overflow > 0:
+                alive.sort()
+                stale.extend(doc_id for _, doc_id in alive[:overflow])
+            if stale:
+                self.collection.delete(ids=stale)
+                for doc_id in stale:
+                    touches.pop(doc_id, None)
+            if touches:
+                self.collection.update(ids=list(touches), metadatas=list(touches.values()))
+            return before - self.collection.count()
+        except Exception:
+            self._restore_touches(touched)
+            raise
+        finally:
+            self._sweep_lock.release()
+
+    def clear(self):
+        self._take_touches()
+        ids = self.collection.get(include=[])["ids"]
+        if ids:
+            self.collection.delete(ids=ids)
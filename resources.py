@@ -0,0 +1,153 @@
+import os
+import sys
+import logging
+import weakref
+import threading
+
+# Resource dùng chung trong process: mỗi store (Chroma client theo path, collection) chỉ mở 1 lần.
+# Import chromadb được hoãn tới lần dùng đầu tiên (hoặc warmup) để import app nhanh.
+# Fork-safe cho gunicorn --preload: master import + warmup (index, model) 1 lần rồi fork; trong worker,
+# resource kế thừa (connection SQLite / Chroma, connection pool HTTP) được bỏ và mở lại khi dùng.
+
+logger = logging.getLogger(__name__)
+
+# Resource kế thừa từ process cha: giữ reference để không bị GC đóng trong process con
+# (vd sqlite3_close ở worker có thể checkpoint / xoá file WAL mà master đang dùng).
+_abandoned = []
+
+def abandon(*items):
+    _abandoned.extend(item for item in items if item is not None)
+
+
+class ResourceRegistry:
+    """Cache resource theo key, tạo bằng factory ở lần get đầu tiên trong process hiện tại."""
+    def __init__(self):
+        self._items = {}
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+    def get(self, key, factory):
+        if self._pid != os.getpid():
+            self.reset()
+        item = self._items.get(key)
+        if item is None:
+            with self._lock:
+                item = self._items.get(key)
+                if item is None:
+                    item = self._items[key] = factory()
+        return item
+
+    def __contains__(self, key) -> bool:
+        return self._pid == os.getpid() and key in self._items
+
+    def discard(self, key):
+        """Bỏ resource khỏi cache (không đóng): lần get sau tạo lại, ai đang giữ reference vẫn dùng tiếp được."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def reset(self):
+        """
+        Bỏ (không đóng) các resource của process cha: đóng connection dùng chung qua fork sẽ làm hỏng
+        connection của master. Lock tạo mới vì có thể đang bị giữ lúc fork.
+        """
+        abandon(*self._items.values())
+        self._lock = threading.RLock()
+        self._items = {}
+        self._pid = os.getpid()
+
+    def close(self):
+        with self._lock:
+            items, self._items = self._items, {}
+        for item in items.values():
+            close = getattr(item, "close", None)
+            if callable(close):
+                try:
+                    close()
+                except Exception:
+                    logger.exception("Đóng resource thất bại")
+
+    def __len__(self):
+        return len(self._items)
+
+
+RESOURCES = ResourceRegistry()
+
+# ------------------- Chroma -------------------
+def chroma_client(path: str):
+    """PersistentClient dùng chung cho mọi RAG / Reflection / tool trên cùng thư mục."""
+    def factory():
+        import chromadb
+        return chromadb.PersistentClient(path=path)
+    return RESOURCES.get(("chroma", os.path.abspath(path)), factory)
+
+def chroma_collection(path: str, name: str):
+    return RESOURCES.get(
+        ("chroma_collection", os.path.abspath(path), name),
+        lambda: chroma_client(path).get_or_create_collection(name=name)
+    )
+
+def release_chroma_collection(path: str, name: str):
+    """
+    Bỏ handle collection khỏi cache của process (catalog bị evict). Chroma 1.x không có API giải phóng segment
+    (HNSW) của riêng 1 collection trong client dùng chung: phần đó nằm trong LRU cache của Chroma.
+    """
+    RESOURCES.discard(("chroma_collection", os.path.abspath(path), name))
+
+
+def import_chroma():
+    """
+    Chỉ import chromadb (không mở client / collection). Dùng trong warmup của master trước fork: collection
+    Chroma đã dùng trong process cha có thể treo khi dùng lại trong process con (state của Rust bindings),
+    nên master chỉ import để worker không phải import lại; worker tự mở collection của mình.
+    """
+    import chromadb  # noqa: F401
+
+
+class LazyCollection:
+    """
+    Proxy của collection Chroma: client / collection chỉ được mở khi gọi method đầu tiên
+    (qua RESOURCES nên dùng chung và tự mở lại sau fork).
+    """
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.name = name
+
+    def resolve(self):
+        return chroma_collection(self.path, self.name)
+
+    def is_open(self) -> bool:
+        """Collection đã được mở trong process hiện tại chưa (không mở nếu chưa)."""
+        return ("chroma_collection", os.path.abspath(self.path), self.name) in RESOURCES
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+    def __repr__(self):
+        return f"LazyCollection(path={self.path!r}, name={self.name!r})"
+
+
+# ------------------- Fork -------------------
+def reinit_after_fork(obj, method: str = "_reopen"):
+    """
+    Gọi obj.<method>() trong process con ngay sau fork (giữ weakref: không làm obj sống mãi).
+    method thường tạo lại lock / connection / thread pool, resource cũ đưa vào abandon().
+    """
+    ref = weakref.ref(obj)
+
+    def callback():
+        target = ref()
+        if target is not None:
+            getattr(target, method)()
+
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=callback)
+
+def _after_fork_in_child():
+    RESOURCES.reset()
+    # Chroma cache System theo path ở mức class -> worker phải tạo System riêng
+    shared = sys.modules.get("chromadb.api.shared_system_client")
+    if shared is not None:
+        shared.SharedSystemClient.clear_system_cache()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -1,7 +1,8 @@
+import os
 import chromadb
 
 db_path = 'VECTOR_STORE'
-collection_name = 'product'
+collection_name = os.getenv("COLLECTION_NAME") or "products"
 
 client = chromadb.PersistentClient(path=db_path)
 collection = client.get_or_create_collection(name=collection_name)
@@ -0,0 +1,186 @@
+import time
+import asyncio
+import threading
+import pytest
+from openai import OpenAI, AsyncOpenAI
+from admission import AdmissionController, AsyncAdmissionController, AdmissionRejected, Deadline
+from agent_router import GuardedRAGAgent, AsyncGuardedRAGAgent, DEGRADE_ERRORS, OVERLOADED_MESSAGE
+from benchmarks.fake_openai import make_server, parse_args
+from embeddings import EmbeddingModel, EmbeddingService
+from history import SQLiteHistoryStore
+from openai_client import OpenAiClient, AsyncOpenAiClient
+from reflection import Reflection
+
+DEADLINE = 0.5
+
+
+@pytest.fixture
+def slow_server():
+    """Fake OpenAI server: chat / embedding đều chậm hơn nhiều so với DEADLINE."""
+    server = make_server(parse_args(["--port", "0", "--dim", "16", "--chat-latency-ms", "5000", "--embed-latency-ms", "5000"]))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/v1"
+    server.shutdown()
+    server.server_close()
+
+
+class NoProducts:
+    """RAG giả: không query nào qua keyword gate -> mọi câu hỏi đi đường Reflection fallback."""
+    collection_name = "products"
+
+    def match_entities(self, query):
+        return []
+
+
+def _reflection(tmp_path, llm=None, async_llm=None):
+    return Reflection(
+        llm=llm,
+        db_path=str(tmp_path),
+        dbChatHistoryCollection="chat_history",
+        semanticCacheCollection="semantic_cache",
+        history_store=SQLiteHistoryStore(str(tmp_path / "history.sqlite3")),
+        async_llm=async_llm
+    )
+
+
+def _embedder():
+    return EmbeddingService(EmbeddingModel(backend="hashing", dim=16))
+
+
+# ------------------- Deadline / AdmissionController -------------------
+def test_deadline_remaining():
+    deadline = Deadline(0.05)
+    assert 0 < deadline.remaining() <= 0.05
+    assert not deadline.expired
+    time.sleep(0.06)
+    assert deadline.expired
+    assert deadline.remaining() == 0.0
+
+
+def test_slot_sheds_when_deadline_too_short():
+    admission = AdmissionController(max_in_flight=1, expected_seconds=1.0)
+    with pytest.raises(AdmissionRejected) as error:
+        with admission.slot(Deadline(0.5)):
+            pass
+    assert error.value.reason == "deadline"
+    assert admission.stats()["shed_deadline"] == 1
+
+
+def test_slot_sheds_when_queue_full():
+    admission = AdmissionController(max_in_flight=1, max_queue=0, expected_seconds=0.0)
+    with admission.slot():
+        with pytest.raises(AdmissionRejected) as error:
+            with admission.slot(Deadline(1.0)):
+                pass
+    assert error.value.reason == "queue_full"
+
+
+def test_slot_wait_times_out():
+    admission = AdmissionController(max_in_flight=1, expected_seconds=0.0)
+    with admission.slot():
+        started = time.monotonic()
+        with pytest.raises(AdmissionRejected):
+            with admission.slot(Deadline(0.1)):
+                pass
+        assert time.monotonic() - started < 1.0
+    assert admission.stats()["timeout"] == 1
+    assert admission.stats()["in_flight"] == 0
+
+
+def test_async_slot_wait_times_out():
+    admission = AsyncAdmissionController(max_in_flight=1, expected_seconds=0.0)
+
+    async def run():
+        async with admission.slot():
+            with pytest.raises(AdmissionRejected):
+                async with admission.slot(Deadline(0.1)):
+                    pass
+        async with admission.slot(Deadline(0.1)):
+            pass
+
+    asyncio.run(run())
+    assert admission.stats()["in_flight"] == 0
+
+
+# ------------------- Fallback Reflection trong deadline -------------------
+def test_slow_fallback_llm_is_cut_at_deadline(tmp_path, slow_server):
+    llm = OpenAiClient(api_key="x", base_url=slow_server, timeout=30, max_retries=2, backoff_seconds=0.05)
+    agent = GuardedRAGAgent(
+        rag=NoProducts(), embedding_client=None, embed_model=None, fallback_reflection=_reflection(tmp_path, llm),
+        embedder=_embedder(), llm=llm, admission=AdmissionController(expected_seconds=0.0), deadline_seconds=DEADLINE
+    )
+    started = time.monotonic()
+    result = agent.invoke("xin chào", session_id="s1")
+    assert time.monotonic() - started < DEADLINE + 1.0
+    assert result["degraded"] is True
+    assert result["output"] == OVERLOADED_MESSAGE
+    assert agent.admission.stats()["in_flight"] == 0
+    llm.close()
+
+
+def test_slow_fallback_stream_is_cut_at_deadline(tmp_path, slow_server):
+    llm = OpenAiClient(api_key="x", base_url=slow_server, timeout=30, max_retries=2, backoff_seconds=0.05)
+    agent = GuardedRAGAgent(
+        rag=NoProducts(), embedding_client=None, embed_model=None, fallback_reflection=_reflection(tmp_path, llm),
+        embedder=_embedder(), llm=llm, admission=AdmissionController(expected_seconds=0.0), deadline_seconds=DEADLINE
+    )
+    started = time.monotonic()
+    chunks = list(agent.invoke_stream("xin chào", session_id="s1"))
+    assert time.monotonic() - started < DEADLINE + 1.0
+    assert chunks == [OVERLOADED_MESSAGE]
+    llm.close()
+
+
+def test_slow_async_fallback_llm_is_cut_at_deadline(tmp_path, slow_server):
+    async_llm = AsyncOpenAiClient(api_key="x", base_url=slow_server, timeout=30, max_retries=2, backoff_seconds=0.05)
+    agent = AsyncGuardedRAGAgent(
+        rag=NoProducts(), embedding_client=None, embed_model=None,
+        fallback_reflection=_reflection(tmp_path, async_llm=async_llm), embedder=_embedder(), llm=object(),
+        async_llm=async_llm, async_admission=AsyncAdmissionController(expected_seconds=0.0), deadline_seconds=DEADLINE
+    )
+
+    async def run():
+        try:
+            started = time.monotonic()
+            result = await agent.ainvoke("xin chào", session_id="s1")
+            return result, time.monotonic() - started
+        finally:
+            await async_llm.close()
+
+    result, elapsed = asyncio.run(run())
+    assert elapsed < DEADLINE + 1.0
+    assert result["degraded"] is True
+
+
+# ------------------- Embed trong deadline -------------------
+def test_slow_embedding_is_cut_at_deadline(slow_server):
+    engine = EmbeddingModel(backend="openai", model="fake", client=OpenAI(api_key="x", base_url=slow_server))
+    embedder = EmbeddingService(engine)
+    started = time.monotonic()
+    with pytest.raises(DEGRADE_ERRORS):
+        embedder.embed("iphone 15", deadline=Deadline(DEADLINE))
+    assert time.monotonic() - started < DEADLINE + 1.0
+
+
+def test_slow_async_embedding_is_cut_at_deadline(slow_server):
+    engine = EmbeddingModel(backend="openai", model="fake", client=OpenAI(api_key="x", base_url=slow_server),
+                            async_client=AsyncOpenAI(api_key="x", base_url=slow_server))
+    embedder = EmbeddingService(engine)
+
+    async def run():
+        started = time.monotonic()
+        with pytest.raises(AdmissionRejected):
+            await embedder.aembed("iphone 15", deadline=Deadline(DEADLINE))
+        return time.monotonic() - started
+
+    assert asyncio.run(run()) < DEADLINE + 1.0
+
+
+def test_expired_deadline_skips_engine():
+    embedder = _embedder()
+    assert embedder.embed("iphone 15", deadline=Deadline(1.0))   # đã cache -> không cần engine
+    deadline = Deadline(0.0)
+    assert embedder.embed("iphone 15", deadline=deadline)
+    with pytest.raises(AdmissionRejected):
+        embedder.embed("samsung s24", deadline=deadline)
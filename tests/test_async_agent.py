@@ -0,0 +1,35 @@
+import time
+import asyncio
+from agent_router import AsyncGuardedRAGAgent
+from embeddings import EmbeddingModel, EmbeddingService
+
+
+class SlowMatcherRag:
+    """RAG giả: matcher load chậm (đọc file / build lại) ở lần match đầu tiên, không có sản phẩm nào."""
+    collection_name = "products"
+
+    def __init__(self, load_seconds: float):
+        self.load_seconds = load_seconds
+
+    def match_entities(self, query):
+        time.sleep(self.load_seconds)
+        return []
+
+
+def test_keyword_gate_runs_off_the_event_loop():
+    agent = AsyncGuardedRAGAgent(
+        rag=SlowMatcherRag(0.3), embedding_client=None, embed_model=None, llm=object(),
+        embedder=EmbeddingService(EmbeddingModel(backend="hashing", dim=8))
+    )
+
+    async def run():
+        task = asyncio.create_task(agent.ainvoke("xin chào", session_id="s1"))
+        ticks = 0
+        while not task.done():
+            await asyncio.sleep(0.01)
+            ticks += 1
+        return ticks, task.result()
+
+    ticks, result = asyncio.run(run())
+    assert ticks >= 15
+    assert result["output"] == "Không tìm thấy dữ liệu"
@@ -0,0 +1,67 @@
+import pytest
+from rag.attributes import extract_constraints, parse_price, MIN_PRICE, AROUND_RATIO
+
+
+def around(value: int) -> dict:
+    return {"min_price": int(value * (1 - AROUND_RATIO)), "max_price": int(value * (1 + AROUND_RATIO))}
+
+
+# ------------------- parse_price -------------------
+@pytest.mark.parametrize("value, expected", [
+    ("2.290.000 ₫", 2_290_000),
+    ("15,990,000đ", 15_990_000),
+    ("990000", 990_000),
+    (1_500_000, 1_500_000),
+    (2.5e6, 2_500_000),
+    ("Liên hệ", None),
+    ("", None),
+    (None, None),
+    (0, None),
+    (-100, None),
+])
+def test_parse_price(value, expected):
+    assert parse_price(value) == expected
+
+
+# ------------------- extract_constraints: giá -------------------
+@pytest.mark.parametrize("query, expected", [
+    ("điện thoại dưới 10 triệu", {"max_price": 10_000_000}),
+    ("laptop trên 5tr", {"min_price": 5_000_000}),
+    ("tivi không quá 500k", {"max_price": 500_000}),
+    ("từ 5 đến 10 triệu", {"min_price": 5_000_000, "max_price": 10_000_000}),
+    ("từ 10 đến 5 triệu", {"min_price": 5_000_000, "max_price": 10_000_000}),
+    ("từ 8 triệu trở lên", {"min_price": 8_000_000}),
+    ("dưới 15", {"max_price": 15_000_000}),
+    ("khoảng 8 triệu", around(8_000_000)),
+    ("15.990.000đ", around(15_990_000)),
+])
+def test_extract_price(query, expected):
+    assert extract_constraints(query) == expected
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("nhà trên 1 tỷ", {"min_price": 1_000_000_000}),
+    ("dưới 1,5 tỉ", {"max_price": 1_500_000_000}),
+    ("từ 500 triệu đến 2 tỷ", {"min_price": 500_000_000, "max_price": 2_000_000_000}),
+    ("tầm 2 tỷ", around(2_000_000_000)),
+    ("xe 3 tỷ", around(3_000_000_000)),
+])
+def test_extract_price_billions(query, expected):
+    assert extract_constraints(query) == expected
+
+
+@pytest.mark.parametrize("query", [
+    "iphone 15 pro max",
+    "điện thoại 8gb 256gb",
+    "tivi 55 inch",
+    "samsung galaxy s24",
+    "",
+])
+def test_extract_no_price(query):
+    assert extract_constraints(query) == {}
+
+
+def test_small_amount_is_not_price():
+    # Số tiền nhỏ hơn MIN_PRICE (vd "50k") không được dùng làm điều kiện lọc
+    assert 50_000 < MIN_PRICE
+    assert extract_constraints("dưới 50k") == {}
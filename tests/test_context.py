@@ -0,0 +1,139 @@
+import pytest
+from history import SQLiteHistoryStore, SQLiteSummaryStore
+from reflection import ContextBuilder
+from reflection.context import TokenCounter, MESSAGE_OVERHEAD_TOKENS
+
+
+class WordCounter(TokenCounter):
+    """1 từ = 1 token: số token của prompt dễ tính trong test."""
+    def count(self, text: str) -> int:
+        return len((text or "").split())
+
+
+class RecordingLLM:
+    def __init__(self, fail: bool = False):
+        self.prompts = []
+        self.fail = fail
+
+    def chat(self, messages, **kwargs):
+        self.prompts.append(messages[-1]["content"])
+        if self.fail:
+            raise RuntimeError("LLM lỗi")
+        return f"tóm tắt {len(self.prompts)}"
+
+
+class ListHistory:
+    """History store không có `between` (vd ChromaHistoryStore): không tóm tắt được."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    def recent(self, session_id, limit=None):
+        return self.rows if limit is None else self.rows[-limit:]
+
+
+MESSAGE = 1 + MESSAGE_OVERHEAD_TOKENS   # token của 1 message 1 từ
+
+
+@pytest.fixture
+def stores(tmp_path):
+    path = str(tmp_path / "history.sqlite3")
+    history, summaries = SQLiteHistoryStore(path), SQLiteSummaryStore(path)
+    yield history, summaries
+    summaries.close()
+    history.close()
+
+
+def _turns(store, session_id, count, start=0):
+    store.append_many([
+        {"session_id": session_id, "type": msg_type, "content": f"{msg_type}{i}"}
+        for i in range(start, start + count) for msg_type in ("human", "ai")
+    ])
+
+
+def _contents(messages):
+    return [m["content"] for m in messages]
+
+
+def test_keeps_latest_messages_within_budget():
+    rows = [{"id": i, "type": t, "content": f"{t}{i}"} for i, t in enumerate(["human", "ai"] * 3)]
+    builder = ContextBuilder(ListHistory(rows), max_tokens=3 * MESSAGE, counter=WordCounter())
+    messages = builder.messages("s1")
+    assert messages == [
+        {"role": "assistant", "content": "ai3"},
+        {"role": "user", "content": "human4"},
+        {"role": "assistant", "content": "ai5"},
+    ]
+    assert not builder.summaries_enabled
+    assert len(builder.messages("s1", max_messages=2)) == 2
+    builder.close()
+
+
+def test_rolling_summary_replaces_dropped_messages(stores):
+    history, summaries = stores
+    llm = RecordingLLM()
+    builder = ContextBuilder(history, summary_store=summaries, llm=llm, max_tokens=4 * MESSAGE,
+                             min_summary_messages=2, counter=WordCounter())
+    _turns(history, "s1", 4)
+    assert _contents(builder.messages("s1")) == ["human2", "ai2", "human3", "ai3"]
+    builder.wait()
+    assert len(llm.prompts) == 1 and "human0" in llm.prompts[0] and "ai1" in llm.prompts[0]
+    assert "human2" not in llm.prompts[0]
+    assert summaries.get("s1")[0] == "tóm tắt 1"
+
+    # Summary chiếm 1 phần budget; message đã tóm tắt không lặp lại
+    messages = builder.messages("s1")
+    assert messages[0] == {"role": "system", "content": "Tóm tắt cuộc trò chuyện trước đó: tóm tắt 1"}
+    assert _contents(messages[1:]) == ["ai3"]
+    builder.wait()
+    # Lần cập nhật sau chỉ gửi phần mới rơi khỏi cửa sổ, kèm summary hiện có
+    assert "tóm tắt 1" in llm.prompts[1] and "human2" in llm.prompts[1]
+    assert "human1" not in llm.prompts[1] and "ai3" not in llm.prompts[1]
+    builder.close()
+
+
+def test_below_min_summary_messages_does_not_call_llm(stores):
+    history, summaries = stores
+    llm = RecordingLLM()
+    builder = ContextBuilder(history, summary_store=summaries, llm=llm, max_tokens=3 * MESSAGE,
+                             min_summary_messages=2, counter=WordCounter())
+    _turns(history, "s1", 2)
+    assert _contents(builder.messages("s1")) == ["ai0", "human1", "ai1"]
+    builder.wait()
+    assert llm.prompts == [] and summaries.get("s1") == ("", 0)
+    builder.close()
+
+
+def test_unflushed_messages_are_kept_and_never_summarized(stores):
+    history, summaries = stores
+    _turns(history, "s1", 2)
+    rows = history.recent("s1") + [{"id": None, "type": "human", "content": "human2"}]
+    summaries.put("s1", "cũ", rows[1]["id"])
+
+    class WithTail(ListHistory):
+        def between(self, session_id, after_id, before_id):
+            return history.between(session_id, after_id, before_id)
+
+    llm = RecordingLLM()
+    builder = ContextBuilder(WithTail(rows), summary_store=summaries, llm=llm, max_tokens=100,
+                             min_summary_messages=1, counter=WordCounter())
+    assert _contents(builder.messages("s1")) == ["Tóm tắt cuộc trò chuyện trước đó: cũ", "human1", "ai1", "human2"]
+    builder.wait()
+    assert llm.prompts == []
+    builder.close()
+
+
+def test_failed_summary_update_is_retried_later(stores):
+    history, summaries = stores
+    llm = RecordingLLM(fail=True)
+    builder = ContextBuilder(history, summary_store=summaries, llm=llm, max_tokens=2 * MESSAGE,
+                             min_summary_messages=1, counter=WordCounter())
+    _turns(history, "s1", 2)
+    assert _contents(builder.messages("s1")) == ["human1", "ai1"]
+    builder.wait()
+    assert summaries.get("s1") == ("", 0)
+
+    llm.fail = False
+    builder.messages("s1")
+    builder.wait()
+    assert len(llm.prompts) == 2 and summaries.get("s1")[0] == "tóm tắt 2"
+    builder.close()
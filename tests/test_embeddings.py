@@ -0,0 +1,109 @@
+import time
+import asyncio
+import sqlite3
+import threading
+import pytest
+from embeddings import EmbeddingModel, EmbeddingService, normalize_text
+
+
+class RecordingEngine(EmbeddingModel):
+    """Backend hashing, ghi lại các batch text được gửi đi embed."""
+    def __init__(self, fail_on=None):
+        super().__init__(backend="hashing", dim=8)
+        self.batches = []
+        self.fail_on = fail_on
+
+    def embed_batch(self, texts, timeout=None):
+        self.batches.append(list(texts))
+        if self.fail_on is not None and self.fail_on in texts:
+            raise RuntimeError(f"lỗi embed {self.fail_on}")
+        return super().embed_batch(texts, timeout=timeout)
+
+
+def test_normalize_text():
+    assert normalize_text("  iPhone   15 Pro ") == "iphone 15 pro"
+    assert normalize_text(None) == ""
+
+
+def test_embeds_original_text_once_per_key():
+    engine = RecordingEngine()
+    service = EmbeddingService(engine)
+    vectors = service.embed_batch(["iPhone 15", "iphone  15", "", "Galaxy S24"])
+    assert engine.batches == [["iPhone 15", "Galaxy S24"]]
+    assert vectors[0] == vectors[1] and vectors[2] == []
+    service.embed("IPHONE 15")
+    assert len(engine.batches) == 1
+    assert service.stats()["memory_hits"] == 1
+
+
+def test_disk_cache_survives_restart(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    first = EmbeddingService(RecordingEngine(), cache_path=path)
+    vector = first.embed("iPhone 15")
+    engine = RecordingEngine()
+    second = EmbeddingService(engine, cache_path=path)
+    assert second.embed("iphone 15") == pytest.approx(vector, abs=1e-6)
+    assert engine.batches == []
+    assert second.stats()["disk_hits"] == 1
+
+
+def test_return_exceptions_isolates_failing_text():
+    service = EmbeddingService(RecordingEngine(fail_on="bad"))
+    results = service.embed_batch(["good", "bad", "other"], return_exceptions=True)
+    assert isinstance(results[1], RuntimeError)
+    assert len(results[0]) == 8 and len(results[2]) == 8
+    with pytest.raises(RuntimeError):
+        service.embed_batch(["bad"])
+
+
+def test_cache_reads_do_not_wait_for_blocked_disk_write(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    warm = EmbeddingService(RecordingEngine(), cache_path=path)
+    warm.embed("galaxy s24")   # có trên đĩa cho service mới bên dưới
+    service = EmbeddingService(RecordingEngine(), cache_path=path)
+    service.embed("iphone 15")
+
+    # Connection khác giữ write lock: ghi cache của thread nền bị chặn ở SQLite
+    blocker = sqlite3.connect(path, timeout=30)
+    blocker.execute("BEGIN IMMEDIATE")
+    writer = threading.Thread(target=service.embed, args=("pixel 9",))
+    writer.start()
+    time.sleep(0.2)
+    try:
+        assert writer.is_alive()
+        started = time.monotonic()
+        service.embed("iphone 15")      # LRU trong RAM
+        service.embed("galaxy s24")     # đọc đĩa (WAL: đọc song song với transaction đang ghi)
+        assert time.monotonic() - started < 0.1
+    finally:
+        blocker.rollback()
+        blocker.close()
+    writer.join(5)
+    assert not writer.is_alive()
+    stats = service.stats()
+    assert stats["memory_hits"] >= 1 and stats["disk_hits"] == 1
+
+
+def test_aembed_does_not_block_event_loop_on_disk_cache(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite3")
+    service = EmbeddingService(RecordingEngine(), cache_path=path)
+    blocker = sqlite3.connect(path, timeout=30)
+    blocker.execute("BEGIN IMMEDIATE")
+
+    async def run():
+        task = asyncio.create_task(service.aembed("pixel 9"))   # ghi cache bị chặn ở SQLite
+        ticks = 0
+        started = time.monotonic()
+        while time.monotonic() - started < 0.3:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        assert not task.done()
+        blocker.rollback()
+        return ticks, await asyncio.wait_for(task, 5)
+
+    try:
+        ticks, vector = asyncio.run(run())
+    finally:
+        blocker.close()
+    assert ticks >= 15
+    assert len(vector) == 8
@@ -0,0 +1,189 @@
+import json
+import time
+import sqlite3
+import pytest
+from history import SQLiteHistoryStore, SQLiteSummaryStore, HistoryRetention, ArchiveFallbackHistoryStore, migrate_chroma_history
+from reflection import ContextBuilder
+
+DAY = 86400
+
+
+@pytest.fixture
+def db(tmp_path):
+    return str(tmp_path / "history.sqlite3")
+
+
+@pytest.fixture
+def retention(db, tmp_path):
+    SQLiteHistoryStore(db).close()   # tạo bảng messages
+    retention = HistoryRetention(db, archive_dir=str(tmp_path / "archive"), max_turns=3, session_ttl=30 * DAY, interval=0)
+    yield retention
+    retention.close()
+
+
+def _turns(store, session_id, count, created_at=None, start=0):
+    store.append_many([
+        {"session_id": session_id, "type": msg_type, "content": f"{msg_type} {i}", "created_at": created_at}
+        for i in range(start, start + count) for msg_type in ("human", "ai")
+    ])
+
+
+def _contents(rows):
+    return [row["content"] for row in rows]
+
+
+class StaticLLM:
+    def __init__(self):
+        self.prompts = []
+
+    def chat(self, messages, **kwargs):
+        self.prompts.append(messages[-1]["content"])
+        return "tóm tắt mới"
+
+
+# ------------------- SQLiteHistoryStore -------------------
+def test_store_recent_and_between(db):
+    store = SQLiteHistoryStore(db)
+    _turns(store, "s1", 3)
+    _turns(store, "s2", 1)
+    rows = store.recent("s1")
+    assert _contents(rows) == ["human 0", "ai 0", "human 1", "ai 1", "human 2", "ai 2"]
+    assert _contents(store.recent("s1", 2)) == ["human 2", "ai 2"]
+    assert _contents(store.between("s1", rows[0]["id"], rows[3]["id"])) == ["ai 0", "human 1"]
+    assert store.recent("missing") == []
+    store.close()
+
+
+class FakeChromaHistory:
+    """Collection Chroma cũ tối giản: get() phân trang theo thứ tự insert."""
+    def __init__(self, rows):
+        self.rows = rows   # (id, session_id, type, content, metadata)
+
+    def get(self, include=None, limit=None, offset=0):
+        page = self.rows[offset:offset + limit]
+        return {
+            "ids": [r[0] for r in page],
+            "documents": [
+                json.dumps({"SessionId": r[1], "History": {"type": r[2], "data": {"content": r[3]}}}) for r in page
+            ],
+            "metadatas": [r[4] for r in page],
+        }
+
+
+class CountingStore(SQLiteHistoryStore):
+    def __init__(self, path):
+        super().__init__(path)
+        self.batches = []
+
+    def append_many(self, records):
+        self.batches.append([r["session_id"] for r in records])
+        super().append_many(records)
+
+
+def test_migrate_chroma_history_batches_per_session_and_keeps_timestamps(db):
+    collection = FakeChromaHistory([
+        ("c1", "s1", "human", "q0", {"created_at": 1_700_000_000.5}),
+        ("c2", "s2", "human", "x0", None),
+        ("c3", "s1", "ai", "a0", {"timestamp": "2023-11-14T22:13:21+00:00"}),
+        ("c4", "s1", "human", "q1", {}),
+    ])
+    store = CountingStore(db)
+    started = time.time()
+    assert migrate_chroma_history(collection, store, batch_size=3) == 4
+    assert store.batches == [["s1", "s1"], ["s2"], ["s1"]]
+    assert _contents(store.recent("s1")) == ["q0", "a0", "q1"]
+
+    conn = sqlite3.connect(db)
+    created = dict(conn.execute("SELECT legacy_id, created_at FROM messages").fetchall())
+    conn.close()
+    assert created["c1"] == 1_700_000_000.5
+    assert created["c3"] == 1_700_000_001.0
+    assert created["c2"] >= started and created["c4"] >= started
+
+    # Chạy lại: legacy_id chặn nhân đôi
+    migrate_chroma_history(collection, store, batch_size=3)
+    assert len(store.recent("s1")) == 3
+    store.close()
+
+
+# ------------------- Retention: cap / TTL + đọc lại archive -------------------
+def test_cap_trims_oldest_turns_to_archive(db, retention):
+    store = SQLiteHistoryStore(db)
+    _turns(store, "s1", 5)
+    report = retention.run_once()
+    assert report["sessions_trimmed"] == 1 and report["messages_archived"] == 4
+    assert _contents(store.recent("s1")) == ["human 2", "ai 2", "human 3", "ai 3", "human 4", "ai 4"]
+    assert _contents(retention.load_session("s1")["messages"]) == ["human 0", "ai 0", "human 1", "ai 1"]
+    # Còn đủ `limit` message trong store -> không đọc archive
+    fallback = ArchiveFallbackHistoryStore(store, retention)
+    assert _contents(fallback.recent("s1", 2)) == ["human 4", "ai 4"]
+    assert _contents(fallback.recent("s1", 8)) == ["human 1", "ai 1"] + _contents(store.recent("s1"))
+    store.close()
+
+
+def test_expired_session_is_archived_and_read_back(db, retention):
+    store = SQLiteHistoryStore(db)
+    summaries = SQLiteSummaryStore(db)
+    old = time.time() - 40 * DAY
+    _turns(store, "s1", 2, created_at=old)
+    rows = store.recent("s1")
+    summaries.put("s1", "khách hỏi iphone 15", rows[1]["id"])
+
+    report = retention.run_once()
+    assert report["sessions_expired"] == 1 and report["messages_archived"] == 4
+    assert store.recent("s1") == []
+    assert summaries.get("s1") == ("", 0)   # summary nằm trong archive record
+    assert retention.load_session("s1")["summary"] == {"summary": "khách hỏi iphone 15", "last_message_id": rows[1]["id"]}
+
+    # Session quay lại: history trong prompt đọc tiếp từ archive, summary được khôi phục
+    fallback = ArchiveFallbackHistoryStore(store, retention)
+    _turns(store, "s1", 1, start=2)
+    assert _contents(fallback.recent("s1", 10)) == ["human 0", "ai 0", "human 1", "ai 1", "human 2", "ai 2"]
+    assert summaries.get("s1") == ("khách hỏi iphone 15", rows[1]["id"])
+    # Không ghi đè summary mới hơn của session
+    summaries.put("s1", "tóm tắt mới hơn", rows[3]["id"])
+    assert not retention.restore_summary("s1", {"summary": "cũ", "last_message_id": 1})
+    assert summaries.get("s1")[0] == "tóm tắt mới hơn"
+    summaries.close()
+    store.close()
+
+
+def test_context_builder_keeps_summary_of_returning_session(db, retention):
+    store = SQLiteHistoryStore(db)
+    summaries = SQLiteSummaryStore(db)
+    _turns(store, "s1", 3, created_at=time.time() - 40 * DAY)
+    rows = store.recent("s1")
+    summaries.put("s1", "khách hỏi iphone 15", rows[1]["id"])
+    retention.run_once()
+
+    llm = StaticLLM()
+    fallback = ArchiveFallbackHistoryStore(store, retention)
+    builder = ContextBuilder(fallback, summary_store=summaries, llm=llm, max_tokens=10_000, min_summary_messages=1)
+    messages = builder.messages("s1", 10)
+    assert messages[0] == {"role": "system", "content": "Tóm tắt cuộc trò chuyện trước đó: khách hỏi iphone 15"}
+    # Message đã nằm trong summary không lặp lại, phần archive chưa tóm tắt vẫn có trong prompt
+    assert [m["content"] for m in messages[1:]] == ["human 1", "ai 1", "human 2", "ai 2"]
+
+    # between() gồm message đã archive: summary được cập nhật tiếp từ message sau last_message_id
+    assert _contents(fallback.between("s1", rows[1]["id"], rows[4]["id"])) == ["human 1", "ai 1"]
+    builder.max_tokens = 40
+    builder.messages("s1", 10)
+    builder.wait()
+    assert "khách hỏi iphone 15" in llm.prompts[-1] and "human 1" in llm.prompts[-1]
+    assert summaries.get("s1")[0] == "tóm tắt mới"
+    builder.close()
+    summaries.close()
+    store.close()
+
+
+def test_archived_session_cache_reloads_after_new_archive(db, retention):
+    store = SQLiteHistoryStore(db)
+    _turns(store, "s1", 4)
+    retention.run_once()
+    assert _contents(retention.recent("s1")) == ["human 0", "ai 0"]
+    _turns(store, "s1", 2, start=4)
+    retention.run_once()
+    assert _contents(retention.recent("s1")) == ["human 0", "ai 0", "human 1", "ai 1", "human 2", "ai 2"]
+    assert retention.recent("s1", 0) == []
+    assert retention.recent("missing") == []
+    store.close()
@@ -0,0 +1,111 @@
+import time
+import threading
+from history import SQLiteHistoryStore, WriteBehindHistoryStore
+
+
+class SlowStore:
+    """Store gốc có group commit chậm: append_many giữ `commit_seconds` trước khi ghi xong."""
+    def __init__(self, store, commit_seconds: float):
+        self.store = store
+        self.commit_seconds = commit_seconds
+        self.committing = threading.Event()
+
+    def append_many(self, records):
+        self.committing.set()
+        time.sleep(self.commit_seconds)
+        self.store.append_many(records)
+        self.committing.clear()
+
+    def recent(self, session_id, limit=None):
+        return self.store.recent(session_id, limit)
+
+    def close(self):
+        self.store.close()
+
+
+def _turn(session_id, i):
+    return [{"session_id": session_id, "type": "human", "content": f"q{i}"},
+            {"session_id": session_id, "type": "ai", "content": f"a{i}"}]
+
+
+def _contents(rows):
+    return [row["content"] for row in rows]
+
+
+def test_recent_includes_unflushed_tail(tmp_path):
+    writer = WriteBehindHistoryStore(SQLiteHistoryStore(str(tmp_path / "h.sqlite3")), flush_interval=60)
+    writer.append_many(_turn("s1", 0))
+    rows = writer.recent("s1")
+    assert _contents(rows) == ["q0", "a0"]
+    assert [row["id"] for row in rows] == [None, None]
+    assert writer.pending() == 2
+    writer.close()
+    assert writer.pending() == 0
+
+
+def test_flush_and_close_write_everything(tmp_path):
+    path = str(tmp_path / "h.sqlite3")
+    writer = WriteBehindHistoryStore(SQLiteHistoryStore(path), flush_interval=0.01)
+    for i in range(3):
+        writer.append_many(_turn("s1", i))
+    assert writer.flush(timeout=5)
+    rows = writer.recent("s1", 4)
+    assert _contents(rows) == ["q1", "a1", "q2", "a2"]
+    assert all(row["id"] is not None for row in rows)
+    writer.append_many(_turn("s1", 3))
+    writer.close()
+    store = SQLiteHistoryStore(path)
+    assert len(store.recent("s1")) == 8
+    store.close()
+
+
+def test_reads_of_other_sessions_do_not_wait_for_commit(tmp_path):
+    slow = SlowStore(SQLiteHistoryStore(str(tmp_path / "h.sqlite3")), commit_seconds=0.5)
+    writer = WriteBehindHistoryStore(slow, flush_interval=0.0)
+    writer.append_many(_turn("other", 0))
+    writer.append_many(_turn("s1", 0))
+    assert slow.committing.wait(2)
+
+    started = time.monotonic()
+    assert _contents(writer.recent("s2")) == []
+    assert time.monotonic() - started < 0.25
+
+    # Session có message trong batch đang ghi: chờ batch ghi xong, không thấy message 2 lần
+    rows = writer.recent("s1")
+    assert _contents(rows) == ["q0", "a0"]
+    writer.close()
+
+
+def test_concurrent_reads_never_duplicate_or_lose_messages(tmp_path):
+    writer = WriteBehindHistoryStore(SQLiteHistoryStore(str(tmp_path / "h.sqlite3")), max_batch=4, flush_interval=0.001)
+    sessions = [f"s{i}" for i in range(4)]
+    turns = 40
+    errors = []
+    done = threading.Event()
+
+    def write(session_id):
+        for i in range(turns):
+            writer.append_many(_turn(session_id, i))
+
+    def read(session_id):
+        while not done.is_set():
+            contents = _contents(writer.recent(session_id))
+            expected = [c for i in range(len(contents) // 2) for c in (f"q{i}", f"a{i}")]
+            if contents != expected:
+                errors.append((session_id, contents))
+                return
+
+    readers = [threading.Thread(target=read, args=(s,)) for s in sessions]
+    writers = [threading.Thread(target=write, args=(s,)) for s in sessions]
+    for t in readers + writers:
+        t.start()
+    for t in writers:
+        t.join()
+    assert writer.flush(timeout=10)
+    done.set()
+    for t in readers:
+        t.join()
+    assert errors == []
+    for session_id in sessions:
+        assert len(writer.recent(session_id)) == 2 * turns
+    writer.close()
@@ -0,0 +1,102 @@
+import json
+import pytest
+from rag.lexical import BM25Index, tokenize, fold_vietnamese, reciprocal_rank_fusion
+
+DOCS = {
+    "p1": "Điện thoại Samsung Galaxy Z Fold7 256GB",
+    "p2": "Điện thoại iPhone 15 Pro Max 256GB",
+    "p3": "Laptop Dell XPS 13",
+    "p4": "Tai nghe Samsung Galaxy Buds",
+}
+
+
+def _index(docs=DOCS):
+    index = BM25Index()
+    for doc_id, text in docs.items():
+        index.add(doc_id, text)
+    return index
+
+
+def _state(index):
+    return index.postings, index.doc_len, index.total_len, index.doc_terms
+
+
+def test_tokenize():
+    assert fold_vietnamese("Điện thoại") == "dien thoai"
+    assert tokenize("Fold7 256GB") == ["fold7", "fold", "7", "256gb", "256", "gb"]
+
+
+def test_search_ranks_matching_docs():
+    index = _index()
+    hits = index.search("samsung fold 7", limit=2)
+    assert [doc_id for doc_id, _ in hits] == ["p1", "p4"]
+    assert hits[0][1] > hits[1][1]
+    assert index.search("không có từ nào khớp") == []
+
+
+def test_search_allowed_ids_and_limit():
+    index = _index()
+    assert [doc_id for doc_id, _ in index.search("samsung", allowed_ids={"p4"})] == ["p4"]
+    assert len(index.search("điện thoại", limit=1)) == 1
+
+
+def test_remove_only_touches_doc_terms():
+    index = _index()
+    index.remove("p3")
+    assert "p3" not in index.doc_len and "p3" not in index.doc_terms
+    assert "dell" not in index.postings and "xps" not in index.postings
+    assert index.postings["samsung"] == {"p1": 1, "p4": 1}
+    index.remove("p3")   # id không còn -> bỏ qua
+    assert len(index) == 3
+
+
+def test_incremental_update_matches_full_build():
+    index = _index()
+    index.add("p2", "Điện thoại iPhone 16 Pro 512GB")   # doc thay đổi
+    index.remove("p4")
+    index.add("p5", "Máy tính bảng iPad Air")
+    expected = _index({"p1": DOCS["p1"], "p2": "Điện thoại iPhone 16 Pro 512GB", "p3": DOCS["p3"], "p5": "Máy tính bảng iPad Air"})
+    assert index.postings == expected.postings
+    assert index.doc_len == expected.doc_len
+    assert index.total_len == expected.total_len
+    assert {k: sorted(v) for k, v in index.doc_terms.items()} == {k: sorted(v) for k, v in expected.doc_terms.items()}
+    assert index.search("iphone 16") == expected.search("iphone 16")
+
+
+def test_save_load_roundtrip(tmp_path):
+    path = str(tmp_path / "products.bm25.json")
+    index = _index()
+    index.catalog_version = "v1"
+    index.save(path)
+    loaded = BM25Index.load(path)
+    assert _state(loaded) == _state(index)
+    assert loaded.catalog_version == "v1"
+    # Term của doc_terms là cùng object với key của postings
+    term = loaded.doc_terms["p1"][0]
+    assert next(t for t in loaded.postings if t == term) is term
+    loaded.remove("p1")
+    assert "fold7" not in loaded.postings
+
+
+def test_load_legacy_file_without_doc_terms(tmp_path):
+    path = str(tmp_path / "products.bm25.json")
+    index = _index()
+    index.save(path)
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    del data["doc_terms"]
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+
+    loaded = BM25Index.load(path)
+    assert {k: sorted(v) for k, v in loaded.doc_terms.items()} == {k: sorted(v) for k, v in index.doc_terms.items()}
+    loaded.remove("p3")
+    assert "dell" not in loaded.postings
+
+
+@pytest.mark.parametrize("rankings, expected", [
+    ([["a", "b"], ["b", "c"]], ["b", "a", "c"]),
+    ([["a"], []], ["a"]),
+])
+def test_reciprocal_rank_fusion(rankings, expected):
+    assert [doc_id for doc_id, _ in reciprocal_rank_fusion(rankings)] == expected
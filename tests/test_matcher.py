@@ -0,0 +1,58 @@
+import pytest
+from rag.matcher import AhoCorasick, EntityMatcher, normalize_for_match, model_name, entity_index_path
+
+TITLES = ["Samsung Galaxy Z Fold7 256GB 5G", "iPhone 15 Pro Max (2023)", "Laptop Dell XPS 13"]
+BRANDS = ["Samsung", "Apple", "Dell"]
+CATEGORIES = ["Điện thoại", "Điện thoại", "Laptop"]
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return EntityMatcher.from_catalog(TITLES, BRANDS, CATEGORIES, catalog_version="v1")
+
+
+def _entities(matches):
+    return [(m["type"], m["value"]) for m in matches]
+
+
+def test_normalize_and_model_name():
+    assert normalize_for_match("Điện thoại Fold7 256GB!") == " dien thoai fold 7 256 gb "
+    assert model_name("iPhone 15 Pro Max 256GB / 8GB (2023)") == "iphone 15 pro max"
+    assert model_name("Samsung Galaxy Z Fold7 256GB 5G") == "samsung galaxy z fold 7"
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = AhoCorasick()
+    for pattern in ("he", "she", "hers"):
+        automaton.add(pattern, pattern)
+    automaton.build()
+    assert sorted((start, payload) for start, _, payload in automaton.iter("ushers")) == [(1, "she"), (2, "he"), (2, "hers")]
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("iPhone 15 Pro Max còn hàng ko", [("brand", "apple"), ("model", "iphone 15 pro max")]),
+    ("giá galaxy z fold 7 bao nhiêu", [("brand", "samsung"), ("model", "samsung galaxy z fold 7")]),
+    ("có laptop dell không", [("category", "laptop"), ("keyword", "laptop"), ("brand", "dell")]),
+    ("ai phon giá bao nhiêu", [("brand", "apple")]),
+    ("samsum", [("brand", "samsung")]),
+    ("hôm nay trời đẹp", []),
+])
+def test_match(matcher, query, expected):
+    assert _entities(matcher.match(query)) == expected
+
+
+def test_match_only_whole_words(matcher):
+    assert matcher.match("delloitte") == []
+
+
+def test_constraints(matcher):
+    assert EntityMatcher.constraints(matcher.match("sam sung dt")) == {"brands": ["samsung"], "categories": ["dien thoai"]}
+    assert EntityMatcher.constraints([]) == {}
+
+
+def test_save_load_roundtrip(matcher, tmp_path):
+    path = entity_index_path(str(tmp_path), "products")
+    matcher.save(path)
+    loaded = EntityMatcher.load(path)
+    assert loaded.catalog_version == "v1" and len(loaded) == len(matcher)
+    assert loaded.match("có laptop dell không") == matcher.match("có laptop dell không")
@@ -0,0 +1,109 @@
+import os
+import json
+import threading
+import numpy as np
+from rag.records import CatalogStore, COLUMNS
+
+
+def _catalog(generation: int, count: int = 20):
+    ids = [f"p{i}" for i in range(count)]
+    documents = [f"mô tả {generation}-{i} " + "x" * (generation * 7 % 13) for i in range(count)]
+    metadatas = [{"title": f"Sản phẩm {generation}-{i}", "price": str(1000 * i), "brand": "acme", "link": ""} for i in range(count)]
+    return ids, documents, metadatas
+
+
+def _files(tmp_path):
+    return sorted(name for name in os.listdir(tmp_path) if name.endswith(".npy"))
+
+
+def test_build_and_read(tmp_path):
+    path = str(tmp_path / "products.records")
+    ids, documents, metadatas = _catalog(1)
+    CatalogStore.build(path, ids, documents, metadatas, catalog_version="v1")
+    store = CatalogStore(path)
+    assert len(store) == 20
+    assert store.catalog_version == "v1"
+    row = store.row("p3")
+    assert store.value(row, "_id") == "p3"
+    assert store.value(row, "title") == "Sản phẩm 1-3"
+    assert store.value(row, "description") == documents[3]
+    assert store.value(row, "snippet").startswith("Title: Sản phẩm 1-3, Content: ")
+    assert store.row("missing") is None
+
+
+def test_empty_store(tmp_path):
+    path = str(tmp_path / "empty.records")
+    CatalogStore.build(path, [], [], [])
+    store = CatalogStore(path)
+    assert len(store) == 0
+    assert store.offsets.shape == (len(COLUMNS), 1)
+
+
+def test_rebuild_keeps_open_store_readable_and_removes_stale_files(tmp_path):
+    path = str(tmp_path / "products.records")
+    CatalogStore.build(path, *_catalog(1), catalog_version="v1")
+    old = CatalogStore(path)
+    old_files = _files(tmp_path)
+
+    CatalogStore.build(path, *_catalog(2), catalog_version="v2")
+    new = CatalogStore(path)
+    assert new.build_id != old.build_id
+    assert new.value(new.row("p5"), "title") == "Sản phẩm 2-5"
+    # Store đã memory-map trước khi rebuild vẫn đọc đúng build của nó
+    assert old.value(old.row("p5"), "title") == "Sản phẩm 1-5"
+    assert not set(old_files) & set(_files(tmp_path))
+    assert len(_files(tmp_path)) == 2
+
+
+def test_legacy_store_without_build_id(tmp_path):
+    path = str(tmp_path / "products.records")
+    CatalogStore.build(path, *_catalog(1), catalog_version="v1")
+    with open(path + ".json", encoding="utf-8") as f:
+        info = json.load(f)
+    base = f"{path}.{info.pop('build')}"
+    os.replace(base + ".npy", path + ".npy")
+    os.replace(base + ".offsets.npy", path + ".offsets.npy")
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump(info, f)
+
+    store = CatalogStore(path)
+    assert store.build_id is None
+    assert store.value(store.row("p1"), "title") == "Sản phẩm 1-1"
+
+    # Build mới thay thế và xoá file của bản cũ
+    CatalogStore.build(path, *_catalog(2), catalog_version="v2")
+    assert not os.path.exists(path + ".npy") and not os.path.exists(path + ".offsets.npy")
+
+
+def test_concurrent_rebuild_never_mixes_builds(tmp_path):
+    path = str(tmp_path / "products.records")
+    CatalogStore.build(path, *_catalog(0), catalog_version="0")
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        generation = 1
+        while not stop.is_set():
+            CatalogStore.build(path, *_catalog(generation), catalog_version=str(generation))
+            generation += 1
+
+    def reader():
+        while not stop.is_set():
+            try:
+                store = CatalogStore(path)
+                generation = store.catalog_version
+                titles = {store.value(r, "title") for r in range(len(store))}
+                assert titles == {f"Sản phẩm {generation}-{i}" for i in range(20)}
+            except Exception as e:   # noqa: BLE001 - ghi lại mọi lỗi của reader
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(3)]
+    for t in threads:
+        t.start()
+    stop.wait(1.0)
+    stop.set()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert np.all(np.diff(CatalogStore(path).offsets[0]) >= 0)
@@ -0,0 +1,126 @@
+import os
+import pytest
+from rag import RAG, CatalogRegistry, BM25Index, lexical_index_path, bump_catalog_version
+
+
+class FakeRAG:
+    """RAG tối giản cho registry: warmup đếm số lần load, resident_bytes cố định (đổi được khi 'load lại')."""
+    def __init__(self, size: int):
+        self.size = size
+        self.warmups = 0
+        self.generation = 0
+
+    def warmup(self, open_stores: bool = True):
+        self.warmups += 1
+        self.generation += 1
+
+    def resident_bytes(self):
+        return {"index": self.size}
+
+    def reload(self, size: int):
+        self.size = size
+        self.generation += 1
+
+
+class FakeCollection:
+    def __init__(self, products):
+        self.products = products
+        self.gets = 0
+
+    def get(self, include=None, **kwargs):
+        self.gets += 1
+        return {
+            "ids": list(self.products),
+            "documents": ["" for _ in self.products],
+            "metadatas": [{"title": title} for title in self.products.values()],
+        }
+
+
+def _registry(tmp_path, max_bytes, **sizes):
+    registry = CatalogRegistry(str(tmp_path), max_bytes=max_bytes)
+    rags = {name: FakeRAG(size) for name, size in sizes.items()}
+    for name, rag in rags.items():
+        registry.register(name, rag)
+    return registry, rags
+
+
+def _resident(registry):
+    return sorted(name for name, c in registry.stats()["catalogs"].items() if c["resident"])
+
+
+# ------------------- CatalogRegistry: LRU theo memory budget -------------------
+def test_evicts_least_recently_used_over_budget(tmp_path):
+    registry, rags = _registry(tmp_path, 250, a=100, b=100, c=100)
+    registry.get("a")
+    registry.get("b")
+    registry.get("a")
+    registry.get("c")   # 300 > 250 -> evict b (lâu không dùng nhất)
+    assert _resident(registry) == ["a", "c"]
+    stats = registry.stats()
+    assert stats["resident_bytes"] == 200
+    assert stats["catalogs"]["b"]["evictions"] == 1 and stats["catalogs"]["b"]["loads"] == 1
+    # Catalog bị evict: lần dùng sau tạo RAG mới và load lại
+    assert "b" in registry
+    with pytest.raises(KeyError):
+        registry.get("missing")
+
+
+def test_pinned_and_just_loaded_catalogs_are_not_evicted(tmp_path):
+    registry = CatalogRegistry(str(tmp_path), max_bytes=150)
+    pinned, other = FakeRAG(100), FakeRAG(100)
+    registry.register("pinned", pinned, pinned=True)
+    registry.register("other", other)
+    registry.warmup()
+    assert pinned.warmups == 1 and other.warmups == 0
+    registry.get("other")   # vượt budget nhưng chỉ còn catalog pinned và catalog vừa load
+    assert _resident(registry) == ["other", "pinned"]
+    registry.get("pinned")
+    assert pinned.warmups == 1
+
+
+def test_reloaded_index_refreshes_bytes_and_evicts(tmp_path):
+    registry, rags = _registry(tmp_path, 250, a=100, b=100)
+    registry.get("a")
+    registry.get("b")
+    assert registry.stats()["resident_bytes"] == 200
+    rags["b"].reload(200)   # catalog b đổi version, index mới lớn hơn
+    registry.get("b")
+    assert _resident(registry) == ["b"]
+    assert registry.stats()["catalogs"]["b"]["bytes"] == 200
+    assert rags["b"].warmups == 1
+
+
+# ------------------- RAG: version catalog + load index -------------------
+def test_catalog_version_is_cached_for_ttl(tmp_path):
+    db_path = str(tmp_path)
+    bump_catalog_version(db_path, "v1", collection_name="products")
+    rag = RAG("products", db_path, backend="numpy")
+    assert rag.catalog_version() == "v1"
+    bump_catalog_version(db_path, "v2", collection_name="products")
+    assert rag.catalog_version() == "v1"
+    rag.version_ttl = 0
+    assert rag.catalog_version() == "v2"
+
+
+def test_lexical_rebuilds_on_corrupt_file_and_bumps_generation(tmp_path):
+    db_path = str(tmp_path)
+    bump_catalog_version(db_path, "v1", collection_name="products")
+    path = lexical_index_path(db_path, "products")
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("{không phải json")
+
+    rag = RAG("products", db_path, backend="numpy")
+    rag.version_ttl = 0
+    rag.collection = FakeCollection({"p1": "iPhone 15", "p2": "Galaxy S24"})
+    index = rag.lexical()
+    assert isinstance(index, BM25Index) and index.catalog_version == "v1"
+    assert [doc_id for doc_id, _ in index.search("galaxy")] == ["p2"]
+    assert rag.lexical() is index and rag.generation == 1
+
+    # Catalog đổi version -> load lại, generation tăng
+    index.save(path)
+    bump_catalog_version(db_path, "v2", collection_name="products")
+    reloaded = rag.lexical()
+    assert reloaded is not index and reloaded.catalog_version == "v2"
+    assert rag.generation == 2 and rag.collection.gets == 2
+    assert os.path.exists(path)
@@ -0,0 +1,81 @@
+import time
+import uuid
+import pytest
+from reflection.semantic_cache import SemanticCache
+
+chromadb = pytest.importorskip("chromadb")
+
+
+class CountingCollection:
+    """Collection Chroma thật, đếm số lần update metadata."""
+    def __init__(self, collection):
+        self.collection = collection
+        self.updates = 0
+
+    def update(self, **kwargs):
+        self.updates += 1
+        return self.collection.update(**kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def _embedding(i: int, dim: int = 8) -> list:
+    return [1.0 if j == i else 0.0 for j in range(dim)]
+
+
+@pytest.fixture
+def collection():
+    client = chromadb.EphemeralClient()
+    name = f"cache_{uuid.uuid4().hex}"
+    yield CountingCollection(client.create_collection(name, metadata={"hnsw:space": "cosine"}))
+    client.delete_collection(name)
+
+
+def _last_used(collection) -> dict:
+    entries = collection.get(include=["metadatas", "documents"])
+    return {doc.split('"content": "')[-1].split('"')[0]: meta["last_used"]
+            for doc, meta in zip(entries["documents"], entries["metadatas"])}
+
+
+def _store(cache, i: int):
+    cache.store(f"q{i}", f"q{i}", f"a{i}", _embedding(i))
+    time.sleep(0.01)
+
+
+def test_hit_buffers_last_used_until_sweep(collection):
+    cache = SemanticCache(collection, sweep_interval=3600)
+    _store(cache, 0)
+    stored = _last_used(collection)["a0"]
+
+    assert cache.lookup(_embedding(0)) == "a0"
+    assert cache.lookup(_embedding(0)) == "a0"
+    assert cache.lookup(_embedding(1)) is None
+    assert collection.updates == 0
+    assert _last_used(collection)["a0"] == stored
+
+    cache.evict()
+    assert collection.updates == 1
+    assert _last_used(collection)["a0"] > stored
+    cache.evict()   # không còn lần dùng nào chưa ghi
+    assert collection.updates == 1
+
+
+def test_sweep_lru_uses_buffered_hits(collection):
+    cache = SemanticCache(collection, max_size=4, evict_ratio=0.5, sweep_interval=3600)
+    for i in range(4):
+        _store(cache, i)
+    assert cache.lookup(_embedding(0)) == "a0"   # entry cũ nhất nhưng vừa được dùng
+    cache.max_size = 3
+    assert cache.evict() == 3
+    assert list(_last_used(collection)) == ["a0"]
+
+
+def test_sweep_drops_touches_of_stale_entries(collection):
+    version = {"value": "v1"}
+    cache = SemanticCache(collection, version_fn=lambda catalog: version["value"], sweep_interval=3600)
+    _store(cache, 0)
+    assert cache.lookup(_embedding(0)) == "a0"
+    version["value"] = "v2"   # ingest lại catalog
+    assert cache.evict() == 1
+    assert collection.updates == 0 and collection.count() == 0
@@ -0,0 +1,123 @@
+import os
+import json
+import threading
+import numpy as np
+import pytest
+from rag.vector_index import NumpyIndex
+
+
+def _vectors(generation: int, count: int = 50, dim: int = 8):
+    rng = np.random.default_rng(generation)
+    return rng.standard_normal((count, dim)).astype(np.float32)
+
+
+def _ids(count: int = 50):
+    return [f"p{i}" for i in range(count)]
+
+
+def _files(tmp_path):
+    return sorted(name for name in os.listdir(tmp_path) if name.endswith(".npy"))
+
+
+@pytest.mark.parametrize("space", ["l2", "cosine", "ip"])
+def test_query_matches_brute_force(tmp_path, space):
+    path = str(tmp_path / "products.index")
+    vectors = _vectors(1)
+    NumpyIndex.build(path, _ids(), vectors, space=space, catalog_version="v1", chunk_size=16)
+    index = NumpyIndex(path)
+    assert len(index) == 50 and index.catalog_version == "v1"
+
+    query = _vectors(2, count=1)[0]
+    if space == "l2":
+        expected = ((vectors - query) ** 2).sum(axis=1)
+    elif space == "ip":
+        expected = 1 - vectors @ query
+    else:
+        expected = 1 - vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+    top = np.argsort(expected, kind="stable")[:5]
+    result = index.query([query.tolist()], n_results=5)
+    assert result["ids"][0] == [f"p{i}" for i in top]
+    assert result["distances"][0] == pytest.approx(expected[top].tolist(), rel=1e-4, abs=1e-4)
+
+    # Pre-filter theo row + get theo id
+    rows = index.rows_for(["p3", "p7", "missing"])
+    assert rows.tolist() == [3, 7, -1]
+    assert set(index.query([query.tolist()], n_results=5, rows=rows[rows >= 0])["ids"][0]) == {"p3", "p7"}
+    assert index.get(["p7", "missing"], query.tolist())["distances"][0] == pytest.approx([expected[7]], rel=1e-4, abs=1e-4)
+
+
+def test_empty_index(tmp_path):
+    path = str(tmp_path / "empty.index")
+    NumpyIndex.build(path, [], [])
+    index = NumpyIndex(path)
+    assert len(index) == 0
+    assert index.query([[0.0, 1.0]], n_results=3) == {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]]}
+
+
+def test_rebuild_keeps_open_index_readable_and_removes_stale_files(tmp_path):
+    path = str(tmp_path / "products.index")
+    NumpyIndex.build(path, _ids(), _vectors(1), catalog_version="v1")
+    old = NumpyIndex(path)
+    old_files = _files(tmp_path)
+
+    NumpyIndex.build(path, _ids(), _vectors(2), catalog_version="v2")
+    new = NumpyIndex(path)
+    assert new.build_id != old.build_id and new.catalog_version == "v2"
+    # Index đã memory-map trước khi rebuild vẫn đọc đúng build của nó
+    assert np.array_equal(old.vectors, _vectors(1))
+    assert np.array_equal(new.vectors, _vectors(2))
+    assert not set(old_files) & set(_files(tmp_path))
+    assert len(_files(tmp_path)) == 2
+
+
+def test_legacy_index_without_build_id(tmp_path):
+    path = str(tmp_path / "products.index")
+    NumpyIndex.build(path, _ids(), _vectors(1))
+    with open(path + ".json", encoding="utf-8") as f:
+        info = json.load(f)
+    base = f"{path}.{info.pop('build')}"
+    os.replace(base + ".npy", path + ".npy")
+    os.replace(base + ".norms.npy", path + ".norms.npy")
+    with open(path + ".json", "w", encoding="utf-8") as f:
+        json.dump(info, f)
+
+    index = NumpyIndex(path)
+    assert index.build_id is None
+    assert np.array_equal(index.vectors, _vectors(1))
+    NumpyIndex.build(path, _ids(), _vectors(2))
+    assert not os.path.exists(path + ".npy") and not os.path.exists(path + ".norms.npy")
+
+
+def test_concurrent_rebuild_never_mixes_builds(tmp_path):
+    path = str(tmp_path / "products.index")
+    NumpyIndex.build(path, _ids(), _vectors(0), catalog_version="0")
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        generation = 1
+        while not stop.is_set():
+            # Mỗi build có số vector khác nhau: ids và vectors lệch build sẽ bị phát hiện
+            count = 20 + generation % 30
+            NumpyIndex.build(path, _ids(count), _vectors(generation, count), catalog_version=str(generation))
+            generation += 1
+
+    def reader():
+        while not stop.is_set():
+            try:
+                index = NumpyIndex(path)
+                generation = int(index.catalog_version)
+                count = 20 + generation % 30 if generation else 50
+                assert np.array_equal(index.vectors, _vectors(generation, count))
+            except Exception as e:   # noqa: BLE001 - ghi lại mọi lỗi của reader
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader) for _ in range(3)]
+    for t in threads:
+        t.start()
+    stop.wait(1.0)
+    stop.set()
+    for t in threads:
+        t.join()
+    assert errors == []
@@ -1,6 +1,6 @@
 from langchain.tools import tool
-from rag import RAG  # import client + RAG
-from openai import OpenAI
+from rag import RAG, current_catalog  # import client + RAG
+from embeddings import EmbeddingModel, EmbeddingService
 import os
 from dotenv import load_dotenv
 
@@ -9,14 +9,21 @@ load_dotenv()
 AZURE_OPENAI_EMBEDDING_API_KEY = os.getenv("OPENAI_API_KEY_EMBEDDED")
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.getenv("OPENAI_ENDPOINT")
 AZURE_OPENAI_EMBED_MODEL = os.getenv("AZURE_OPENAI_EMBED_MODEL", "text-embedding-3-small")
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH") or os.path.join("VECTOR_STORE", "embedding_cache.sqlite3")
 
-embedding_client = OpenAI(
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "openai")
+
+embedding_engine = EmbeddingModel(
     api_key=AZURE_OPENAI_EMBEDDING_API_KEY,
-    base_url=AZURE_OPENAI_EMBEDDING_ENDPOINT,
+    endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT,
+    model=AZURE_OPENAI_EMBED_MODEL if EMBEDDING_BACKEND == "openai" else None,
+    backend=EMBEDDING_BACKEND
 )
+# Dùng chung cache embedding trên đĩa với app.py
+embedder = EmbeddingService(embedding_engine, cache_path=EMBEDDING_CACHE_PATH)
 
-# Tạo object RAG (nếu chưa có)
-rag = RAG(collection_name="YOUR_COLLECTION_NAME", db_path="VECTOR_STORE")
+# Tạo object RAG (nếu chưa có); trong request có catalog_scope thì dùng catalog của request
+rag = RAG(collection_name=os.getenv("COLLECTION_NAME") or "products", db_path="VECTOR_STORE")
 
 @tool
 def product_search(query: str) -> str:
@@ -24,13 +31,10 @@ def product_search(query: str) -> str:
     Single-input tool để tìm sản phẩm từ RAG.
     """
     # tạo embedding
-    query_embedding = embedding_client.embeddings.create(
-        model=AZURE_OPENAI_EMBED_MODEL,
-        input=query
-    ).data[0].embedding
+    query_embedding = embedder.embed(query)
 
     # lấy context từ RAG
-    context = rag.enhance_prompt(query_embedding)
+    context = (current_catalog() or rag).enhance_prompt(query_embedding, query_text=query)
     if not context:
         return "Không tìm thấy sản phẩm liên quan."
 